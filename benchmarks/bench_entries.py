@@ -0,0 +1,105 @@
+"""micro-benchmark for sorting and grouping the entries of a journal by
+year, as done when build() writes the YYYY.rst TOC files.
+
+This compares the original approach (string-keyed Entry objects and
+one list comprehension per year) with the current one (slotted Entry
+objects sorted on their date ordinal and grouped in a single pass),
+using a synthetic journal held in memory.
+
+usage: python benchmarks/bench_entries.py [--topics 50] [--years 20]
+
+"""
+
+import argparse
+import datetime
+import itertools
+import random
+import timeit
+
+from pyjournal2.build_util import Entry
+
+
+class LegacyEntry:
+    """the Entry class before it had __slots__ and a date ordinal"""
+    def __init__(self, topic, year, entry_date_num):
+        self.topic = topic
+        self.year = int(year)
+        self.entry_date_num = entry_date_num
+
+
+def synthetic_topics(ntopics, nyears, entries_per_year, seed=12345):
+    """return a dict of topic name -> list of YYYY-MM-DD directory names"""
+
+    rng = random.Random(seed)
+    start = datetime.date.today().toordinal() - 365 * nyears
+
+    topics = {}
+    for n in range(ntopics):
+        days = rng.sample(range(365 * nyears), entries_per_year * nyears)
+        topics[f"topic{n:03d}"] = [str(datetime.date.fromordinal(start + d)) for d in days]
+
+    return topics
+
+
+def legacy_bucket(topics):
+    """parse, sort, and group the entries the way build() used to"""
+
+    nfiles = 0
+    for topic, dirs in topics.items():
+        entries = []
+        for d in dirs:
+            y, _, _ = d.split("-")
+            entries.append(LegacyEntry(topic, y, d))
+        entries.sort(reverse=True, key=lambda e: e.entry_date_num)
+
+        years = list({q.year for q in entries})
+        years.sort(reverse=True)
+        for y in years:
+            y_entries = [q for q in entries if q.year == y]
+            nfiles += len(y_entries)
+
+    return nfiles
+
+
+def current_bucket(topics):
+    """parse, sort, and group the entries the way build() does now"""
+
+    nfiles = 0
+    for topic, dirs in topics.items():
+        entries = []
+        for d in dirs:
+            y, _, _ = d.split("-")
+            entries.append(Entry(topic, y, d))
+        entries.sort(reverse=True, key=lambda e: e.ordinal)
+
+        for _, y_entries in itertools.groupby(entries, key=lambda e: e.year):
+            nfiles += len(list(y_entries))
+
+    return nfiles
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--topics", type=int, default=50, help="number of topics")
+    p.add_argument("--years", type=int, default=20, help="number of years")
+    p.add_argument("--entries-per-year", type=int, default=100,
+                   help="entries per topic per year")
+    p.add_argument("--repeat", type=int, default=5, help="number of timing repeats")
+    args = p.parse_args()
+
+    topics = synthetic_topics(args.topics, args.years, args.entries_per_year)
+    nentries = sum(len(v) for v in topics.values())
+
+    assert legacy_bucket(topics) == current_bucket(topics) == nentries
+
+    t_legacy = min(timeit.repeat(lambda: legacy_bucket(topics), number=1, repeat=args.repeat))
+    t_current = min(timeit.repeat(lambda: current_bucket(topics), number=1, repeat=args.repeat))
+
+    print(f"{args.topics} topics, {args.years} years, {nentries} entries")
+    print(f"  legacy (per-year list comprehension): {t_legacy*1000:8.1f} ms")
+    print(f"  current (single-pass groupby):        {t_current*1000:8.1f} ms")
+    print(f"  speedup: {t_legacy/t_current:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
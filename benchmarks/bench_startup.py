@@ -0,0 +1,73 @@
+"""startup-time regression check for the pyjournal command line.
+
+This runs "pyjournal status" a number of times against a throwaway
+journal configuration and compares the median wall-clock time with a
+fixed budget.  It exits with a nonzero status if the budget is
+exceeded, so it can be used as a CI check.
+
+usage: python benchmarks/bench_startup.py [--budget 150] [--runs 10]
+
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def time_command(cmd, env, runs):
+    """return the list of wall-clock times (in ms) for running cmd"""
+
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(1000.0 * (time.perf_counter() - start))
+
+    return times
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--budget", type=float, default=150.0,
+                   help="the allowed median time for 'pyjournal status' in ms")
+    p.add_argument("--runs", type=int, default=10, help="number of timed runs")
+    args = p.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+
+        # a minimal configuration is enough for status -- it should
+        # not touch the journal itself
+        with open(os.path.join(home, ".pyjournal2rc"), "w") as f:
+            f.write("[main]\n")
+            f.write(f"master_repo = {home}/journal-bench.git\n")
+            f.write(f"working_path = {home}\n")
+            f.write("nickname = bench\n")
+
+        env = dict(os.environ, HOME=home)
+
+        cmd = [sys.executable, "-c",
+               "from pyjournal2.main_util import run; import sys; "
+               "sys.argv = ['pyjournal', 'status']; run()"]
+
+        baseline = time_command([sys.executable, "-c", "pass"], env, args.runs)
+        status = time_command(cmd, env, args.runs)
+
+    t_base = statistics.median(baseline)
+    t_status = statistics.median(status)
+
+    print(f"python startup:   {t_base:7.1f} ms")
+    print(f"pyjournal status: {t_status:7.1f} ms (budget {args.budget:.1f} ms)")
+
+    if t_status > args.budget:
+        sys.exit("FAIL: pyjournal status is over its startup budget")
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""benchmark suite for the scan, TOC, entry, and build paths.
+
+A synthetic journal (see synthetic.py) is generated in a temporary
+directory and the main code paths are timed on it.  The results are
+written as JSON, so they can be saved and compared across releases:
+
+    python benchmarks/bench_suite.py --topics 50 --years 10 -o results.json
+
+Progress and anything the timed code prints goes to stderr, so the
+JSON can also be sent to stdout.
+
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from pyjournal2 import __version__
+from pyjournal2 import build_util
+from pyjournal2 import catalog_util
+from pyjournal2 import entry_util
+from pyjournal2 import main_util
+from pyjournal2 import profile_util
+from pyjournal2 import sphinx_util
+
+import synthetic
+
+
+def timed(results, name, func, *args, repeat=1, **kwargs):
+    """run func repeat times, storing the best wall-clock time (in
+    seconds) in results[name], and return the result of the last call"""
+
+    best = None
+    value = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(sys.stderr):
+            value = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    results[name] = best
+    print(f"{name:40s} {best:10.4f} s", file=sys.stderr)
+
+    return value
+
+
+def bench_scan(defs, results, repeat):
+    """time the topic and entry enumeration, with a cold and a warm catalog"""
+
+    catalog_util.clear(defs)
+    topics, _ = timed(results, "get_topics_cold", build_util.get_topics, defs)
+    timed(results, "get_topics", build_util.get_topics, defs, repeat=repeat)
+
+    def all_entries():
+        return [build_util.get_topic_entries(t, defs) for t in topics]
+
+    catalog_util.clear(defs)
+    timed(results, "get_topic_entries_cold", all_entries)
+    timed(results, "get_topic_entries", all_entries, repeat=repeat)
+
+    timed(results, "get_most_recent_entries", build_util.get_most_recent_entries,
+          topics, defs, repeat=repeat)
+
+    return topics
+
+
+def bench_tocs(defs, results, repeat):
+    """time writing the TOC files from scratch and when nothing changed"""
+
+    topics, other = build_util.get_topics(defs)
+    timed(results, "write_tocs_initial", build_util.write_tocs, defs, topics, other)
+    timed(results, "write_tocs_unchanged", build_util.write_tocs, defs, topics, other,
+          repeat=repeat)
+
+
+def bench_entry(defs, results, topics, nentries, image):
+    """time adding new entries (with one image each) through entry()"""
+
+    # we need a git identity for the commits
+    os.environ.setdefault("GIT_AUTHOR_NAME", "bench")
+    os.environ.setdefault("GIT_AUTHOR_EMAIL", "bench@localhost")
+    os.environ.setdefault("GIT_COMMITTER_NAME", "bench")
+    os.environ.setdefault("GIT_COMMITTER_EMAIL", "bench@localhost")
+
+    # use dates after the synthetic journal ends, so these are new entries
+    today = datetime.date.today().toordinal()
+
+    def add_entries():
+        cwd = os.getcwd()
+        for n in range(nentries):
+            date = str(datetime.date.fromordinal(today + 1 + n))
+            entry_util.entry(topics[n % len(topics)], [image], [], defs,
+                             string="benchmark entry\n", use_date=date)
+        os.chdir(cwd)
+
+    timed(results, f"entry_x{nentries}", add_entries)
+    results["entry_mean"] = results[f"entry_x{nentries}"] / nentries
+
+
+def html_bytes(defs):
+    """return the total size of the HTML pages in the build"""
+
+    _, html_dir, _ = sphinx_util.get_build_dirs(defs)
+
+    total = 0
+    for root, _, names in os.walk(html_dir):
+        total += sum(os.path.getsize(os.path.join(root, n)) for n in names if n.endswith(".html"))
+
+    return total
+
+
+def bench_sphinx(defs, results, jobs):
+    """time a full Sphinx build and an incremental build with no changes.
+    The read and write phases of the full build are timed separately,
+    and the size of the HTML it writes is recorded.  The phases can
+    only be timed with a single Sphinx worker, so with more workers
+    they come from a separate full build with one."""
+
+    serial = sphinx_util.get_jobs(defs, jobs) == 1
+
+    profile = profile_util.BuildProfile() if serial else None
+    result = timed(results, "build_full", build_util.build, defs, clean=True, jobs=jobs,
+                   profile=profile)
+    results["build_full_status"] = result.status
+    results["build_full_warnings"] = len(result.warnings)
+    results["html_bytes"] = html_bytes(defs)
+
+    if not serial:
+        profile = profile_util.BuildProfile()
+        timed(results, "build_full_serial", build_util.build, defs, clean=True, jobs=1,
+              profile=profile)
+
+    for name, elapsed in profile.sphinx_phases:
+        results[f"build_full_{name.split()[-1]}"] = elapsed
+
+    timed(results, "build_incremental_unchanged", build_util.build, defs, jobs=jobs)
+
+
+def parse_settings(settings):
+    """turn a list of KEY=VALUE strings into a dict of settings, with
+    the values converted to the types read_config would give them"""
+
+    values = {}
+    for setting in settings:
+        key, _, value = setting.partition("=")
+        kind = main_util.OPTIONAL_SETTINGS.get(key, str)
+        if kind is bool:
+            values[key] = value.lower() in ["1", "true", "yes", "on"]
+        else:
+            values[key] = kind(value)
+
+    return values
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--topics", type=int, default=20, help="number of topics")
+    p.add_argument("--years", type=int, default=5, help="number of years")
+    p.add_argument("--entries-per-day", type=float, default=1.0,
+                   help="average number of entries per day (across all topics)")
+    p.add_argument("--words", type=int, default=200, help="average words per entry")
+    p.add_argument("--images", type=float, default=0.2, help="average images per entry")
+    p.add_argument("--notebooks", type=float, default=0.0, help="average notebooks per entry")
+    p.add_argument("--new-entries", type=int, default=10,
+                   help="number of entries to add when timing entry()")
+    p.add_argument("--repeat", type=int, default=3, help="repeats for the warm timings")
+    p.add_argument("--jobs", type=int, default=None, help="parallel Sphinx workers")
+    p.add_argument("--no-sphinx", action="store_true", help="skip the Sphinx builds")
+    p.add_argument("--seed", type=int, default=12345, help="random seed")
+    p.add_argument("--setting", action="append", default=[], metavar="KEY=VALUE",
+                   help="a .pyjournal2rc setting to use (can be repeated), e.g. archive_pages=true")
+    p.add_argument("-o", "--output", default=None, help="write the JSON results here (default: stdout)")
+    args = p.parse_args()
+
+    params = {k: v for k, v in vars(args).items() if k != "output"}
+
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        defs = timed(results, "generate", synthetic.make_journal, tmp,
+                     topics=args.topics, years=args.years,
+                     entries_per_day=args.entries_per_day, words=args.words,
+                     images=args.images, notebooks=args.notebooks,
+                     git=True, seed=args.seed)
+        defs.update(parse_settings(args.setting))
+
+        topics = bench_scan(defs, results, args.repeat)
+        results["num_topics"] = len(topics)
+        results["num_entries"] = sum(len(build_util.get_topic_entries(t, defs)) for t in topics)
+
+        bench_tocs(defs, results, args.repeat)
+
+        image = os.path.join(tmp, "bench.png")
+        with open(image, "wb") as f:
+            f.write(synthetic.png_bytes(64, 48))
+
+        bench_entry(defs, results, topics, args.new_entries, image)
+
+        if not args.no_sphinx:
+            bench_sphinx(defs, results, args.jobs)
+
+    report = {"pyjournal2_version": __version__,
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "date": datetime.datetime.now().isoformat(timespec="seconds"),
+              "params": params,
+              "results": results}
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
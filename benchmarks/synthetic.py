@@ -0,0 +1,187 @@
+"""generate a synthetic journal for benchmarking.
+
+The journal has the same layout that "pyjournal init", create_topic,
+and entry() produce: a copy of the Sphinx base tree in
+journal-<nickname>/source/, one directory per topic, and one
+YYYY-MM-DD/ directory per entry holding the entry's .rst file and any
+images or linked files.  Everything is generated from a seeded random
+number generator, so the same parameters give the same journal.
+
+usage: python benchmarks/synthetic.py path [--topics 20] [--years 5] ...
+
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import zlib
+
+from pyjournal2 import build_util
+from pyjournal2 import entry_util
+
+WORDS = """the a of and to in is that for it with as was on be by this are
+we at from or an which can but not have has more than density temperature
+flow shock burning convergence resolution grid timestep run simulation
+plot energy mass velocity pressure star white dwarf nova reaction network
+test compare figure paper draft code bug fix merge branch meeting idea
+model equation solver method error norm result output input parameter""".split()
+
+
+def png_bytes(width, height, seed=0):
+    """return a small, valid RGB PNG image"""
+
+    rng = random.Random(seed)
+    color = bytes(rng.randrange(256) for _ in range(3))
+    raw = b"".join(b"\x00" + color * width for _ in range(height))
+
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data +
+                struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    return (b"\x89PNG\r\n\x1a\n" +
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) +
+            chunk(b"IDAT", zlib.compress(raw)) +
+            chunk(b"IEND", b""))
+
+
+def notebook_json(rng):
+    """return a small, already executed Jupyter notebook.  There are
+    no markdown cells, so nbsphinx does not need pandoc to render it."""
+
+    a, b = rng.randrange(100), rng.randrange(100)
+    nb = {"nbformat": 4, "nbformat_minor": 5,
+          "metadata": {"kernelspec": {"name": "python3", "display_name": "Python 3",
+                                      "language": "python"}},
+          "cells": [{"cell_type": "code", "id": "code", "metadata": {},
+                     "execution_count": 1, "source": [f"{a} + {b}"],
+                     "outputs": [{"output_type": "execute_result", "execution_count": 1,
+                                  "metadata": {}, "data": {"text/plain": [f"{a + b}"]}}]}]}
+    return json.dumps(nb, indent=1)
+
+
+def paragraph(rng, nwords):
+    """return nwords of random text"""
+    return " ".join(rng.choice(WORDS) for _ in range(nwords))
+
+
+def write_entry(defs, topic, entry_dir, rng, *, words=200, images=0, notebooks=0):
+    """write an entry file (and its attachments) the way entry() lays it out"""
+
+    odir = os.path.join(build_util.get_source_dir(defs), topic, entry_dir)
+    os.mkdir(odir)
+
+    text = f".. _{topic}_{entry_dir}:\n\n"
+    text += len(entry_dir)*"*" + "\n" + f"{entry_dir}\n" + len(entry_dir)*"*" + "\n"
+    text += entry_util.SYMBOLS + "\n\n"
+    text += paragraph(rng, words) + "\n"
+
+    # the figure labels are global in Sphinx, and several topics can
+    # have an entry on the same day
+    unique_id = f"{entry_dir}_12.00.00_{topic}"
+
+    for n in range(images):
+        name = f"plot{n}.png"
+        with open(os.path.join(odir, name), "wb") as f:
+            f.write(png_bytes(32, 24, seed=rng.randrange(1 << 30)))
+
+        for l in entry_util.FIGURE_STR.split("\n"):
+            l = l.replace("@figname@", name).replace("@figlabel@", f"{unique_id}:plot{n}")
+            text += l.replace("@download@", "").rstrip() + "\n"
+
+    for n in range(notebooks):
+        name = f"analysis{n}.ipynb"
+        with open(os.path.join(odir, name), "w") as f:
+            f.write(notebook_json(rng))
+
+        text += f":download:`{name} <{name}>`\n\n"
+
+    with open(os.path.join(odir, f"{entry_dir}.rst"), "w") as f:
+        f.write(text)
+
+
+def make_journal(working_path, *, nickname="synthetic", topics=20, years=5,
+                 entries_per_day=1.0, words=200, images=0.2, notebooks=0.0,
+                 git=False, seed=12345):
+    """create a synthetic journal under working_path and return its defs.
+
+    entries_per_day is the average number of entries written per day
+    across the whole journal, each in a random topic.  images and
+    notebooks are the average number of each attached to an entry.
+    If git is True, the working directory is made a git repo with the
+    journal committed, so entries can be added with entry().
+
+    """
+
+    rng = random.Random(seed)
+
+    module_dir = os.path.dirname(os.path.abspath(entry_util.__file__))
+
+    working_path = os.path.abspath(working_path)
+    defs = {"working_path": working_path,
+            "nickname": nickname,
+            "module_dir": module_dir,
+            "auto_commit": True}
+
+    journal_dir = os.path.join(working_path, f"journal-{nickname}")
+    shutil.copytree(os.path.join(module_dir, "sphinx_base/source"),
+                    os.path.join(journal_dir, "source"))
+    shutil.copy(os.path.join(module_dir, "sphinx_base/Makefile"), journal_dir)
+
+    topic_names = [f"topic{n:03d}" for n in range(topics)]
+    for t in topic_names:
+        build_util.create_topic(t, defs)
+
+    # pick the entries -- at most one per topic per day
+    start = datetime.date.today().toordinal() - 365 * years
+    nentries = int(entries_per_day * 365 * years)
+
+    chosen = set()
+    for _ in range(nentries):
+        chosen.add((rng.choice(topic_names), start + rng.randrange(365 * years)))
+
+    for t, day in sorted(chosen):
+        nimages = int(images) + (rng.random() < images - int(images))
+        nnotebooks = int(notebooks) + (rng.random() < notebooks - int(notebooks))
+        write_entry(defs, t, str(datetime.date.fromordinal(day)), rng,
+                    words=max(1, int(rng.gauss(words, words / 4))),
+                    images=nimages, notebooks=nnotebooks)
+
+    if git:
+        for cmd in (["git", "init", "-q"],
+                    ["git", "add", "."],
+                    ["git", "-c", "user.name=bench", "-c", "user.email=bench@localhost",
+                     "commit", "-q", "-m", "synthetic journal"]):
+            subprocess.run(cmd, cwd=journal_dir, check=True)
+
+    return defs
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("path", help="the working path to create the journal in")
+    p.add_argument("--nickname", default="synthetic", help="the journal nickname")
+    p.add_argument("--topics", type=int, default=20, help="number of topics")
+    p.add_argument("--years", type=int, default=5, help="number of years")
+    p.add_argument("--entries-per-day", type=float, default=1.0,
+                   help="average number of entries per day (across all topics)")
+    p.add_argument("--words", type=int, default=200, help="average words per entry")
+    p.add_argument("--images", type=float, default=0.2, help="average images per entry")
+    p.add_argument("--notebooks", type=float, default=0.0, help="average notebooks per entry")
+    p.add_argument("--git", action="store_true", help="make the journal a git repo")
+    p.add_argument("--seed", type=int, default=12345, help="random seed")
+    args = p.parse_args()
+
+    os.makedirs(args.path, exist_ok=True)
+    make_journal(args.path, nickname=args.nickname, topics=args.topics, years=args.years,
+                 entries_per_day=args.entries_per_day, words=args.words,
+                 images=args.images, notebooks=args.notebooks, git=args.git,
+                 seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""a content-addressed store for the files attached to entries.
+
+Every image or linked file added to an entry is stored once, under
+its SHA-256 hash, in the journal's cache directory.  The file in the
+entry directory is a hardlink to the stored object, so attaching the
+same file to many entries only uses the disk space once, while Sphinx
+and git still see an ordinary file in the entry directory.  (git
+already stores identical content only once in its history.)  If a
+hardlink can't be made, we fall back to a copy.
+
+Since every entry with the same attachment shares the stored object,
+writing to one of them in place would change them all (and leave the
+object under the wrong hash), so the stored objects -- and with them,
+the hardlinks -- are read-only.  An attachment is changed by replacing
+the file, which breaks the link.
+
+Copies into the store are done by the kernel where possible -- a
+reflink (copy-on-write clone) if the file system supports it, then
+copy_file_range or sendfile -- and several attachments are copied at
+once, with the progress shown for large copies.
+
+"""
+
+import concurrent.futures
+import hashlib
+import os
+import shutil
+import stat
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from pyjournal2 import catalog_util
+
+# the special directories in source/ that are not entries
+SKIP_DIRS = ["_static", "_templates"]
+
+# the Linux ioctl that makes a reflink of a whole file
+FICLONE = 0x40049409
+
+# the amount copied per system call (or read) in a copy
+COPY_CHUNK = 8 * 1024 * 1024
+
+# only show the progress of a copy when there is at least this much
+PROGRESS_MIN_BYTES = 64 * 1024 * 1024
+
+# the maximum number of files to copy at once
+MAX_COPY_THREADS = 4
+
+# the permission bits removed from the stored objects
+WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+
+class CopyProgress:
+    """show the progress of a set of copies on stderr.  Each file
+    counts twice -- once for hashing it and once for copying it."""
+
+    def __init__(self, total):
+        self.total = 2 * total
+        self.done = 0
+        self.last = 0.0
+        self.lock = threading.Lock()
+        self.show = total >= PROGRESS_MIN_BYTES and sys.stderr.isatty()
+
+    def update(self, nbytes):
+        """record that nbytes more have been processed"""
+        with self.lock:
+            self.done += nbytes
+            now = time.monotonic()
+            if self.show and now - self.last > 0.2:
+                self.last = now
+                print(f"\rcopying attachments: {self.done / self.total:4.0%} "
+                      f"of {self.total / 2 / 1024**2:.0f} MB", end="", file=sys.stderr)
+
+    def finish(self):
+        """end the progress line"""
+        if self.show:
+            print(f"\rcopying attachments: 100% of {self.total / 2 / 1024**2:.0f} MB",
+                  file=sys.stderr)
+
+
+def get_store_dir(defs):
+    """return the directory holding the stored attachments"""
+
+    store_dir = os.path.join(catalog_util.get_cache_dir(defs), "attachments")
+    os.makedirs(store_dir, exist_ok=True)
+    return store_dir
+
+
+def hash_file(path, progress=None):
+    """return the SHA-256 hex digest of a file's contents"""
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            h.update(chunk)
+            if progress is not None:
+                progress.update(len(chunk))
+
+    return h.hexdigest()
+
+
+def reflink(fsrc, fdst):
+    """try to make fdst a copy-on-write clone of fsrc.  Returns True if
+    the file system supports this."""
+
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        return False
+
+    return True
+
+
+def kernel_copy(fsrc, fdst, progress=None):
+    """copy fsrc to fdst with copy_file_range or sendfile, so the data
+    never passes through Python.  Returns False if neither works here
+    (in which case nothing was copied)."""
+
+    infd = fsrc.fileno()
+    outfd = fdst.fileno()
+
+    for name in ["copy_file_range", "sendfile"]:
+        if not hasattr(os, name):
+            continue
+
+        copied = 0
+        while True:
+            try:
+                if name == "copy_file_range":
+                    n = os.copy_file_range(infd, outfd, COPY_CHUNK)
+                else:
+                    n = os.sendfile(outfd, infd, None, COPY_CHUNK)
+            except OSError:
+                if copied == 0:
+                    # not supported for these files -- try the next way
+                    break
+                raise
+
+            if n == 0:
+                return True
+
+            copied += n
+            if progress is not None:
+                progress.update(n)
+
+    return False
+
+
+def copy_file(src, dest, progress=None):
+    """copy the contents and permissions of src to dest, as cheaply as
+    the platform allows"""
+
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+        if reflink(fsrc, fdst):
+            if progress is not None:
+                progress.update(os.fstat(fsrc.fileno()).st_size)
+
+        elif not kernel_copy(fsrc, fdst, progress):
+            while True:
+                chunk = fsrc.read(COPY_CHUNK)
+                if not chunk:
+                    break
+                fdst.write(chunk)
+                if progress is not None:
+                    progress.update(len(chunk))
+
+    shutil.copymode(src, dest)
+
+
+def object_path(defs, digest, name):
+    """return the path in the store for content with the given digest.
+    We keep the file extension so the objects are easy to identify."""
+
+    ext = os.path.splitext(name)[1].lower()
+    return os.path.join(get_store_dir(defs), digest[:2], f"{digest}{ext}")
+
+
+def make_read_only(path):
+    """remove the write permissions of the stored object path (and so of
+    every hardlink to it)"""
+
+    mode = stat.S_IMODE(os.stat(path).st_mode)
+    if mode & WRITE_BITS:
+        os.chmod(path, mode & ~WRITE_BITS)
+
+
+def link_or_copy(src, dest):
+    """make dest a hardlink to the stored object src (replacing dest if
+    it exists), or a copy if the file system can't do that.  A hardlink
+    is read-only, like the object, but a copy isn't shared, so it can
+    be written to."""
+
+    make_read_only(src)
+
+    tmp = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+        os.chmod(tmp, stat.S_IMODE(os.stat(tmp).st_mode) | stat.S_IWUSR)
+
+    os.replace(tmp, dest)
+
+
+def place(defs, src, dest, progress=None):
+    """copy the file src to dest (in an entry directory) through the
+    store.  Returns the digest of the file."""
+
+    digest = hash_file(src, progress)
+    obj = object_path(defs, digest, src)
+
+    if not os.path.isfile(obj):
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        tmp = f"{obj}.{os.getpid()}.{threading.get_ident()}.tmp"
+        copy_file(src, tmp, progress)
+        os.replace(tmp, obj)
+    elif progress is not None:
+        progress.update(os.path.getsize(src))
+
+    link_or_copy(obj, dest)
+
+    return digest
+
+
+def place_all(defs, copies):
+    """copy each (src, dest) pair in copies through the store, several
+    at once.  Returns a dict mapping each dest to its digest."""
+
+    digests = {}
+    if not copies:
+        return digests
+
+    total = 0
+    for src, _ in copies:
+        try:
+            total += os.path.getsize(src)
+        except OSError:
+            sys.exit(f"ERROR: unable to copy {src}")
+
+    progress = CopyProgress(total)
+
+    nthreads = min(len(copies), MAX_COPY_THREADS)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as pool:
+        futures = {pool.submit(place, defs, src, dest, progress): (src, dest)
+                   for src, dest in copies}
+        for future in concurrent.futures.as_completed(futures):
+            src, dest = futures[future]
+            try:
+                digests[dest] = future.result()
+            except OSError:
+                sys.exit(f"ERROR: unable to copy {src} to {dest}")
+
+    progress.finish()
+
+    return digests
+
+
+def adopt(defs, path, digest=None):
+    """put a file that is already in an entry directory into the store,
+    replacing it with a hardlink to the stored copy if the store already
+    has the same content.  Returns the number of bytes this saved."""
+
+    if digest is None:
+        digest = hash_file(path)
+    obj = object_path(defs, digest, path)
+
+    if not os.path.isfile(obj):
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        try:
+            os.link(path, obj)
+        except OSError:
+            shutil.copy2(path, obj)
+        make_read_only(obj)
+        return 0
+
+    st = os.stat(path)
+    if os.path.samefile(path, obj):
+        # stores from before the objects were read-only
+        make_read_only(obj)
+        return 0
+
+    link_or_copy(obj, path)
+
+    # if we could only copy, nothing was saved
+    if os.path.samefile(path, obj):
+        return st.st_size
+
+    return 0
+
+
+def same_content(path_a, path_b):
+    """do two files have the same contents?"""
+
+    if os.path.getsize(path_a) != os.path.getsize(path_b):
+        return False
+
+    return os.path.samefile(path_a, path_b) or hash_file(path_a) == hash_file(path_b)
+
+
+def find_attachments(defs):
+    """return the paths of every attachment (any file that is not an
+    .rst file) in the topic and special directories of source/"""
+
+    source_dir = os.path.join(catalog_util.get_journal_dir(defs), "source")
+
+    files = []
+    for d in sorted(os.listdir(source_dir)):
+        top = os.path.join(source_dir, d)
+        if d in SKIP_DIRS or d.startswith((".", "_")) or not os.path.isdir(top):
+            continue
+
+        for root, _, names in os.walk(top):
+            for n in sorted(names):
+                if n.endswith(".rst") or n.startswith("."):
+                    continue
+                files.append(os.path.join(root, n))
+
+    return files
+
+
+def dedup(defs):
+    """put every existing attachment into the store, replacing duplicate
+    files with hardlinks to a single stored copy"""
+
+    files = find_attachments(defs)
+
+    nlinked = 0
+    saved = 0
+    for path in files:
+        try:
+            n = adopt(defs, path)
+        except OSError as err:
+            sys.exit(f"ERROR: unable to deduplicate {path}: {err}")
+
+        if n > 0:
+            nlinked += 1
+            saved += n
+
+    print(f"checked {len(files)} attachment(s): replaced {nlinked} duplicate(s), "
+          f"saving {saved / 1024**2:.1f} MB")
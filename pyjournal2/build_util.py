@@ -1,17 +1,33 @@
 """This module controls building the journal from the entry sources"""
 
+import calendar
+import contextlib
+import datetime
+import heapq
+import io
+import itertools
 import os
+import shutil
 import sys
-import webbrowser
 
-from pyjournal2 import shell_util
+from pyjournal2 import catalog_util
+from pyjournal2 import notebook_util
+from pyjournal2 import sidecar_util
+from pyjournal2 import sphinx_util
 
 
 class Entry:
+    """a single dated entry in a topic.  entry_date_num is the
+    YYYY-MM-DD name of the entry's directory, and ordinal is the
+    date as a proleptic Gregorian ordinal, which is what we sort on"""
+
+    __slots__ = ("topic", "year", "entry_date_num", "ordinal")
+
     def __init__(self, topic, year, entry_date_num):
         self.topic = topic
         self.year = int(year)
         self.entry_date_num = entry_date_num
+        self.ordinal = datetime.date.fromisoformat(entry_date_num).toordinal()
 
     def __str__(self):
         return f"{self.topic}: {self.entry_date_num}"
@@ -25,16 +41,17 @@ def get_source_dir(defs):
 def get_topics(defs):
     """return a list of the currently known topics"""
 
-    source_dir = get_source_dir(defs)
-
     topics = []
     other = []
 
     # get the list of directories in source/ -- these are the topics
-    for d in os.listdir(source_dir):
-        if os.path.isdir(os.path.join(source_dir, d)) and not d.startswith("_"):
+    dirs, _ = catalog_util.listing(defs)
+    for d in dirs:
+        if not d.startswith("_"):
             topics.append(d)
 
+    catalog_util.save(defs)
+
     # remove todo, projects, and year_review -- they will be treated specially
     if "todo" in topics:
         topics.remove("todo")
@@ -54,37 +71,79 @@ def get_topics(defs):
 def get_topic_entries(topic, defs):
     """return a list of Entry objects for all the entries in topic"""
 
-    cwd = os.getcwd()
+    # look over the directories here, they will be in the form YYYY-MM-DD
+    entries = []
 
-    source_dir = get_source_dir(defs)
-    tdir = os.path.join(source_dir, topic)
+    dirs, _ = catalog_util.listing(defs, topic)
+    for d in dirs:
+        y, _, _ = d.split("-")
+        entries.append(Entry(topic, y, d))
 
-    os.chdir(tdir)
+    catalog_util.save(defs)
 
-    # look over the directories here, they will be in the form YYYY-MM-DD
-    entries = []
+    entries.sort(reverse=True, key=lambda e: e.ordinal)
+
+    return entries
+
+
+def iter_topic_entries(topic, defs):
+    """lazily yield the Entry objects for topic, most recent first"""
+
+    # the catalog keeps the directories sorted, and the YYYY-MM-DD
+    # names sort chronologically, so we just walk them backwards
+    dirs, _ = catalog_util.listing(defs, topic)
+    for d in reversed(dirs):
+        y, _, _ = d.split("-")
+        yield Entry(topic, y, d)
 
-    for d in os.listdir(tdir):
-        if os.path.isdir(os.path.join(tdir, d)):
-            y, _, _ = d.split("-")
-            entries.append(Entry(topic, y, d))
 
-    entries.sort(reverse=True, key=lambda e: e.entry_date_num)
+def get_most_recent_entries(topics, defs, *, N=None):
+    """return the N most recent entries, regardless of topic.  If N is
+    not given, we use the recent_entries setting from the .pyjournal2rc
+    (default 25)."""
 
-    os.chdir(cwd)
+    if N is None:
+        N = defs.get("recent_entries", 25)
+
+    # each topic is already in date order, so we just need to merge
+    # the topics until we have N entries
+    merged = heapq.merge(*[iter_topic_entries(t, defs) for t in topics],
+                         key=lambda e: e.ordinal, reverse=True)
+    entries = list(itertools.islice(merged, N))
+
+    catalog_util.save(defs)
 
     return entries
 
 
-def get_most_recent_entries(topics, defs, *, N=25):
-    """return the N most recent entries, regardless of topic"""
+def get_thumbnails(defs, entry):
+    """return the file names of the image thumbnails (name.thumb.ext, see
+    image_util) in the directory of entry"""
 
-    entries = []
-    for t in topics:
-        entries += get_topic_entries(t, defs)
+    path = os.path.join(get_source_dir(defs), entry.topic, entry.entry_date_num)
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return []
+
+    return sorted(n for n in names if os.path.splitext(os.path.splitext(n)[0])[1] == ".thumb")
+
+
+def write_gallery(f, thumbs):
+    """write the thumbnails -- a list of (image, target, alt) -- to f as
+    linked images.  They are substitutions in a single paragraph, so
+    they flow together like a gallery."""
 
-    entries.sort(reverse=True, key=lambda e: e.entry_date_num)
-    return entries[0:N]
+    if not thumbs:
+        return
+
+    f.write("\n.. rubric:: recent figures\n\n")
+    f.write(" ".join(f"|thumb-{i}|" for i in range(len(thumbs))) + "\n\n")
+
+    for i, (image, target, alt) in enumerate(thumbs):
+        f.write(f".. |thumb-{i}| image:: {image}\n")
+        f.write(f"   :target: {target}\n")
+        f.write(f"   :alt: {alt}\n\n")
 
 
 def get_year_review_entries(defs):
@@ -93,22 +152,17 @@ def get_year_review_entries(defs):
 
     """
 
-    cwd = os.getcwd()
-
-    source_dir = get_source_dir(defs)
-    tdir = os.path.join(source_dir, "year_review")
-
-    os.chdir(tdir)
-
-    # look over the directories here, they will be in the form YYYY-MM-DD
+    # the year entries are the .rst files of the form year-YYYY.rst
     entries = []
-    for f in os.listdir(tdir):
-        if f.endswith(".rst") and f != "years.rst":
+
+    _, rst_files = catalog_util.listing(defs, "year_review")
+    for f in rst_files:
+        if f != "years.rst":
             entries.append(f)
 
-    entries.sort(reverse=True)
+    catalog_util.save(defs)
 
-    os.chdir(cwd)
+    entries.sort(reverse=True)
 
     return entries
 
@@ -116,25 +170,122 @@ def get_year_review_entries(defs):
 def create_topic(topic, defs):
     """create a new topic directory"""
 
-    source_dir = get_source_dir(defs)
     try:
-        os.mkdir(os.path.join(source_dir, topic))
+        catalog_util.add_directory(defs, topic)
     except OSError:
         sys.exit("unable to create a new topic")
 
 
-def build(defs, show=0):
-    """build the journal.  This entails writing the TOC files that link to
-    the individual entries and then running the Sphinx make command
+def write_if_changed(filename, text):
+    """write text to filename, but only if it differs from what is
+    already there.  The write goes through a temporary file that is
+    renamed into place, so a reader never sees a partial file.  Returns
+    True if the file was written."""
+
+    try:
+        with open(filename) as f:
+            if f.read() == text:
+                return False
+    except OSError:
+        pass
+
+    # the temporary file lives next to the target so the rename stays
+    # on the same filesystem
+    tmp_name = os.path.join(os.path.dirname(os.path.abspath(filename)),
+                            f".{os.path.basename(filename)}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_name, "w") as f:
+            f.write(text)
+        os.replace(tmp_name, filename)
+    except OSError:
+        if os.path.isfile(tmp_name):
+            os.remove(tmp_name)
+        sys.exit(f"ERROR: unable to write {filename}")
+
+    return True
+
+
+def write_archive(topic, entries, tdir):
+    """write the archive pages for a topic: topic.rst links to a page
+    for each year (YYYY.rst), which links to a page for each month
+    (YYYY-MM.rst), which links to the entries.  These are plain links
+    rather than toctrees, so the entries are not part of the global
+    navigation tree that every page embeds.  Returns the number of
+    files that were written."""
+
+    updated = 0
+
+    years = []
+    for y, y_entries in itertools.groupby(entries, key=lambda e: e.year):
+        y_entries = list(y_entries)
+        years.append((y, len(y_entries)))
+
+        months = []
+        for m, m_entries in itertools.groupby(y_entries, key=lambda e: e.entry_date_num[:7]):
+            m_entries = list(m_entries)
+            months.append((m, len(m_entries)))
+
+            title = f"{topic}: {calendar.month_name[int(m[5:])]} {y}"
+            mf = io.StringIO()
+            mf.write(":orphan:\n\n")
+            mf.write(len(title)*"*" + "\n")
+            mf.write(f"{title}\n")
+            mf.write(len(title)*"*" + "\n\n")
+
+            for entry in m_entries:
+                mf.write(f"* :doc:`{entry.entry_date_num} <{entry.entry_date_num}/{entry.entry_date_num}>`\n")
+
+            updated += write_if_changed(os.path.join(tdir, f"{m}.rst"), mf.getvalue())
+
+        title = f"{topic}: {y}"
+        yf = io.StringIO()
+        yf.write(":orphan:\n\n")
+        yf.write(len(title)*"*" + "\n")
+        yf.write(f"{title}\n")
+        yf.write(len(title)*"*" + "\n\n")
+
+        for m, n in months:
+            yf.write(f"* :doc:`{calendar.month_name[int(m[5:])]} <{m}>` ({n} entr{'ies' if n > 1 else 'y'})\n")
+
+        updated += write_if_changed(os.path.join(tdir, f"{y}.rst"), yf.getvalue())
+
+    tf = io.StringIO()
+    tf.write(len(topic)*"*" + "\n")
+    tf.write(f"{topic}\n")
+    tf.write(len(topic)*"*" + "\n\n")
+
+    for y, n in years:
+        tf.write(f"* :doc:`{y} <{y}>` ({n} entr{'ies' if n > 1 else 'y'})\n")
+
+    updated += write_if_changed(os.path.join(tdir, f"{topic}.rst"), tf.getvalue())
+
+    return updated
+
+
+def write_tocs(defs, topics, other, rescan=False):
+    """create the TOC files (YYYY.rst, topic.rst, years.rst, recent.rst,
+    and index.rst) that link the entries together.  Each file is
+    rendered in memory and only written if its contents changed, so
+    Sphinx does not see unchanged TOCs as outdated.  Returns the
+    number of files that were written.
+
+    With the archive_pages setting, each topic gets paginated archive
+    pages instead (see write_archive).  The toc_maxdepth setting is the
+    depth of the topic and year toctrees.  With the stats_page setting,
+    the statistics page, stats.rst, is rewritten too (see stats_util),
+    with rescan checking every entry for changes.
 
     """
 
     source_dir = get_source_dir(defs)
 
-    topics, other = get_topics(defs)
+    archive = defs.get("archive_pages", False)
+    maxdepth = defs.get("toc_maxdepth", 2)
 
     latest_entries = get_most_recent_entries(topics, defs)
 
+    updated = 0
+
     # for each topic, we want to create a "topic.rst" that then has
     # things subdivided by year-month, and that a
     # "topic-year-month.rst" that includes the individual entries
@@ -142,124 +293,283 @@ def build(defs, show=0):
 
         entries = get_topic_entries(topic, defs)
         tdir = os.path.join(source_dir, topic)
-        os.chdir(tdir)
 
-        years = {q.year for q in entries}
-        years = list(years)
-        years.sort(reverse=True)
+        if archive:
+            updated += write_archive(topic, entries, tdir)
+            continue
+
+        # the entries are sorted newest first, so we can group them by
+        # year in a single pass
+        years = []
 
         # we need to create ReST files of the form YYYY.rst.  These
         # will each then contain the links to the entries for that
         # year
-        for y in years:
-            y_entries = [q for q in entries if q.year == y]
+        for y, y_entries in itertools.groupby(entries, key=lambda e: e.year):
+            years.append(y)
+
+            yf = io.StringIO()
+            yf.write("****\n")
+            yf.write(f"{y}\n")
+            yf.write("****\n\n")
 
-            with open(f"{y}.rst", "w") as yf:
-                yf.write("****\n")
-                yf.write(f"{y}\n")
-                yf.write("****\n\n")
+            yf.write(".. toctree::\n")
+            yf.write(f"   :maxdepth: {maxdepth}\n")
+            yf.write("   :caption: Contents:\n\n")
 
-                yf.write(".. toctree::\n")
-                yf.write("   :maxdepth: 2\n")
-                yf.write("   :caption: Contents:\n\n")
+            for entry in y_entries:
+                yf.write(f"   {entry.entry_date_num}/{entry.entry_date_num}.rst\n")
 
-                for entry in y_entries:
-                    yf.write(f"   {entry.entry_date_num}/{entry.entry_date_num}.rst\n")
+            updated += write_if_changed(os.path.join(tdir, f"{y}.rst"), yf.getvalue())
 
         # now write the topic.rst
-        with open(f"{topic}.rst", "w") as tf:
-            tf.write(len(topic)*"*" + "\n")
-            tf.write(f"{topic}\n")
-            tf.write(len(topic)*"*" + "\n")
+        tf = io.StringIO()
+        tf.write(len(topic)*"*" + "\n")
+        tf.write(f"{topic}\n")
+        tf.write(len(topic)*"*" + "\n")
 
-            tf.write(".. toctree::\n")
-            tf.write("   :maxdepth: 2\n")
-            tf.write("   :caption: Contents:\n\n")
+        tf.write(".. toctree::\n")
+        tf.write(f"   :maxdepth: {maxdepth}\n")
+        tf.write("   :caption: Contents:\n\n")
+
+        for y in years:
+            tf.write(f"   {y}.rst\n")
 
-            for y in years:
-                tf.write(f"   {y}.rst\n")
+        updated += write_if_changed(os.path.join(tdir, f"{topic}.rst"), tf.getvalue())
 
     # handle the year review now
     if "year_review" in other:
         tdir = os.path.join(source_dir, "year_review")
-        os.chdir(tdir)
         entries = get_year_review_entries(defs)
 
-        with open("years.rst", "w") as tf:
-            topic = "year review"
-            tf.write(len(topic)*"*" + "\n")
-            tf.write(f"{topic}\n")
-            tf.write(len(topic)*"*" + "\n")
-
-            tf.write(".. toctree::\n")
-            tf.write("   :maxdepth: 2\n")
-            tf.write("   :caption: Contents:\n\n")
-
-            for e in entries:
-                tf.write(f"   {e}\n")
-
-    # handle the most recent
-    os.chdir(source_dir)
-    with open("recent.rst", "w") as tf:
-        topic = "recent entries"
+        tf = io.StringIO()
+        topic = "year review"
         tf.write(len(topic)*"*" + "\n")
         tf.write(f"{topic}\n")
         tf.write(len(topic)*"*" + "\n")
 
         tf.write(".. toctree::\n")
-        tf.write("   :maxdepth: 1\n")
+        tf.write("   :maxdepth: 2\n")
         tf.write("   :caption: Contents:\n\n")
 
-        for e in latest_entries:
-            tf.write(f"   {e} <{e.topic}/{e.entry_date_num}/{e.entry_date_num}.rst>\n")
+        for e in entries:
+            tf.write(f"   {e}\n")
+
+        updated += write_if_changed(os.path.join(tdir, "years.rst"), tf.getvalue())
+
+    # handle the most recent
+    tf = io.StringIO()
+    topic = "recent entries"
+    tf.write(len(topic)*"*" + "\n")
+    tf.write(f"{topic}\n")
+    tf.write(len(topic)*"*" + "\n")
+
+    tf.write(".. toctree::\n")
+    tf.write("   :maxdepth: 1\n")
+    tf.write("   :caption: Contents:\n\n")
+
+    for e in latest_entries:
+        tf.write(f"   {e} <{e.topic}/{e.entry_date_num}/{e.entry_date_num}.rst>\n")
+
+    # the thumbnails of the images in the recent entries, each linking
+    # to its entry
+    thumbs = []
+    for e in latest_entries:
+        entry_dir = f"{e.topic}/{e.entry_date_num}"
+        for name in get_thumbnails(defs, e):
+            thumbs.append((f"{entry_dir}/{name}", f"{entry_dir}/{e.entry_date_num}.html", f"{e}"))
+    write_gallery(tf, thumbs)
+
+    updated += write_if_changed(os.path.join(source_dir, "recent.rst"), tf.getvalue())
+
+    if defs.get("stats_page", False):
+        from pyjournal2 import stats_util
+        updated += stats_util.write_page(defs, rescan=rescan)
 
     # now write the index.rst
-    os.chdir(source_dir)
-    with open("index.rst", "w") as mf:
-        mf.write("Research Journal\n")
-        mf.write("================\n\n")
+    mf = io.StringIO()
+    mf.write("Research Journal\n")
+    mf.write("================\n\n")
+
+    mf.write(".. toctree::\n")
+    mf.write("   :maxdepth: 1\n")
+    mf.write("   :caption: Summaries:\n\n")
+
+    mf.write("   recent.rst\n")
+
+    if "projects" in other:
+        mf.write("   projects/projects.rst\n")
+
+    if "todo" in other:
+        mf.write("   todo/todo.rst\n")
+
+    if "year_review" in other:
+        mf.write("   year_review/years.rst\n")
+
+    if os.path.isfile(os.path.join(source_dir, "stats.rst")):
+        mf.write("   stats.rst\n")
+
+    mf.write(".. toctree::\n")
+    mf.write("   :maxdepth: 1\n")
+    mf.write("   :caption: Topics:\n\n")
+
+    for topic in sorted(topics):
+        mf.write(f"   {topic}/{topic}\n")
+
+    mf.write("\n")
+    mf.write("Indices and tables\n")
+    mf.write("==================\n\n")
+    mf.write("* :ref:`genindex`\n")
+    mf.write("* :ref:`modindex`\n")
+    mf.write("* :ref:`search`\n")
+
+    updated += write_if_changed(os.path.join(source_dir, "index.rst"), mf.getvalue())
+
+    return updated
 
-        mf.write(".. toctree::\n")
-        mf.write("   :maxdepth: 1\n")
-        mf.write("   :caption: Summaries:\n\n")
 
-        mf.write("   recent.rst\n")
+def get_phase(profile):
+    """return the context manager factory that times a build phase in
+    profile (a profile_util.BuildProfile), or one that does nothing"""
 
-        if "projects" in other:
-            mf.write("   projects/projects.rst\n")
+    if profile is not None:
+        return profile.phase
 
-        if "todo" in other:
-            mf.write("   todo/todo.rst\n")
+    def phase(_):
+        return contextlib.nullcontext()
 
-        if "year_review" in other:
-            mf.write("   year_review/years.rst\n")
+    return phase
 
-        mf.write(".. toctree::\n")
-        mf.write("   :maxdepth: 1\n")
-        mf.write("   :caption: Topics:\n\n")
 
-        for topic in sorted(topics):
-            mf.write(f"   {topic}/{topic}\n")
+def prepare_sources(defs, jobs=None, profile=None, rescan=False):
+    """get the sources ready for Sphinx: write the TOC files, fetch the
+    large attachments that are only in the sidecar store, and execute
+    the notebooks that aren't in the notebook cache yet.  rescan looks
+    at every topic for changes, not just the ones whose directory
+    changed or that were marked as changed (see
+    catalog_util.mark_changed).  Returns the (topics, other) lists of
+    get_topics."""
 
-        mf.write("\n")
-        mf.write("Indices and tables\n")
-        mf.write("==================\n\n")
-        mf.write("* :ref:`genindex`\n")
-        mf.write("* :ref:`modindex`\n")
-        mf.write("* :ref:`search`\n")
+    phase = get_phase(profile)
+
+    with phase("scan topics"):
+        topics, other = get_topics(defs)
+
+    with phase("write TOCs"):
+        updated = write_tocs(defs, topics, other, rescan=rescan)
+    print(f"updated {updated} TOC file(s)")
+
+    # get any large attachments that are only in the sidecar store
+    with phase("fetch attachments"):
+        sidecar_util.fetch_missing(defs)
+
+    # run the notebooks that aren't in the notebook cache yet
+    with phase("execute notebooks"):
+        notebook_util.execute_missing(defs, sphinx_util.get_jobs(defs, jobs), rescan=rescan)
+
+    return topics, other
+
+
+def run_sphinx(defs, topics, other, *, jobs=None, clean=False, sharded=False,
+               runner=None, profile=None, rescan=False):
+    """run Sphinx on the prepared sources, returning the BuildResult.
+    If sharded, each topic is built as a separate Sphinx project (see
+    shard_util), with rescan rebuilding every shard.  Otherwise runner is the sphinx_util.SphinxRunner to
+    build with (by default a new one), which lets "pyjournal serve"
+    keep its environment warm between builds."""
+
+    phase = get_phase(profile)
+
+    if sharded:
+        from pyjournal2 import shard_util
+        with phase("sharded build"):
+            return shard_util.build_shards(defs, topics, other, jobs=jobs, clean=clean, rescan=rescan)
+
+    if runner is not None:
+        with phase("sphinx build"):
+            return runner.build()
+
+    hooks = [profile.connect] if profile is not None else []
+
+    with sphinx_util.SphinxRunner(defs, jobs=jobs, freshenv=clean, hooks=hooks) as new_runner:
+        with phase("sphinx setup"):
+            new_runner.create()
+        with phase("sphinx build"):
+            return new_runner.build()
+
+
+def finish_build(defs, result, *, jobs=None, sharded=False, precompress=None, profile=None):
+    """report the result of the Sphinx build and write what goes in
+    build/html besides Sphinx's output: the sharded search index (with
+    the web_search setting) and, if precompress is True (default: the
+    precompress setting), the compressed copies of the output"""
+
+    phase = get_phase(profile)
+
+    result.report()
+
+    if defs.get("web_search", False):
+        from pyjournal2 import websearch_util
+        with phase("search index"):
+            websearch_util.write_index(defs, sharded=sharded)
+
+    if precompress is None:
+        precompress = defs.get("precompress", False)
+
+    if precompress:
+        from pyjournal2 import compress_util
+        with phase("precompress"):
+            compress_util.precompress(defs, jobs=jobs)
+
+
+def build(defs, show=0, clean=False, *, jobs=None, profile=None, sharded=None, precompress=None,
+          rescan=False):
+    """build the journal.  This entails writing the TOC files that link to
+    the individual entries and then running Sphinx on the sources.
+
+    By default the build is incremental -- Sphinx keeps its doctree
+    and HTML cache in build/ and only rereads the sources that changed
+    (along with the pages whose TOCs depend on them).  Setting clean
+    wipes the cache first and forces a full rebuild.  jobs is the
+    number of parallel Sphinx workers (see sphinx_util.get_jobs).
+    profile is a profile_util.BuildProfile to record the timings in.
+    If sharded is True (default: the sharded_build setting), each topic
+    is built as a separate Sphinx project (see shard_util).  If
+    precompress is True (default: the precompress setting), gzipped
+    (and brotli) copies of the output are written for static file
+    servers (see compress_util).  rescan looks at every topic for
+    changes made outside of pyjournal (see prepare_sources).
+
+    Returns the sphinx_util.BuildResult for the build.
+
+    """
+
+    topics, other = prepare_sources(defs, jobs=jobs, profile=profile, rescan=rescan)
 
     # now do the building
     build_dir = f"{defs['working_path']}/journal-{defs['nickname']}/"
-    os.chdir(build_dir)
 
-    _, _, rc = shell_util.run("make clean")
-    _, _, rc = shell_util.run("make -j 3 html")
+    if clean:
+        try:
+            shutil.rmtree(os.path.join(build_dir, "build"))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            sys.exit("ERROR: unable to remove the old build")
 
-    if rc != 0:
-        print("build may have been unsuccessful")
+    if sharded is None:
+        sharded = defs.get("sharded_build", False)
+
+    result = run_sphinx(defs, topics, other, jobs=jobs, clean=clean, sharded=sharded, profile=profile,
+                        rescan=rescan)
+
+    finish_build(defs, result, jobs=jobs, sharded=sharded, precompress=precompress, profile=profile)
 
     index = os.path.join(build_dir, "build/html/index.html")
 
     # use webbrowser module
     if show == 1:
+        import webbrowser
         webbrowser.open_new_tab(index)
+
+    return result
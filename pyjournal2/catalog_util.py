@@ -0,0 +1,248 @@
+"""a persistent catalog of the directories in the journal source tree.
+
+Listing a topic means reading every entry directory in it, which is
+slow on network file systems.  Instead we keep the listing of each
+directory (its subdirectories and .rst files) in a JSON file under
+the journal's cache directory, together with the directory's mtime.
+Adding or removing something in a directory changes its mtime, so a
+single stat tells us if the cached listing is still good.
+
+Editing a file doesn't change the mtime of its directory, though, so
+the caches that work topic by topic (the entry catalog of columns_util,
+the notebook memo of notebook_util, and the shard fingerprints of
+shard_util) also need to hear about the
+topics whose files were edited.  mark_changed() leaves a mark for each
+of them, which they collect with take_changed().
+
+"""
+
+import json
+import os
+import sys
+import time
+
+CATALOG_VERSION = 1
+
+# on file systems with coarse (whole second) timestamps, a directory
+# that was modified within this many seconds of when we scanned it
+# might have changed again without its mtime changing, so we don't
+# trust it
+RACY_WINDOW = 2.0
+
+# the caches that keep their own copy of the marks left by mark_changed
+CHANGED_CONSUMERS = ["entries", "notebooks", "shards"]
+
+_catalogs = {}
+
+
+def get_journal_dir(defs):
+    """return the working directory of the journal"""
+    return f"{defs['working_path']}/journal-{defs['nickname']}/"
+
+
+def get_cache_dir(defs):
+    """return the directory where pyjournal2 keeps its local cache
+    files, creating it if needed.  The cache is specific to this
+    working copy and is never committed to git."""
+
+    cache_dir = os.path.join(get_journal_dir(defs), ".pyjournal2")
+
+    if not os.path.isdir(cache_dir):
+        try:
+            os.mkdir(cache_dir)
+            with open(os.path.join(cache_dir, ".gitignore"), "w") as f:
+                f.write("*\n")
+        except OSError:
+            sys.exit(f"ERROR: unable to create the cache directory {cache_dir}")
+
+    return cache_dir
+
+
+def get_catalog_file(defs):
+    """return the name of the catalog file"""
+    return os.path.join(get_cache_dir(defs), "catalog.json")
+
+
+def load(defs):
+    """return the catalog, reading it from disk the first time"""
+
+    catalog_file = get_catalog_file(defs)
+
+    if catalog_file not in _catalogs:
+        catalog = None
+        try:
+            with open(catalog_file) as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        if not isinstance(catalog, dict) or catalog.get("version") != CATALOG_VERSION:
+            catalog = {"version": CATALOG_VERSION, "dirs": {}}
+
+        _catalogs[catalog_file] = {"catalog": catalog, "dirty": False}
+
+    return _catalogs[catalog_file]["catalog"]
+
+
+def save(defs):
+    """write the catalog back to disk if it changed"""
+
+    catalog_file = get_catalog_file(defs)
+    state = _catalogs.get(catalog_file)
+    if state is None or not state["dirty"]:
+        return
+
+    tmp_name = f"{catalog_file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_name, "w") as f:
+            json.dump(state["catalog"], f, separators=(",", ":"))
+        os.replace(tmp_name, catalog_file)
+    except OSError:
+        # the catalog is only a cache, so failing to write it is not fatal
+        return
+
+    state["dirty"] = False
+
+
+def clear(defs):
+    """forget the catalog, both in memory and on disk, so the next
+    listing rescans the source tree"""
+
+    catalog_file = get_catalog_file(defs)
+    _catalogs.pop(catalog_file, None)
+
+    try:
+        os.remove(catalog_file)
+    except FileNotFoundError:
+        pass
+
+
+def mark_dirty(defs):
+    """note that the in-memory catalog needs to be saved"""
+    load(defs)
+    _catalogs[get_catalog_file(defs)]["dirty"] = True
+
+
+def is_valid(cached, mtime):
+    """is the cached listing of a directory with the given mtime (in
+    ns) still good?"""
+
+    if cached is None or cached["mtime"] != mtime:
+        return False
+
+    if mtime % 1_000_000_000 == 0 and cached["scanned"] - mtime/1.e9 < RACY_WINDOW:
+        return False
+
+    return True
+
+
+def scan(path):
+    """read a directory, returning its subdirectories and .rst files"""
+
+    dirs = []
+    rst_files = []
+
+    with os.scandir(path) as it:
+        for d in it:
+            if d.is_dir():
+                dirs.append(d.name)
+            elif d.name.endswith(".rst"):
+                rst_files.append(d.name)
+
+    dirs.sort()
+    rst_files.sort()
+
+    return dirs, rst_files
+
+
+def listing(defs, relpath=""):
+    """return the subdirectories and .rst files in the directory relpath
+    (relative to source/), from the catalog if it is still valid and by
+    rescanning the directory otherwise"""
+
+    catalog = load(defs)
+    path = os.path.join(get_journal_dir(defs), "source", relpath)
+
+    mtime = os.stat(path).st_mtime_ns
+
+    cached = catalog["dirs"].get(relpath)
+    if is_valid(cached, mtime):
+        return cached["dirs"], cached["rst"]
+
+    scanned = time.time()
+    dirs, rst_files = scan(path)
+
+    catalog["dirs"][relpath] = {"mtime": mtime, "scanned": scanned,
+                                "dirs": dirs, "rst": rst_files}
+    mark_dirty(defs)
+
+    return dirs, rst_files
+
+
+def add_directory(defs, relpath):
+    """create the directory relpath (relative to source/) and record it
+    in its parent's listing, so the parent does not need to be
+    rescanned.  Raises OSError if the directory cannot be made."""
+
+    catalog = load(defs)
+    path = os.path.join(get_journal_dir(defs), "source", relpath)
+    parent, name = os.path.split(os.path.normpath(relpath))
+
+    parent_path = os.path.dirname(os.path.normpath(path))
+    old_mtime = os.stat(parent_path).st_mtime_ns
+
+    os.mkdir(path)
+
+    cached = catalog["dirs"].get(parent)
+    if cached is None:
+        return
+
+    if is_valid(cached, old_mtime) and name not in cached["dirs"]:
+        # nothing else changed since we last looked, so we can just
+        # add the new directory
+        cached["dirs"].append(name)
+        cached["dirs"].sort()
+        cached["mtime"] = os.stat(parent_path).st_mtime_ns
+        cached["scanned"] = time.time()
+    else:
+        del catalog["dirs"][parent]
+
+    mark_dirty(defs)
+    save(defs)
+
+
+def get_changed_file(defs, consumer):
+    """return the name of the file holding the marks for consumer"""
+    return os.path.join(get_cache_dir(defs), f"{consumer}.changed")
+
+
+def mark_changed(defs, topic=None):
+    """note that files in the directory topic (default: any directory in
+    source/) may have changed without the directory changing"""
+
+    for consumer in CHANGED_CONSUMERS:
+        try:
+            with open(get_changed_file(defs, consumer), "a") as f:
+                f.write(f"{topic if topic is not None else '*'}\n")
+        except OSError:
+            pass
+
+
+def take_changed(defs, consumer):
+    """return the set of directories marked as changed for consumer ("*"
+    meaning every directory) and clear the marks"""
+
+    changed_file = get_changed_file(defs, consumer)
+    tmp = f"{changed_file}.{os.getpid()}.tmp"
+    try:
+        os.replace(changed_file, tmp)
+    except OSError:
+        return set()
+
+    try:
+        with open(tmp) as f:
+            return {line.strip() for line in f if line.strip()}
+    except OSError:
+        return {"*"}
+    finally:
+        os.remove(tmp)
@@ -0,0 +1,346 @@
+"""a columnar catalog of the dated entries.
+
+get_topic_entries() gives a list of Entry objects for one topic, with
+the dates as strings, so a question about a date range means listing
+every topic and checking every entry.  The entry catalog instead keeps
+one row per entry, in compact arrays (one per column), sorted by date:
+
+  * date: the date as a proleptic Gregorian ordinal
+  * topic: the index of the topic in the sorted list of topic names
+  * size: the size of the entry's .rst file, in bytes
+  * words: the number of words in the entry's .rst file, not counting
+    the lines entry_util writes (the header and the figure templates)
+  * attachments: the number of attachments in the entry's directory,
+    not counting the web renditions and thumbnails of the images
+  * attachment_bytes: the total size of those attachments
+
+so the entries in a date range are found by binary search on the date
+column, without looking at any other entry.
+
+The columns are stored in the journal's cache directory as a short
+JSON header followed by the raw arrays.  The header also keeps the
+mtime of each topic directory, which changes when an entry is added or
+removed, so keeping the catalog up to date only costs a stat of each
+topic directory: the entries of a topic are only looked at if its
+directory changed, and then an entry is only rescanned if the mtime of
+its directory or .rst file changed.  Editing an existing entry doesn't
+change the topic directory, so "pyjournal entry" (and pull and sync)
+mark the topics they change (see catalog_util.mark_changed), and with
+rescan update() checks every entry, to catch edits made outside of
+pyjournal.
+The entries themselves come from the same topic listing as the build
+(build_util.get_topics and get_topic_entries).
+
+"""
+
+import array
+import bisect
+import datetime
+import json
+import os
+import re
+import sys
+import time
+
+from pyjournal2 import build_util
+from pyjournal2 import catalog_util
+from pyjournal2 import entry_util
+from pyjournal2 import image_util
+from pyjournal2 import sidecar_util
+
+COLUMNS_VERSION = 5
+
+# the columns and their array typecodes.  dir_mtime and rst_mtime are
+# only there to tell when an entry needs rescanning.
+COLUMNS = {"date": "i",
+           "topic": "H",
+           "size": "Q",
+           "words": "I",
+           "attachments": "I",
+           "attachment_bytes": "Q",
+           "dir_mtime": "q",
+           "rst_mtime": "q"}
+
+
+def get_boilerplate_re():
+    """return a regex matching the (stripped) lines that entry_util
+    writes into an entry: the title and its over/underline, the lines
+    of SYMBOLS and FIGURE_STR, where the @...@ parts can be anything,
+    and the links to the files that aren't figures"""
+
+    patterns = [r"\*+", r"\d{4}(-\d{2}-\d{2})?",
+                r":download:`[^`]* <[^`]*>`",
+                r"`[^`]* <[^`]*>`__ \(not copied into the journal\)"]
+    for template in (entry_util.SYMBOLS, entry_util.FIGURE_STR):
+        for line in template.split("\n"):
+            if line.strip():
+                patterns.append(re.sub("@[a-z]+@", ".*", re.escape(line.strip())))
+
+    return re.compile("|".join(patterns))
+
+
+BOILERPLATE_RE = get_boilerplate_re()
+
+# the link to the original image that entry_util adds to the caption
+ORIGINAL_RE = re.compile(r"\(:download:`original <[^>]*>`\)")
+
+
+class EntryColumns:
+    """the entry catalog: the list of topic names and an array for each
+    column, all sorted by date (and then topic).  topic_mtimes holds the
+    mtime of each topic directory (and when it was scanned), for
+    catalog_util.is_valid."""
+
+    def __init__(self, topics=None, columns=None, topic_mtimes=None):
+        self.topics = topics if topics is not None else []
+        self.topic_mtimes = topic_mtimes if topic_mtimes is not None else {}
+        if columns is None:
+            columns = {name: array.array(code) for name, code in COLUMNS.items()}
+        self.columns = columns
+
+        self.date = columns["date"]
+        self.topic = columns["topic"]
+        self.size = columns["size"]
+        self.words = columns["words"]
+        self.attachments = columns["attachments"]
+        self.attachment_bytes = columns["attachment_bytes"]
+        self.dir_mtime = columns["dir_mtime"]
+        self.rst_mtime = columns["rst_mtime"]
+
+    def __len__(self):
+        return len(self.date)
+
+    def get_range(self, since=None, until=None):
+        """return the (start, end) slice of the rows from date since to
+        until (YYYY-MM-DD strings, inclusive)"""
+
+        start = 0
+        end = len(self)
+
+        if since is not None:
+            start = bisect.bisect_left(self.date, datetime.date.fromisoformat(since).toordinal())
+        if until is not None:
+            end = bisect.bisect_right(self.date, datetime.date.fromisoformat(until).toordinal())
+
+        return start, max(start, end)
+
+    def select(self, topics=None, since=None, until=None):
+        """return the indices of the rows in the date range that belong
+        to one of topics (default: any topic)"""
+
+        start, end = self.get_range(since, until)
+
+        if not topics:
+            return range(start, end)
+
+        ids = {self.topics.index(t) for t in topics if t in self.topics}
+        topic = self.topic
+        return [i for i in range(start, end) if topic[i] in ids]
+
+    def get_date(self, i):
+        """return the date of row i as YYYY-MM-DD"""
+        return datetime.date.fromordinal(self.date[i]).isoformat()
+
+    def get_topic(self, i):
+        """return the topic name of row i"""
+        return self.topics[self.topic[i]]
+
+
+def get_columns_file(defs):
+    """return the name of the file holding the entry catalog"""
+    return os.path.join(catalog_util.get_cache_dir(defs), "entries.columns")
+
+
+def read(defs):
+    """read the entry catalog from disk, returning an empty one if it is
+    missing or can't be used"""
+
+    try:
+        with open(get_columns_file(defs), "rb") as f:
+            header = json.loads(f.readline())
+            if header.get("version") != COLUMNS_VERSION or header.get("byteorder") != sys.byteorder:
+                return EntryColumns()
+
+            columns = {}
+            for name, code in COLUMNS.items():
+                a = array.array(code)
+                if a.itemsize != header["itemsizes"][name]:
+                    return EntryColumns()
+                a.fromfile(f, header["rows"])
+                columns[name] = a
+    except (OSError, ValueError, KeyError, EOFError):
+        return EntryColumns()
+
+    return EntryColumns(header["topics"], columns, header["topic_mtimes"])
+
+
+def write(defs, catalog):
+    """write the entry catalog to disk"""
+
+    columns_file = get_columns_file(defs)
+
+    header = {"version": COLUMNS_VERSION,
+              "byteorder": sys.byteorder,
+              "rows": len(catalog),
+              "topics": catalog.topics,
+              "topic_mtimes": catalog.topic_mtimes,
+              "itemsizes": {name: catalog.columns[name].itemsize for name in COLUMNS}}
+
+    tmp = f"{columns_file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            for name in COLUMNS:
+                catalog.columns[name].tofile(f)
+        os.replace(tmp, columns_file)
+    except OSError:
+        # the catalog is only a cache, so failing to write it is not fatal
+        pass
+
+
+def count_words(path):
+    """return the number of (whitespace separated) words in the entry
+    file path, skipping the lines entry_util wrote"""
+
+    nwords = 0
+    try:
+        with open(path, errors="replace") as f:
+            for line in f:
+                if BOILERPLATE_RE.fullmatch(line.strip()):
+                    continue
+                nwords += len(ORIGINAL_RE.sub("", line).split())
+    except OSError:
+        pass
+
+    return nwords
+
+
+def scan_entry(path):
+    """return the number and total size of the attachments in the entry
+    directory path, leaving out the renditions of the images"""
+
+    count = 0
+    nbytes = 0
+    for root, _, names in os.walk(path):
+        for n in names:
+            if n.endswith((".rst", sidecar_util.POINTER_EXT)) or n.startswith(".") or \
+               image_util.is_rendition(n):
+                continue
+            try:
+                nbytes += os.path.getsize(os.path.join(root, n))
+            except OSError:
+                continue
+            count += 1
+
+    return count, nbytes
+
+
+def update(defs, rescan=False):
+    """return the entry catalog, brought up to date with the source tree.
+    Only the topics whose directory changed (or that were marked as
+    changed) are looked at, unless rescan is True."""
+
+    old = read(defs)
+
+    marked = catalog_util.take_changed(defs, "entries")
+    if "*" in marked:
+        rescan = True
+
+    # where each date of each topic was in the old catalog
+    old_rows = {}
+    for i in range(len(old)):
+        old_rows.setdefault(old.topic[i], {})[old.date[i]] = i
+
+    source_dir = build_util.get_source_dir(defs)
+    topics, _ = build_util.get_topics(defs)
+    topics.sort()
+
+    rows = []
+    topic_mtimes = {}
+    changed = topics != old.topics
+
+    for tid, topic in enumerate(topics):
+        old_tid = old.topics.index(topic) if topic in old.topics else None
+        topic_rows = old_rows.get(old_tid, {})
+
+        topic_dir = os.path.join(source_dir, topic)
+        try:
+            mtime = os.stat(topic_dir).st_mtime_ns
+        except OSError:
+            continue
+
+        # no entry was added to or removed from the topic
+        cached = old.topic_mtimes.get(topic)
+        if old_tid is not None and not rescan and topic not in marked and \
+           catalog_util.is_valid(cached, mtime):
+            topic_mtimes[topic] = cached
+            for i in topic_rows.values():
+                rows.append((old.date[i], tid, old.size[i], old.words[i], old.attachments[i],
+                             old.attachment_bytes[i], old.dir_mtime[i], old.rst_mtime[i]))
+            continue
+
+        topic_mtimes[topic] = {"mtime": mtime, "scanned": time.time()}
+        changed = True
+
+        for e in build_util.get_topic_entries(topic, defs):
+            path = os.path.join(topic_dir, e.entry_date_num)
+            try:
+                dir_mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+
+            try:
+                st = os.stat(os.path.join(path, f"{e.entry_date_num}.rst"))
+                size, rst_mtime = st.st_size, st.st_mtime_ns
+            except OSError:
+                size, rst_mtime = 0, 0
+
+            i = topic_rows.get(e.ordinal)
+            if i is not None and old.dir_mtime[i] == dir_mtime and old.rst_mtime[i] == rst_mtime:
+                nwords = old.words[i]
+                nattach, attach_bytes = old.attachments[i], old.attachment_bytes[i]
+            else:
+                nwords = count_words(os.path.join(path, f"{e.entry_date_num}.rst"))
+                nattach, attach_bytes = scan_entry(path)
+
+            rows.append((e.ordinal, tid, size, nwords, nattach, attach_bytes, dir_mtime, rst_mtime))
+
+    if not changed:
+        return old
+
+    rows.sort(key=lambda r: (r[0], r[1]))
+
+    columns = {name: array.array(code) for name, code in COLUMNS.items()}
+    for name, column in zip(COLUMNS, zip(*rows)):
+        columns[name] = array.array(COLUMNS[name], column)
+
+    catalog = EntryColumns(topics, columns, topic_mtimes)
+
+    write(defs, catalog)
+
+    return catalog
+
+
+def list_entries(defs, *, topics=None, since=None, until=None, N=None, rescan=False):
+    """print the entries in topics (default: all) from since to until,
+    most recent first.  rescan checks every entry for changes (see
+    update)."""
+
+    catalog = update(defs, rescan=rescan)
+
+    if topics:
+        for t in topics:
+            if t not in catalog.topics:
+                sys.exit(f"ERROR: {t} is not a valid topic")
+
+    rows = catalog.select(topics, since, until)
+
+    shown = 0
+    for i in reversed(rows):
+        if N is not None and shown >= N:
+            break
+        print(f"{catalog.get_date(i)}  {catalog.get_topic(i):20s} {catalog.words[i]:6d} words  "
+              f"{catalog.attachments[i]:3d} attachment(s) {catalog.attachment_bytes[i] / 1024**2:9.2f} MB")
+        shown += 1
+
+    print(f"{len(rows)} entries")
@@ -0,0 +1,198 @@
+"""precompressed copies of the built HTML for static file servers.
+
+With precompress = true in .pyjournal2rc (or "pyjournal build
+--precompress"), every compressible file in build/html -- the pages,
+searchindex.js, and the CSS and JavaScript -- gets a gzipped sibling,
+name.gz, and, if the brotli module is installed, a name.br, once the
+build is done.  A static file server set up to look for them (e.g.
+nginx's gzip_static and brotli_static) can then send them as they
+are, rather than compressing each file on every request or not at
+all.
+
+The compression is done in parallel threads, and it is incremental:
+the SHA-256 hash of each file we compressed is kept in the journal's
+cache directory, and a file is only compressed again when its content
+changes.  Sphinx often rewrites a file without changing it, so the
+size and mtime only tell us when a file needs hashing.  The gzip files don't
+record a time, so compressing the same content always gives the same
+bytes.
+
+"""
+
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import os
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from pyjournal2 import build_util
+from pyjournal2 import catalog_util
+from pyjournal2 import sphinx_util
+
+# the kinds of files worth compressing -- images, fonts like woff, and
+# archives are already compressed
+COMPRESSIBLE_EXTENSIONS = {".html", ".htm", ".js", ".mjs", ".css", ".json", ".map",
+                           ".svg", ".xml", ".txt", ".ttf", ".otf", ".eot", ".ipynb"}
+
+# files smaller than this (in bytes) gain too little to be worth it
+COMPRESS_MIN_SIZE = 1024
+
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+
+def get_encodings():
+    """return the file extensions of the compressed siblings we write"""
+    return [".gz", ".br"] if brotli is not None else [".gz"]
+
+
+def find_compressible(html_dir):
+    """return the paths, relative to html_dir, of the files to compress,
+    with their (size, mtime) stats"""
+
+    files = {}
+    for root, _, names in os.walk(html_dir):
+        for name in names:
+            if os.path.splitext(name)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+                continue
+
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+
+            if st.st_size >= COMPRESS_MIN_SIZE:
+                files[os.path.relpath(path, html_dir)] = (st.st_size, st.st_mtime_ns)
+
+    return files
+
+
+def write_sibling(path, ext, data):
+    """write the compressed data next to path, with path's mtime"""
+
+    dest = path + ext
+    tmp = f"{dest}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+
+    st = os.stat(path)
+    os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmp, dest)
+
+
+def compress_file(path, digest=None):
+    """write the compressed siblings of path.  Returns the SHA-256 hash of
+    path and the (original, gzip) sizes.  If digest is given and path
+    still has that hash, nothing is written and the sizes are None."""
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    new_digest = hashlib.sha256(data).hexdigest()
+    if new_digest == digest:
+        return new_digest, None
+
+    compressed = gzip.compress(data, GZIP_LEVEL, mtime=0)
+    write_sibling(path, ".gz", compressed)
+
+    if brotli is not None:
+        write_sibling(path, ".br", brotli.compress(data, quality=BROTLI_QUALITY))
+    elif os.path.isfile(path + ".br"):
+        # left over from when brotli was installed
+        os.remove(path + ".br")
+
+    return new_digest, (len(data), len(compressed))
+
+
+def remove_stale(html_dir, old_files, files):
+    """remove the compressed siblings we wrote for files that are gone.
+    Returns the number removed."""
+
+    nremoved = 0
+    for rel in old_files.keys() - files.keys():
+        for ext in (".gz", ".br"):
+            try:
+                os.remove(os.path.join(html_dir, rel) + ext)
+            except OSError:
+                continue
+            nremoved += 1
+
+    return nremoved
+
+
+def precompress(defs, jobs=None):
+    """write the compressed siblings of the compressible files in
+    build/html whose content changed since the last time"""
+
+    _, html_dir, _ = sphinx_util.get_build_dirs(defs)
+    if not os.path.isdir(html_dir):
+        return
+
+    manifest_file = os.path.join(catalog_util.get_cache_dir(defs), "compress.json")
+    try:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    # a manifest written without brotli doesn't cover the .br files
+    if manifest.get("encodings") != get_encodings():
+        manifest = {}
+    old_files = manifest.get("files", {})
+
+    files = find_compressible(html_dir)
+
+    new_files = {}
+    todo = {}
+    for rel, (size, mtime) in files.items():
+        old = old_files.get(rel)
+        path = os.path.join(html_dir, rel)
+        have_siblings = all(os.path.isfile(path + ext) for ext in get_encodings())
+
+        if old is not None and have_siblings and old["size"] == size and old["mtime"] == mtime:
+            new_files[rel] = old
+        else:
+            # only skip the compression if the content is the same
+            todo[rel] = old["sha256"] if old is not None and have_siblings else None
+
+    ncompressed = 0
+    nbytes = 0
+    ngzip = 0
+    if todo:
+        nthreads = min(len(todo), sphinx_util.get_jobs(defs, jobs))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as pool:
+            futures = {pool.submit(compress_file, os.path.join(html_dir, rel), digest): rel
+                       for rel, digest in todo.items()}
+            for future in concurrent.futures.as_completed(futures):
+                rel = futures[future]
+                try:
+                    digest, sizes = future.result()
+                except OSError as err:
+                    print(f"WARNING: unable to compress {rel}: {err}", file=sys.stderr)
+                    continue
+
+                size, mtime = files[rel]
+                new_files[rel] = {"size": size, "mtime": mtime, "sha256": digest}
+                if sizes is not None:
+                    ncompressed += 1
+                    nbytes += sizes[0]
+                    ngzip += sizes[1]
+
+    nremoved = remove_stale(html_dir, old_files, new_files)
+
+    build_util.write_if_changed(manifest_file, json.dumps({"encodings": get_encodings(),
+                                                           "files": new_files}, indent=1))
+
+    msg = f"compressed {ncompressed} of {len(files)} file(s)"
+    if ncompressed:
+        msg += f" ({nbytes / 1024**2:.1f} MB to {ngzip / 1024**2:.1f} MB gzipped)"
+    if nremoved:
+        msg += f", removed {nremoved} stale compressed file(s)"
+    print(msg)
@@ -2,10 +2,16 @@
 
 import datetime
 import os
-import shutil
+import pathlib
+import shlex
 import sys
 
+from pyjournal2 import attach_util
+from pyjournal2 import catalog_util
+from pyjournal2 import image_util
+from pyjournal2 import queue_util
 from pyjournal2 import shell_util
+from pyjournal2 import sidecar_util
 
 FIGURE_STR = r"""
 .. _@figlabel@:
@@ -13,7 +19,7 @@ FIGURE_STR = r"""
    :width: 90%
    :align: center
 
-   The caption goes here
+   The caption goes here@download@
 
 .. reference this as :numref:`@figlabel@`
 """
@@ -61,8 +67,15 @@ def get_unique_string():
     return str(now.replace(microsecond=0)).replace(" ", "_").replace(":", ".")
 
 
-def entry(topic, images, link_files, defs, string=None, use_date=None):
-    """create an entry"""
+def entry(topic, images, link_files, defs, string=None, use_date=None, *, commit=None,
+          defer=None):
+    """create an entry.  The entry file and any images or linked files
+    are committed to git together in a single commit.  If commit is
+    False, they are only staged (so a later commit can batch several
+    sessions) -- by default this follows the auto_commit setting in
+    .pyjournal2rc.  If defer is True (default: the defer_git setting),
+    the git work is queued for a background worker instead (see
+    queue_util)."""
 
     current_year = int(datetime.datetime.now().year)
 
@@ -96,7 +109,8 @@ def entry(topic, images, link_files, defs, string=None, use_date=None):
 
     if not os.path.isdir(odir):
         try:
-            os.mkdir(odir)
+            source_dir = f"{defs['working_path']}/journal-{defs['nickname']}/source/"
+            catalog_util.add_directory(defs, os.path.relpath(odir, source_dir))
         except OSError:
             sys.exit(f"ERROR: unable to make directory {odir}")
 
@@ -129,6 +143,15 @@ def entry(topic, images, link_files, defs, string=None, use_date=None):
             unique_id = get_unique_string()
 
             files_copied = []
+            attachments = []
+
+            # the files to copy into the entry directory (name -> source),
+            # and the large linked files we only reference (name -> URI)
+            pending = {}
+            referenced = {}
+
+            link_max_size = defs.get("link_max_size")
+
             for im in images + link_files:
 
                 if im is None:
@@ -140,19 +163,30 @@ def entry(topic, images, link_files, defs, string=None, use_date=None):
                 dest = odir
 
                 im_copy = os.path.basename(im)
-                if os.path.isfile(f"{dest}/{im_copy}"):
-                    im_copy = f"{unique_id.replace('.', '_')}_{im_copy}"
 
-                dest = os.path.join(dest, im_copy)
+                # linked files above the size limit stay where they are
+                if (im in link_files and im not in images and link_max_size is not None and
+                        os.path.isfile(src) and os.path.getsize(src) > link_max_size * 1024**2):
+                    referenced[im_copy] = pathlib.Path(os.path.abspath(src)).as_uri()
+                    attachments.append((im_copy, None))
+                    continue
+
+                existing = pending.get(im_copy, f"{dest}/{im_copy}")
+                exists = False
+                if os.path.isfile(existing) and os.path.isfile(src):
+                    # if it is the same file, we just reference it again
+                    if attach_util.same_content(src, existing):
+                        exists = True
+                    else:
+                        im_copy = f"{unique_id.replace('.', '_')}_{im_copy}"
 
-                # copy it
+                # copy it (below, through the attachment store)
                 if im != "":
-                    try:
-                        shutil.copy(src, dest)
-                    except OSError:
-                        sys.exit(f"ERROR: unable to copy image {src} to {dest}")
+                    if not exists:
+                        pending[im_copy] = src
 
-                    files_copied.append(im_copy)
+                    if im_copy not in files_copied:
+                        files_copied.append(im_copy)
 
                     if im in images:
                         # create a unique label for latex referencing
@@ -166,14 +200,64 @@ def entry(topic, images, link_files, defs, string=None, use_date=None):
                         else:
                             sys.exit("unsupported image type -- try creating a link instead")
 
-                        # add the figure text
-                        for l in FIGURE_STR.split("\n"):
-                            new_name = l.replace("@figname@", im_copy).replace("@figlabel@", im0).rstrip()
-                            f.write(f"{new_name}\n")
+                        attachments.append((im_copy, im0))
 
                     else:
-                        # add the download directive
-                        f.write(f":download:`{im_copy} <{im_copy}>`\n\n")
+                        attachments.append((im_copy, None))
+
+            # copy the attachments, several at once
+            digests = attach_util.place_all(defs, [(src, os.path.join(odir, name))
+                                                   for name, src in pending.items()])
+
+            # large attachments go to the sidecar store -- git only gets
+            # a pointer to them
+            for name in pending:
+                dest = os.path.join(odir, name)
+                if sidecar_util.use_sidecar(defs, dest):
+                    staged, uploaded = sidecar_util.offload(defs, odir, name, digests[dest])
+                    files_copied.remove(name)
+                    files_copied += [q for q in staged if q not in files_copied]
+                    if not uploaded:
+                        warning(f"unable to copy {name} to the sidecar store -- "
+                                "pyjournal push will try again")
+
+            # make the web-sized renditions and thumbnails of the images
+            image_names = [name for name, label in attachments if label is not None]
+            if not image_util.HAVE_PIL and any(os.path.splitext(q)[1].lower() in image_util.RENDITION_EXTENSIONS
+                                               for q in image_names):
+                warning("Pillow is not installed -- figures will use the original images")
+
+            renditions = image_util.ingest(odir, image_names, defs)
+            for web, thumb in renditions.values():
+                for q in (web, thumb):
+                    if q not in files_copied:
+                        attach_util.adopt(defs, os.path.join(odir, q))
+                        files_copied.append(q)
+
+            for im_copy, im0 in attachments:
+
+                if im0 is not None:
+                    # the figure shows the web rendition, with a link
+                    # to the original
+                    figname = im_copy
+                    download = ""
+                    if im_copy in renditions and renditions[im_copy][0] != im_copy:
+                        figname = renditions[im_copy][0]
+                        download = f" (:download:`original <{im_copy}>`)"
+
+                    # add the figure text
+                    for l in FIGURE_STR.split("\n"):
+                        new_name = l.replace("@figname@", figname).replace("@figlabel@", im0)
+                        new_name = new_name.replace("@download@", download).rstrip()
+                        f.write(f"{new_name}\n")
+
+                elif im_copy in referenced:
+                    # link to the file where it is
+                    f.write(f"`{im_copy} <{referenced[im_copy]}>`__ (not copied into the journal)\n\n")
+
+                else:
+                    # add the download directive
+                    f.write(f":download:`{im_copy} <{im_copy}>`\n\n")
 
     except OSError:
         sys.exit(f"ERROR: unable to open {os.path.join(odir, ofile)}")
@@ -187,13 +271,46 @@ def entry(topic, images, link_files, defs, string=None, use_date=None):
 
         shell_util.run(prog)
 
-    # commit the entry to the working git repo
+    # editing an entry doesn't change its topic directory, so tell the
+    # caches to look at the topic again
+    catalog_util.mark_changed(defs, "year_review" if topic == "year" else topic)
+
+    # stage the entry and any images / linked files together and
+    # commit them as a single change to the working git repo
     os.chdir(odir)
 
-    shell_util.run("git add " + ofile)
-    shell_util.run("git commit -m 'new entry' " + ofile)
+    if commit is None:
+        commit = defs.get("auto_commit", True)
+
+    msg = None
+    if commit:
+        if topic in ["todo", "projects"]:
+            msg = f"{topic}: update"
+        elif topic == "year":
+            msg = f"year_review: {current_year} goals"
+        else:
+            msg = f"{topic}: entry for {entry_dir}"
+
+        # count what was attached, not the renditions we made
+        if attachments:
+            msg += f" ({len(attachments)} attachment{'s' if len(attachments) > 1 else ''})"
+
+    if defer is None:
+        defer = defs.get("defer_git", False)
+
+    if defer and not queue_util.can_defer():
+        warning("the git work can't be deferred on this platform -- doing it now")
+        defer = False
+
+    if defer:
+        # leave the git work to a background worker
+        queue_util.enqueue(defs, odir, [ofile] + files_copied, msg)
+        queue_util.start_worker(defs)
+        return
+
+    session_files = " ".join(shlex.quote(q) for q in [ofile] + files_copied)
+
+    shell_util.run("git add -- " + session_files)
 
-    # commit any images too
-    for im in files_copied:
-        shell_util.run("git add " + im)
-        shell_util.run("git commit -m 'new image' " + im)
+    if msg is not None:
+        shell_util.run(f"git commit -m {shlex.quote(msg)} -- " + session_files)
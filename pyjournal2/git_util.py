@@ -3,10 +3,16 @@
 import os
 import re
 import sys
+import shlex
 import shutil
+import time
 
+from pyjournal2 import build_util
+from pyjournal2 import catalog_util
 from pyjournal2 import entry_util
+from pyjournal2 import queue_util
 from pyjournal2 import shell_util
+from pyjournal2 import sidecar_util
 
 #=============================================================================
 # journal-specific routines
@@ -148,6 +154,11 @@ def pull(defs):
 
     print(stdout)
 
+    # the pull may have changed any entry
+    catalog_util.mark_changed(defs)
+
+    sidecar_util.fetch_missing(defs)
+
 
 def push(defs):
     """push the journal to the origin"""
@@ -160,9 +171,137 @@ def push(defs):
     except OSError:
         sys.exit(f"ERROR: unable to switch to working directory: {wd}")
 
+    # the large attachments need to be in the sidecar store before
+    # anyone pulls the pointers to them
+    sidecar_util.push_missing(defs)
+
     _, stderr, rc = shell_util.run("git push")
     if rc != 0:
         print(stderr)
         sys.exit("ERROR: something went wrong with the git push")
 
     print(stderr)
+
+
+def sync(defs):
+    """bring the journal and its origin up to date with a single fetch:
+    commit the entries that were only staged (with --no-commit or
+    auto_commit = false) as one batch, fast-forward or rebase onto the
+    remote only if it has new commits,
+    push only if we have local commits, and rebuild (incrementally)
+    only if the incoming commits changed the sources.  The time taken
+    by each phase is reported."""
+
+    wd = f"{defs['working_path']}/journal-{defs['nickname']}"
+
+    try:
+        os.chdir(wd)
+    except OSError:
+        sys.exit(f"ERROR: unable to switch to working directory: {wd}")
+
+    timings = []
+
+    # first commit anything left in the deferred queue
+    start = time.perf_counter()
+    queue_util.drain(defs, do_push=False, wait=True)
+    if queue_util.get_jobs(defs):
+        sys.exit("ERROR: the queued git work failed -- see pyjournal queue status")
+
+    # then the entries that were staged but not committed, in a single
+    # commit, so they go out with this push
+    _, _, rc = shell_util.run("git diff --cached --quiet -- source")
+    note = ""
+    if rc != 0:
+        stdout, _, _ = shell_util.run("git diff --cached --name-only -- source")
+        # an entry is topic/YYYY-MM-DD/YYYY-MM-DD.rst
+        nentries = len({os.path.dirname(q) for q in stdout.split("\n")
+                        if q.endswith(".rst") and os.path.basename(q)[:-4] == os.path.basename(os.path.dirname(q))})
+        entries = f"{nentries} staged entr{'y' if nentries == 1 else 'ies'}"
+        _, stderr, rc = shell_util.run(f"git commit --quiet -m {shlex.quote(f'journal: {entries}')}")
+        if rc != 0:
+            print(stderr)
+            sys.exit("ERROR: unable to commit the staged entries")
+        note = f"committed {entries}"
+    timings.append(("queue", time.perf_counter() - start, note))
+
+    start = time.perf_counter()
+    _, stderr, rc = shell_util.run("git fetch --quiet")
+    if rc != 0:
+        print(stderr)
+        sys.exit("ERROR: something went wrong with the git fetch")
+    timings.append(("fetch", time.perf_counter() - start, ""))
+
+    stdout, stderr, rc = shell_util.run("git rev-list --left-right --count HEAD...@{u}")
+    if rc != 0:
+        print(stderr)
+        sys.exit("ERROR: unable to compare with the remote -- does the branch track one?")
+    ahead, behind = (int(q) for q in stdout.split())
+
+    start = time.perf_counter()
+    old_head, _, _ = shell_util.run("git rev-parse HEAD")
+
+    if behind == 0:
+        note = "up to date"
+
+    elif ahead == 0:
+        note = f"fast-forwarded {behind} commit(s)"
+        stdout, stderr, rc = shell_util.run("git merge --ff-only --quiet @{u}")
+        if rc != 0:
+            print(stdout, stderr)
+            sys.exit("ERROR: something went wrong with the fast-forward")
+
+    else:
+        note = f"rebased {ahead} local commit(s) onto {behind} remote commit(s)"
+
+        # set aside any uncommitted changes (keeping what is staged)
+        status, _, _ = shell_util.run("git status --porcelain --untracked-files=no")
+        stashed = status.strip() != ""
+        if stashed:
+            shell_util.run("git stash push --quiet")
+
+        stdout, stderr, rc = shell_util.run("git rebase --quiet @{u}")
+        if rc != 0:
+            shell_util.run("git rebase --abort")
+        if rc != 0:
+            print(stdout, stderr)
+        if stashed:
+            _, pop_stderr, pop_rc = shell_util.run("git stash pop --quiet --index")
+            if pop_rc != 0:
+                print(pop_stderr)
+                sys.exit("ERROR: unable to restore your uncommitted changes -- they are still in git stash list")
+        if rc != 0:
+            sys.exit("ERROR: the rebase onto the remote had conflicts -- resolve them with git pull")
+
+    timings.append(("update", time.perf_counter() - start, note))
+
+    start = time.perf_counter()
+    if ahead > 0:
+        # the large attachments need to be in the sidecar store before
+        # anyone pulls the pointers to them
+        sidecar_util.push_missing(defs)
+
+        _, stderr, rc = shell_util.run("git push --quiet")
+        if rc != 0:
+            print(stderr)
+            sys.exit("ERROR: something went wrong with the git push")
+        note = f"pushed {ahead} commit(s)"
+    else:
+        note = "nothing to push"
+    timings.append(("push", time.perf_counter() - start, note))
+
+    start = time.perf_counter()
+    changed = False
+    if behind > 0:
+        _, _, rc = shell_util.run(f"git diff --quiet {old_head.strip()} HEAD -- source")
+        changed = rc != 0
+
+    if changed:
+        catalog_util.mark_changed(defs)
+        build_util.build(defs)
+        note = "rebuilt"
+    else:
+        note = "sources unchanged"
+    timings.append(("build", time.perf_counter() - start, note))
+
+    for phase, elapsed, note in timings:
+        print(f"{phase:8s} {elapsed:7.2f} s  {note}")
@@ -0,0 +1,126 @@
+"""prepare images for the web when they are added to an entry.
+
+For each image we keep the original (offered as a download) and make
+a size-capped web rendition that the figure actually displays, plus a
+small thumbnail.  The renditions are made in parallel worker processes.
+This needs Pillow -- without it, figures just use the original image.
+
+"""
+
+import concurrent.futures
+import os
+
+try:
+    from PIL import Image, ImageOps
+    HAVE_PIL = True
+except ImportError:
+    HAVE_PIL = False
+
+# the largest dimension (in pixels) of the web rendition and the thumbnail
+WEB_MAX_SIZE = 1600
+THUMB_MAX_SIZE = 320
+
+# images smaller than this (in both size and bytes) are displayed as is
+WEB_MAX_BYTES = 1024 * 1024
+
+# formats that Pillow can make renditions of
+RENDITION_EXTENSIONS = [".jpg", ".jpeg", ".png", ".gif"]
+
+
+def rendition_name(name, kind):
+    """return the file name for a rendition of kind ("web" or "thumb")"""
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{kind}{ext}"
+
+
+def is_rendition(name):
+    """is name the file name of a rendition (see rendition_name)?"""
+    stem, ext = os.path.splitext(name)
+    return ext.lower() in RENDITION_EXTENSIONS and os.path.splitext(stem)[1] in (".web", ".thumb")
+
+
+def save_image(im, filename):
+    """save an image, choosing options that keep the file small.  An
+    existing file is replaced rather than written over, since it may be
+    a (read-only) hardlink into the attachment store."""
+
+    stem, ext = os.path.splitext(filename)
+    ext = ext.lower()
+    tmp = f"{stem}.{os.getpid()}.tmp{ext}"
+
+    if ext in [".jpg", ".jpeg"]:
+        if im.mode not in ["RGB", "L"]:
+            im = im.convert("RGB")
+        im.save(tmp, quality=85, optimize=True, progressive=True)
+    elif ext == ".png":
+        im.save(tmp, optimize=True)
+    else:
+        im.save(tmp)
+
+    os.replace(tmp, filename)
+
+
+def make_renditions(path, web_max_size, thumb_max_size):
+    """make the web rendition and thumbnail of the image at path.
+    Returns (web, thumb) -- the file names of the renditions, with web
+    set to the original name if the image is already small enough to
+    display as is -- or None if this image can't be processed."""
+
+    name = os.path.basename(path)
+    odir = os.path.dirname(path)
+
+    try:
+        with Image.open(path) as im:
+            if getattr(im, "is_animated", False):
+                # we'd lose the animation
+                return None
+
+            # apply any camera rotation, so the renditions display upright
+            im = ImageOps.exif_transpose(im)
+
+            if max(im.size) > web_max_size or os.path.getsize(path) > WEB_MAX_BYTES:
+                web = rendition_name(name, "web")
+                web_im = im.copy()
+                web_im.thumbnail((web_max_size, web_max_size), Image.Resampling.LANCZOS)
+                save_image(web_im, os.path.join(odir, web))
+            else:
+                web = name
+
+            thumb = rendition_name(name, "thumb")
+            thumb_im = im.copy()
+            thumb_im.thumbnail((thumb_max_size, thumb_max_size), Image.Resampling.LANCZOS)
+            save_image(thumb_im, os.path.join(odir, thumb))
+
+    except OSError:
+        return None
+
+    return web, thumb
+
+
+def ingest(odir, names, defs):
+    """make the web renditions and thumbnails for the images names in
+    the entry directory odir.  Returns a dict mapping each image name to
+    its (web, thumb) rendition names (only for the images we could
+    process)."""
+
+    names = [n for n in names if os.path.splitext(n)[1].lower() in RENDITION_EXTENSIONS]
+    if not names:
+        return {}
+
+    if not HAVE_PIL:
+        return {}
+
+    web_max_size = defs.get("image_max_size", WEB_MAX_SIZE)
+    thumb_max_size = defs.get("thumbnail_size", THUMB_MAX_SIZE)
+
+    paths = [os.path.join(odir, n) for n in names]
+
+    if len(paths) == 1:
+        results = [make_renditions(paths[0], web_max_size, thumb_max_size)]
+    else:
+        nworkers = min(len(paths), os.cpu_count() or 1)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=nworkers) as pool:
+            results = list(pool.map(make_renditions, paths,
+                                    [web_max_size] * len(paths), [thumb_max_size] * len(paths)))
+
+    return {n: r for n, r in zip(names, results) if r is not None}
@@ -1,15 +1,73 @@
 """
 main driver for the journal
+
+To keep startup fast, the modules that do the work for a subcommand
+are only imported once we know which subcommand was asked for.
 """
 
 import argparse
 import configparser
+import datetime
 import os
+import shlex
 import sys
 
-from pyjournal2 import build_util
-from pyjournal2 import entry_util
-from pyjournal2 import git_util
+# the subcommands take precedence over topics of the same name in the
+# "pyjournal topic" shortcut
+SUBCOMMANDS = ["init", "connect", "entry", "todo", "projects", "year",
+               "continue", "build", "pull", "push", "status", "show",
+               "serve", "search", "dedup", "sync", "queue", "list", "stats"]
+
+# the optional settings in the [main] section of .pyjournal2rc, and
+# their types
+OPTIONAL_SETTINGS = {"username": str,
+                     "recent_entries": int,
+                     "jobs": int,
+                     "auto_commit": bool,
+                     "image_max_size": int,
+                     "thumbnail_size": int,
+                     "link_max_size": float,
+                     "sidecar_store": str,
+                     "sidecar_min_size": float,
+                     "defer_git": bool,
+                     "sharded_build": bool,
+                     "archive_pages": bool,
+                     "toc_maxdepth": int,
+                     "nav_collapse": bool,
+                     "nav_depth": int,
+                     "nav_titles_only": bool,
+                     "notebook_cache": bool,
+                     "notebook_timeout": int,
+                     "precompress": bool,
+                     "web_search": bool,
+                     "stats_page": bool}
+
+SETTING_TYPES = {bool: "true or false", int: "an integer", float: "a number", str: "a string"}
+
+
+def date_arg(string):
+    """an argparse type for dates given as YYYY-MM-DD"""
+    try:
+        return str(datetime.date.fromisoformat(string))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{string} is not a date of the form YYYY-MM-DD") from None
+
+
+def is_topic(name, defs):
+    """is name an existing topic?  This only needs a single stat, so
+    we don't have to list all of the topics before parsing the
+    arguments"""
+
+    if name in SUBCOMMANDS or name.startswith(("-", "_", ".")) or name in ["todo", "projects", "year_review"]:
+        return False
+
+    try:
+        source_dir = f"{defs['working_path']}/journal-{defs['nickname']}/source/"
+    except KeyError:
+        # we are doing init or connect, so there are no keys yet
+        return False
+
+    return os.path.isdir(os.path.join(source_dir, name))
 
 
 def get_args(defs):
@@ -19,12 +77,6 @@ def get_args(defs):
     # entry, and we don't take any arguments, and we don't do an
     # argparse
 
-    try:
-        topics, _ = build_util.get_topics(defs)
-    except KeyError:
-        # we are doing init or connect, so there are no keys yet
-        topics = []
-
     if not os.path.isfile(defs["param_file"]):
         if len(sys.argv) == 1 or sys.argv[1] not in ["init", "connect"]:
             print("pyjournal is not initialized")
@@ -34,12 +86,16 @@ def get_args(defs):
         args = {"command": "entry",
                 "images": [],
                 "link": None,
+                "no_commit": False,
+                "defer": False,
                 "topic": "main"}
 
-    elif len(sys.argv) == 2 and sys.argv[-1] in topics:
+    elif len(sys.argv) == 2 and is_topic(sys.argv[-1], defs):
         args = {"command": "entry",
                 "images": [],
                 "link": None,
+                "no_commit": False,
+                "defer": False,
                 "topic": sys.argv[-1]}
 
     else:
@@ -78,6 +134,10 @@ def get_args(defs):
         entry_ps.add_argument("--link", metavar="link-files",
                               help="files to link in the entry",
                               type=str, default=None)
+        entry_ps.add_argument("--no-commit", help="stage the entry in git, but don't commit it",
+                              action="store_true")
+        entry_ps.add_argument("--defer", help="queue the git work for a background worker and return right away",
+                              action="store_true")
         entry_ps.add_argument("topic", help="the name of the topic to add to",
                               nargs="?", default="main", type=str)
         entry_ps.add_argument("images", help="images to include as figures in the entry",
@@ -101,14 +161,34 @@ def get_args(defs):
         cont_ps.add_argument("--link", metavar="link-files",
                              help="files to link in the entry",
                              type=str, default=None)
+        cont_ps.add_argument("--no-commit", help="stage the entry in git, but don't commit it",
+                             action="store_true")
+        cont_ps.add_argument("--defer", help="queue the git work for a background worker and return right away",
+                             action="store_true")
         cont_ps.add_argument("topic", help="the name of the topic to add to",
                              nargs="?", default="main", type=str)
         cont_ps.add_argument("images", help="images to include as figures in the entry",
                              nargs="*", default=None, type=str)
 
         # the build command
-        sp.add_parser("build",
-                      help="build a PDF of the journal")
+        build_ps = sp.add_parser("build",
+                                 help="build a PDF of the journal")
+        build_ps.add_argument("--clean", help="remove the old build and do a full rebuild",
+                              action="store_true")
+        build_ps.add_argument("-j", "--jobs", help="number of parallel Sphinx workers (default: number of CPUs)",
+                              type=int, default=None)
+        build_ps.add_argument("--sharded", help="build each topic as a separate Sphinx project, skipping unchanged ones",
+                              action="store_true")
+        build_ps.add_argument("--precompress", help="write gzipped (and brotli) copies of the HTML for static file servers",
+                              action="store_true")
+        build_ps.add_argument("--rescan", help="check every topic for changes made outside of pyjournal",
+                              action="store_true")
+        build_ps.add_argument("--profile", help="time each phase of the build and each document (uses one worker)",
+                              action="store_true")
+        build_ps.add_argument("--slowest", help="with --profile, the number of slowest documents to list",
+                              type=int, default=10)
+        build_ps.add_argument("--cprofile", help="with --profile, also write a cProfile dump of the build",
+                              action="store_true")
 
         # the pull command
         sp.add_parser("pull",
@@ -118,13 +198,85 @@ def get_args(defs):
         sp.add_parser("push",
                       help="push local changes to the remote journal")
 
+        # the sync command
+        sp.add_parser("sync",
+                      help="pull, push, and rebuild the journal, skipping whatever is already up to date")
+
+        # the queue command
+        queue_ps = sp.add_parser("queue",
+                                 help="show (or run) the git work queued by deferred entries")
+        queue_ps.add_argument("action", help="status shows the queue, drain runs it now",
+                              nargs="?", default="status", choices=["status", "drain"])
+
         # the status command
         sp.add_parser("status",
                       help="list the current journal information")
 
         # the show command
-        sp.add_parser("show",
-                      help="build the PDF and launch a PDF viewer")
+        show_ps = sp.add_parser("show",
+                                help="build the PDF and launch a PDF viewer")
+        show_ps.add_argument("--clean", help="remove the old build and do a full rebuild",
+                             action="store_true")
+        show_ps.add_argument("-j", "--jobs", help="number of parallel Sphinx workers (default: number of CPUs)",
+                             type=int, default=None)
+        show_ps.add_argument("--sharded", help="build each topic as a separate Sphinx project, skipping unchanged ones",
+                             action="store_true")
+
+        # the serve command
+        serve_ps = sp.add_parser("serve",
+                                 help="serve the journal locally, rebuilding it as entries change")
+        serve_ps.add_argument("-p", "--port", help="the port to serve on",
+                              type=int, default=8000)
+        serve_ps.add_argument("-j", "--jobs", help="number of parallel Sphinx workers (default: number of CPUs)",
+                              type=int, default=None)
+        serve_ps.add_argument("--no-browser", help="don't open the journal in a web browser",
+                              action="store_true")
+
+        # the list command
+        list_ps = sp.add_parser("list",
+                                help="list the entries, most recent first")
+        list_ps.add_argument("--topic", help="only list this topic (can be repeated)",
+                             action="append", default=None, type=str)
+        list_ps.add_argument("--since", help="only list entries on or after this date (YYYY-MM-DD)",
+                             default=None, type=date_arg)
+        list_ps.add_argument("--until", help="only list entries on or before this date (YYYY-MM-DD)",
+                             default=None, type=date_arg)
+        list_ps.add_argument("-n", help="the maximum number of entries to show",
+                             type=int, default=None)
+        list_ps.add_argument("--rescan", help="check every entry for changes made outside of pyjournal",
+                             action="store_true")
+
+        # the stats command
+        stats_ps = sp.add_parser("stats",
+                                 help="show statistics of the journal activity")
+        stats_ps.add_argument("--topic", help="only count this topic (can be repeated)",
+                              action="append", default=None, type=str)
+        stats_ps.add_argument("--since", help="only count entries on or after this date (YYYY-MM-DD)",
+                              default=None, type=date_arg)
+        stats_ps.add_argument("--until", help="only count entries on or before this date (YYYY-MM-DD)",
+                              default=None, type=date_arg)
+        stats_ps.add_argument("--rst", help="write the statistics of the whole journal as source/stats.rst",
+                              action="store_true")
+        stats_ps.add_argument("--rescan", help="check every entry for changes made outside of pyjournal",
+                              action="store_true")
+
+        # the search command
+        search_ps = sp.add_parser("search",
+                                  help="search the text of the journal entries")
+        search_ps.add_argument("--topic", help="only search this topic (can be repeated)",
+                               action="append", default=None, type=str)
+        search_ps.add_argument("--since", help="only search entries on or after this date (YYYY-MM-DD)",
+                               default=None, type=date_arg)
+        search_ps.add_argument("--until", help="only search entries on or before this date (YYYY-MM-DD)",
+                               default=None, type=date_arg)
+        search_ps.add_argument("-n", help="the maximum number of results to show",
+                               type=int, default=20)
+        search_ps.add_argument("query", help='the words to search for -- use "double quotes" for a phrase',
+                               nargs="+", type=str)
+
+        # the dedup command
+        sp.add_parser("dedup",
+                      help="store each attachment once, replacing duplicates with hardlinks")
 
         args = vars(p.parse_args())
 
@@ -146,10 +298,20 @@ def read_config():
         defs["working_path"] = cp.get("main", "working_path")
         defs["master_repo"] = cp.get("main", "master_repo")
         defs["nickname"] = cp.get("main", "nickname")
-        try:
-            defs["username"] = cp.get("main", "username")
-        except (configparser.NoOptionError, KeyError):
-            pass
+        for key, kind in OPTIONAL_SETTINGS.items():
+            try:
+                if kind is bool:
+                    defs[key] = cp.getboolean("main", key)
+                elif kind is int:
+                    defs[key] = cp.getint("main", key)
+                elif kind is float:
+                    defs[key] = cp.getfloat("main", key)
+                else:
+                    defs[key] = cp.get("main", key)
+            except (configparser.NoOptionError, KeyError):
+                pass
+            except ValueError:
+                sys.exit(f"ERROR: {key} in .pyjournal2rc should be {SETTING_TYPES[kind]}")
 
     return defs
 
@@ -170,6 +332,7 @@ def main(args, defs):
         master_path = os.path.normpath(os.path.expanduser(master_path))
         working_path = os.path.normpath(os.path.expanduser(working_path))
 
+        from pyjournal2 import git_util
         git_util.init(nickname, username, master_path, working_path, defs)
 
     elif action == "connect":
@@ -177,6 +340,7 @@ def main(args, defs):
         working_path = args["working-path"][0]
         working_path = os.path.normpath(os.path.expanduser(working_path))
 
+        from pyjournal2 import git_util
         git_util.connect(master_repo, working_path, defs)
 
     elif action == "entry":
@@ -187,6 +351,9 @@ def main(args, defs):
         else:
             link_files = args["link"].split()
 
+        from pyjournal2 import build_util
+        from pyjournal2 import entry_util
+
         # check if the topic exists.  If not, ask if we want to create it
         topics, _ = build_util.get_topics(defs)
         if topic not in topics:
@@ -196,12 +363,15 @@ def main(args, defs):
             if create.lower() == "y":
                 build_util.create_topic(topic, defs)
 
-        entry_util.entry(topic, images, link_files, defs)
+        entry_util.entry(topic, images, link_files, defs,
+                         commit=False if args["no_commit"] else None,
+                         defer=True if args["defer"] else None)
 
     elif action == "todo":
         # "todo" is a special topic with only a single entry
         images = []
         link_files = []
+        from pyjournal2 import entry_util
         entry_util.entry("todo", images, link_files, defs)
 
     elif action == "projects":
@@ -209,6 +379,7 @@ def main(args, defs):
         images = []
         link_files = []
 
+        from pyjournal2 import entry_util
         entry_util.entry("projects", images, link_files, defs)
 
     elif action == "year":
@@ -216,6 +387,7 @@ def main(args, defs):
         images = []
         link_files = []
 
+        from pyjournal2 import entry_util
         entry_util.entry("year", images, link_files, defs)
 
     elif action == "continue":
@@ -231,24 +403,80 @@ def main(args, defs):
         else:
             link_files = args["link"].split()
 
+        from pyjournal2 import build_util
+        from pyjournal2 import entry_util
+
         # get the entry id of the last entry for this topic -- note: we sort
         # with latest entries first
         entries = build_util.get_topic_entries(topic, defs)
 
-        entry_util.entry(topic, images, link_files, defs, use_date=entries[0].entry_date_num)
+        entry_util.entry(topic, images, link_files, defs, use_date=entries[0].entry_date_num,
+                         commit=False if args["no_commit"] else None,
+                         defer=True if args["defer"] else None)
 
     elif action == "build":
-        build_util.build(defs)
+        if args["profile"]:
+            from pyjournal2 import profile_util
+            profile_util.profile_build(defs, clean=args["clean"], N=args["slowest"],
+                                       cprofile=args["cprofile"])
+        else:
+            from pyjournal2 import build_util
+            build_util.build(defs, clean=args["clean"], jobs=args["jobs"],
+                             sharded=True if args["sharded"] else None,
+                             precompress=True if args["precompress"] else None,
+                             rescan=args["rescan"])
 
     elif action == "show":
-        build_util.build(defs, show=1)
+        from pyjournal2 import build_util
+        build_util.build(defs, show=1, clean=args["clean"], jobs=args["jobs"],
+                         sharded=True if args["sharded"] else None)
+
+    elif action == "serve":
+        from pyjournal2 import serve_util
+        serve_util.serve(defs, port=args["port"], jobs=args["jobs"],
+                         open_browser=not args["no_browser"])
+
+    elif action == "search":
+        # an argument with spaces in it was quoted on the command line,
+        # so keep it together as a phrase
+        query = " ".join(shlex.quote(q) for q in args["query"])
+
+        from pyjournal2 import search_util
+        search_util.run_search(defs, query, topics=args["topic"],
+                               since=args["since"], until=args["until"], N=args["n"])
+
+    elif action == "list":
+        from pyjournal2 import columns_util
+        columns_util.list_entries(defs, topics=args["topic"], since=args["since"],
+                                  until=args["until"], N=args["n"], rescan=args["rescan"])
+
+    elif action == "stats":
+        from pyjournal2 import stats_util
+        stats_util.show_stats(defs, topics=args["topic"], since=args["since"],
+                              until=args["until"], rst=args["rst"], rescan=args["rescan"])
+
+    elif action == "dedup":
+        from pyjournal2 import attach_util
+        attach_util.dedup(defs)
 
     elif action == "pull":
+        from pyjournal2 import git_util
         git_util.pull(defs)
 
     elif action == "push":
+        from pyjournal2 import git_util
         git_util.push(defs)
 
+    elif action == "sync":
+        from pyjournal2 import git_util
+        git_util.sync(defs)
+
+    elif action == "queue":
+        from pyjournal2 import queue_util
+        if args["action"] == "drain":
+            queue_util.drain(defs, wait=True)
+        queue_util.status(defs)
+
     elif action == "status":
 
         print("pyjournal2")
@@ -0,0 +1,317 @@
+"""a cache of executed notebooks for nbsphinx.
+
+Left to itself, nbsphinx executes every notebook without outputs each
+time Sphinx reads it -- starting a kernel and running every cell --
+and it does so one notebook at a time.  Instead, before Sphinx runs,
+build() executes the notebooks that need it itself, in parallel
+processes, and keeps each executed notebook in the journal's cache
+directory, keyed by a hash of the notebook's text and its kernel.  As
+Sphinx reads a notebook, its source is swapped for the cached, executed
+version, and Sphinx is told never to execute notebooks itself, so a
+notebook that hasn't changed is never executed again.
+
+So that a build doesn't have to look through the whole source tree
+for notebooks, or read and hash every notebook just to find its cache
+key, the notebooks in each topic directory are remembered (in
+notebooks.json in the cache directory) along with the directory's
+mtime, and the key of each notebook along with its mtime and size.  A
+topic is only searched again if its directory changed or it was marked
+as changed (see catalog_util.mark_changed), or with rescan, and only a
+notebook whose mtime or size changed is read again.
+
+A notebook is executed if nbsphinx would execute it: if none of its
+code cells have outputs, or if its metadata says "nbsphinx": {"execute":
+"always"}.  Each one runs in its own directory, with a timeout of
+notebook_timeout seconds per cell (unless its metadata sets one).  A
+notebook that fails to execute is not cached -- it is rendered without
+outputs, and executed again on the next build.
+
+Setting notebook_cache = false in .pyjournal2rc goes back to letting
+nbsphinx do the executing.
+
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+from pyjournal2 import catalog_util
+
+# bump this when the format of the memo of notebook keys changes
+MEMO_VERSION = 2
+
+# the default timeout (in seconds) for executing a notebook cell
+NOTEBOOK_TIMEOUT = 60
+
+# the kernel used when a notebook doesn't name one
+DEFAULT_KERNEL = "python3"
+
+# the tracebacks from the kernel are colored
+COLOR_RE = re.compile(r"\x1b\[[0-9;]*m")
+
+
+def use_cache(defs):
+    """are the notebooks executed through the cache?"""
+    return defs.get("notebook_cache", True)
+
+
+def get_notebook_cache_dir(defs):
+    """return the directory holding the executed notebooks"""
+
+    cache_dir = os.path.join(catalog_util.get_cache_dir(defs), "notebooks")
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def get_memo_file(defs):
+    """return the file remembering the cache key of each notebook"""
+    return os.path.join(catalog_util.get_cache_dir(defs), "notebooks.json")
+
+
+def read_memo(defs):
+    """return the memo of the notebooks: a dict mapping each directory in
+    source/ to its mtime (and when it was scanned, for
+    catalog_util.is_valid) and the notebooks in it, and a dict mapping
+    the path of each notebook to its [mtime_ns, size, key], where key is
+    None if the notebook doesn't need executing"""
+
+    try:
+        with open(get_memo_file(defs)) as f:
+            memo = json.load(f)
+    except (OSError, ValueError):
+        return {}, {}
+
+    if not isinstance(memo, dict) or memo.get("version") != MEMO_VERSION:
+        return {}, {}
+
+    return memo.get("topics", {}), memo.get("notebooks", {})
+
+
+def write_memo(defs, topics, notebooks):
+    """write the memo of the notebooks"""
+
+    memo_file = get_memo_file(defs)
+    tmp = f"{memo_file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump({"version": MEMO_VERSION, "topics": topics, "notebooks": notebooks}, f)
+        os.replace(tmp, memo_file)
+    except OSError:
+        # the memo is only a cache, so failing to write it is not fatal
+        pass
+
+
+def find_notebooks(defs, old_topics, rescan=False):
+    """return the notebooks in each directory of source/, searching only
+    the directories that changed since old_topics (see read_memo), or
+    every one with rescan"""
+
+    source_dir = os.path.join(catalog_util.get_journal_dir(defs), "source")
+
+    marked = catalog_util.take_changed(defs, "notebooks")
+    rescan = rescan or "*" in marked
+
+    dirs, _ = catalog_util.listing(defs)
+    catalog_util.save(defs)
+
+    topics = {}
+    for d in dirs:
+        if d.startswith(("_", ".")):
+            continue
+
+        top = os.path.join(source_dir, d)
+        try:
+            mtime = os.stat(top).st_mtime_ns
+        except OSError:
+            continue
+
+        cached = old_topics.get(d)
+        if not rescan and d not in marked and catalog_util.is_valid(cached, mtime):
+            topics[d] = cached
+            continue
+
+        scanned = time.time()
+        found = []
+        for root, subdirs, names in os.walk(top):
+            # skip .ipynb_checkpoints and the like
+            subdirs[:] = sorted(q for q in subdirs if not q.startswith("."))
+            found += [os.path.join(root, n) for n in sorted(names)
+                      if n.endswith(".ipynb") and not n.startswith(".")]
+
+        topics[d] = {"mtime": mtime, "scanned": scanned, "notebooks": found}
+
+    return topics
+
+
+def parse(text):
+    """return the notebook text as a dict, or None if it isn't valid JSON"""
+
+    try:
+        nb = json.loads(text)
+    except ValueError:
+        return None
+
+    return nb if isinstance(nb, dict) else None
+
+
+def get_kernel(nb):
+    """return the name of the kernel the notebook runs with"""
+    return nb.get("metadata", {}).get("kernelspec", {}).get("name") or DEFAULT_KERNEL
+
+
+def get_key(text, kernel):
+    """return the cache key of the notebook text run with kernel"""
+
+    h = hashlib.sha256()
+    h.update(kernel.encode())
+    h.update(b"\0")
+    h.update(text.encode())
+    return h.hexdigest()
+
+
+def needs_execution(nb):
+    """would nbsphinx execute the notebook nb?"""
+
+    execute = nb.get("metadata", {}).get("nbsphinx", {}).get("execute", "auto")
+    if execute != "auto":
+        return execute == "always"
+
+    code = [c for c in nb.get("cells", []) if c.get("cell_type") == "code"]
+    return (any(c.get("source") for c in code) and
+            not any(c.get("outputs") or c.get("execution_count") for c in code))
+
+
+def read_notebook(path):
+    """return the text of the notebook at path, decoded the way Sphinx
+    decodes its sources"""
+
+    with open(path, encoding="utf-8-sig") as f:
+        return f.read()
+
+
+def execute_notebook(path, text, kernel, timeout, cache_file):
+    """execute the notebook at path (whose content is text) and write the
+    executed notebook to cache_file.  This runs in a worker process."""
+
+    import nbclient
+    import nbformat
+
+    nb = nbformat.reads(text, as_version=4)
+    options = nb.metadata.get("nbsphinx", {})
+
+    client = nbclient.NotebookClient(nb, kernel_name=kernel,
+                                     timeout=options.get("timeout", timeout),
+                                     allow_errors=options.get("allow_errors", False),
+                                     resources={"metadata": {"path": os.path.dirname(path)}})
+    client.execute()
+
+    # the notebook is already executed -- don't let its metadata ask
+    # nbsphinx to run it again
+    nb.metadata.setdefault("nbsphinx", {})["execute"] = "never"
+
+    tmp = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        nbformat.write(nb, f)
+    os.replace(tmp, cache_file)
+
+
+def execute_missing(defs, jobs, rescan=False):
+    """execute, in jobs parallel processes, every notebook in the journal
+    that needs executing and isn't already in the cache.  rescan looks
+    for notebooks in every directory, not just the ones that changed."""
+
+    if not use_cache(defs):
+        return
+
+    cache_dir = get_notebook_cache_dir(defs)
+    timeout = defs.get("notebook_timeout", NOTEBOOK_TIMEOUT)
+
+    old_topics, memo = read_memo(defs)
+    topics = find_notebooks(defs, old_topics, rescan)
+    notebooks = {}
+
+    todo = {}
+    for path in (p for t in topics.values() for p in t["notebooks"]):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+
+        # a notebook that hasn't changed since we last hashed it only
+        # needs to be read if it isn't in the cache (e.g. it failed)
+        entry = memo.get(path)
+        if entry is not None and entry[:2] == [st.st_mtime_ns, st.st_size]:
+            key = entry[2]
+            if key is None or os.path.isfile(os.path.join(cache_dir, f"{key}.ipynb")):
+                notebooks[path] = entry
+                continue
+
+        try:
+            text = read_notebook(path)
+        except (OSError, UnicodeDecodeError):
+            continue
+
+        key = None
+        nb = parse(text)
+        if nb is not None and needs_execution(nb):
+            kernel = get_kernel(nb)
+            key = get_key(text, kernel)
+            cache_file = os.path.join(cache_dir, f"{key}.ipynb")
+            if not os.path.isfile(cache_file):
+                todo[cache_file] = (path, text, kernel)
+
+        notebooks[path] = [st.st_mtime_ns, st.st_size, key]
+
+    if topics != old_topics or notebooks != memo:
+        write_memo(defs, topics, notebooks)
+
+    if not todo:
+        return
+
+    print(f"executing {len(todo)} notebook(s)")
+
+    nworkers = min(len(todo), jobs)
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nworkers) as pool:
+        futures = {pool.submit(execute_notebook, path, text, kernel, timeout, cache_file): path
+                   for cache_file, (path, text, kernel) in todo.items()}
+        for future in concurrent.futures.as_completed(futures):
+            # a notebook can fail in as many ways as its code can
+            try:
+                future.result()
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                failed.append((futures[future], COLOR_RE.sub("", str(err)).strip().splitlines()))
+
+    for path, lines in failed:
+        reason = lines[-1] if lines else "unknown error"
+        print(f"WARNING: unable to execute {path}: {reason}", file=sys.stderr)
+
+
+def get_hook(defs):
+    """return a SphinxRunner hook that has Sphinx read the executed
+    version of each notebook from the cache"""
+
+    cache_dir = get_notebook_cache_dir(defs)
+
+    def on_source_read(app, docname, source):
+        if not str(app.env.doc2path(docname)).endswith(".ipynb"):
+            return
+
+        nb = parse(source[0])
+        if nb is None:
+            return
+
+        cache_file = os.path.join(cache_dir, f"{get_key(source[0], get_kernel(nb))}.ipynb")
+        try:
+            source[0] = read_notebook(cache_file)
+        except OSError:
+            pass
+
+    def hook(app):
+        app.connect("source-read", on_source_read)
+
+    return hook
@@ -0,0 +1,192 @@
+"""profiling a journal build ("pyjournal build --profile").
+
+A BuildProfile records how long each phase of build() takes, and --
+through Sphinx event hooks -- how long Sphinx spends reading and
+writing each document:
+
+  * reading a document runs from its source-read event to its
+    doctree-read event
+
+  * writing a document runs from its doctree-resolved event to the
+    next document's (or, for the last one, to whatever Sphinx does
+    next)
+
+Sphinx doesn't send the events from its parallel workers back to the
+main process, so a profiled build always uses a single worker (and
+is never sharded).
+
+"""
+
+import contextlib
+import cProfile
+import json
+import os
+import time
+
+from pyjournal2 import build_util
+from pyjournal2 import sphinx_util
+
+# the number of slowest documents to report
+SLOWEST = 10
+
+
+class BuildProfile:
+    """the phase timings and per-document read and write times of a build"""
+
+    def __init__(self):
+        self.phases = []
+        self.sphinx_phases = []
+        self.docs = {}
+        self.notebooks = set()
+
+        self._reading = {}
+        self._writing = None
+        self._mark = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """time the code in the with block as phase name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def _add(self, docname, kind, elapsed):
+        times = self.docs.setdefault(docname, {"read": 0.0, "write": 0.0})
+        times[kind] += elapsed
+
+    def _end_phase(self, name):
+        # the Sphinx phases are measured between events
+        now = time.perf_counter()
+        if self._mark is not None:
+            self.sphinx_phases.append((name, now - self._mark))
+        self._mark = now
+
+    def _end_write(self):
+        if self._writing is not None:
+            docname, start = self._writing
+            self._add(docname, "write", time.perf_counter() - start)
+            self._writing = None
+
+    def _on_read_start(self, _app, _env, _docnames):
+        self._mark = time.perf_counter()
+
+    def _on_source_read(self, app, docname, _):
+        self._reading[docname] = time.perf_counter()
+        if os.path.splitext(str(app.env.doc2path(docname)))[1] == ".ipynb":
+            self.notebooks.add(docname)
+
+    def _on_doctree_read(self, app, _doctree):
+        docname = app.env.docname
+        if docname in self._reading:
+            self._add(docname, "read", time.perf_counter() - self._reading.pop(docname))
+
+    def _on_env_updated(self, _app, _env):
+        self._end_phase("sphinx read")
+
+    def _on_doctree_resolved(self, _app, _doctree, docname):
+        self._end_write()
+        self._writing = (docname, time.perf_counter())
+
+    def _on_page_context(self, _app, pagename, *_):
+        # a page that isn't a document (e.g. genindex) means the last
+        # document is done
+        if self._writing is not None and pagename != self._writing[0]:
+            self._end_write()
+
+    def _on_collect_pages(self, _app):
+        self._end_write()
+        self._end_phase("sphinx write")
+        return []
+
+    def _on_build_finished(self, _app, _exc):
+        self._end_write()
+        self._end_phase("sphinx finish")
+
+    def connect(self, app):
+        """connect the event hooks to the Sphinx application app"""
+
+        app.connect("env-before-read-docs", self._on_read_start)
+        app.connect("source-read", self._on_source_read)
+        app.connect("doctree-read", self._on_doctree_read)
+        app.connect("env-updated", self._on_env_updated)
+        app.connect("doctree-resolved", self._on_doctree_resolved)
+        app.connect("html-page-context", self._on_page_context)
+        app.connect("html-collect-pages", self._on_collect_pages)
+        app.connect("build-finished", self._on_build_finished)
+
+    def slowest(self, N=SLOWEST):
+        """return the N documents that took the longest, as a list of
+        (docname, read, write)"""
+
+        docs = sorted(self.docs.items(), key=lambda d: d[1]["read"] + d[1]["write"], reverse=True)
+        return [(d, t["read"], t["write"]) for d, t in docs[:N]]
+
+    def report(self, N=SLOWEST):
+        """print the phase timings and the N slowest documents"""
+
+        print("phase timings:")
+        for name, elapsed in self.phases:
+            print(f"  {name:20s} {elapsed:8.3f} s")
+            if name == "sphinx build":
+                for sphinx_name, sphinx_elapsed in self.sphinx_phases:
+                    print(f"    {sphinx_name:18s} {sphinx_elapsed:8.3f} s")
+
+        if self.notebooks:
+            nb_read = sum(self.docs[d]["read"] for d in self.notebooks if d in self.docs)
+            nb_write = sum(self.docs[d]["write"] for d in self.notebooks if d in self.docs)
+            print(f"  {len(self.notebooks)} notebook(s): {nb_read:.3f} s reading, {nb_write:.3f} s writing")
+
+        slowest = self.slowest(N)
+        if slowest:
+            print(f"slowest {len(slowest)} document(s):")
+            print(f"  {'read':>8s} {'write':>8s}  document")
+            for docname, read, write in slowest:
+                print(f"  {read:8.3f} {write:8.3f}  {docname}")
+
+    def to_dict(self):
+        """return the profile as a JSON-serializable dict"""
+
+        return {"phases": [{"name": name, "seconds": elapsed} for name, elapsed in self.phases],
+                "sphinx_phases": [{"name": name, "seconds": elapsed}
+                                  for name, elapsed in self.sphinx_phases],
+                "documents": {d: dict(t, notebook=d in self.notebooks)
+                              for d, t in sorted(self.docs.items())}}
+
+
+def profile_build(defs, *, clean=False, N=SLOWEST, cprofile=False):
+    """build the journal with profiling on, print the report, and write
+    it as JSON (and, if cprofile, a cProfile dump of the whole build)
+    to the build/ directory.  Returns the BuildResult."""
+
+    profile = BuildProfile()
+
+    profiler = cProfile.Profile() if cprofile else None
+
+    if profiler is not None:
+        profiler.enable()
+    try:
+        result = build_util.build(defs, clean=clean, jobs=1, profile=profile, sharded=False)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+
+    print()
+    profile.report(N)
+
+    _, html_dir, _ = sphinx_util.get_build_dirs(defs)
+    build_dir = os.path.dirname(html_dir)
+    os.makedirs(build_dir, exist_ok=True)
+
+    profile_file = os.path.join(build_dir, "profile.json")
+    with open(profile_file, "w") as f:
+        json.dump(profile.to_dict(), f, indent=1)
+    print(f"wrote {profile_file}")
+
+    if profiler is not None:
+        stats_file = os.path.join(build_dir, "profile.pstats")
+        profiler.dump_stats(stats_file)
+        print(f"wrote {stats_file} (view it with python -m pstats)")
+
+    return result
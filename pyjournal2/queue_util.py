@@ -0,0 +1,261 @@
+"""a durable queue for the git work of new entries.
+
+In deferred mode ("pyjournal entry --defer", or defer_git = true in
+.pyjournal2rc), entry() does not run git itself once the editor
+closes.  It writes a job -- the directory, the files to stage, and
+the commit message -- as a JSON file in the journal's cache directory
+and starts a detached background worker.  The worker commits the
+queued jobs in order and then pushes, if there is anything to push
+and the remote can be reached.
+
+A job is only removed once its git work is done, and redoing a job
+that was already committed is harmless, so if the worker (or the
+machine) dies, the next worker simply replays whatever is left.  Only
+one worker runs at a time -- they take an exclusive lock on a file in
+the cache directory.  Where there is no fcntl (e.g. Windows) we can't
+take that lock, so entries are never deferred and entry() runs git
+itself (anything already queued is still run by drain()).
+
+"""
+
+import datetime
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from pyjournal2 import catalog_util
+from pyjournal2 import shell_util
+from pyjournal2 import sidecar_util
+
+
+def can_defer():
+    """can the git work be left to a background worker here?"""
+    return fcntl is not None
+
+
+def get_queue_dir(defs):
+    """return the directory holding the queued jobs"""
+
+    queue_dir = os.path.join(catalog_util.get_cache_dir(defs), "queue")
+    os.makedirs(queue_dir, exist_ok=True)
+    return queue_dir
+
+
+def get_status_file(defs):
+    """return the file where the worker records its last error"""
+    return os.path.join(catalog_util.get_cache_dir(defs), "queue-status.json")
+
+
+def get_jobs(defs):
+    """return the paths of the queued jobs, oldest first"""
+
+    queue_dir = get_queue_dir(defs)
+    return [os.path.join(queue_dir, q) for q in sorted(os.listdir(queue_dir))
+            if q.endswith(".json")]
+
+
+def write_durably(path, data):
+    """write data as JSON to path so that, even after a crash, path
+    either holds all of it or doesn't exist"""
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+    dir_fd = os.open(os.path.dirname(path), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def enqueue(defs, cwd, files, message):
+    """queue staging files (relative to cwd) in git and, if message is
+    not None, committing them"""
+
+    job = {"cwd": os.path.abspath(cwd),
+           "files": files,
+           "message": message,
+           "created": datetime.datetime.now().isoformat(timespec="seconds")}
+
+    name = f"{time.time_ns():020d}-{os.getpid()}.json"
+    write_durably(os.path.join(get_queue_dir(defs), name), job)
+
+
+def start_worker(defs):
+    """start a background worker to drain the queue, detached from this
+    process so it outlives it"""
+
+    log_file = os.path.join(catalog_util.get_cache_dir(defs), "queue.log")
+
+    cmd = [sys.executable, "-m", "pyjournal2.queue_util", json.dumps(defs)]
+
+    # the worker is never waited for
+    with open(log_file, "a") as log:
+        subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,  # pylint: disable=consider-using-with
+                         cwd=catalog_util.get_journal_dir(defs), start_new_session=True)
+
+
+def run_job(job):
+    """do the git work for a job.  Returns None on success or the error
+    message from git."""
+
+    cwd = shlex.quote(job["cwd"])
+    files = " ".join(shlex.quote(q) for q in job["files"])
+
+    _, stderr, rc = shell_util.run(f"git -C {cwd} add -- {files}")
+    if rc != 0:
+        return stderr
+
+    if job["message"] is not None:
+        # if nothing is staged, this job was already committed before
+        # a crash
+        _, _, rc = shell_util.run(f"git -C {cwd} diff --cached --quiet -- {files}")
+        if rc == 0:
+            return None
+
+        _, stderr, rc = shell_util.run(f"git -C {cwd} commit -q -m {shlex.quote(job['message'])} -- {files}")
+        if rc != 0:
+            return stderr
+
+    return None
+
+
+def push(defs):
+    """push any local commits.  Returns None on success (or if there is
+    nothing to push) or an error message."""
+
+    journal_dir = shlex.quote(catalog_util.get_journal_dir(defs))
+
+    stdout, _, rc = shell_util.run(f"git -C {journal_dir} rev-list --count @{{u}}..HEAD")
+    if rc != 0 or int(stdout) == 0:
+        return None
+
+    try:
+        sidecar_util.push_missing(defs)
+    except SystemExit as err:
+        return str(err)
+
+    _, stderr, rc = shell_util.run(f"git -C {journal_dir} push --quiet")
+    if rc != 0:
+        return f"unable to push (will try again later): {stderr.strip()}"
+
+    return None
+
+
+def record_status(defs, error):
+    """record the outcome of draining the queue"""
+
+    outcome = {"time": datetime.datetime.now().isoformat(timespec="seconds"),
+               "error": error}
+    write_durably(get_status_file(defs), outcome)
+
+
+def drain(defs, *, do_push=True, wait=False):
+    """run the queued jobs in order, and then push.  Returns False if
+    another worker has the queue (and we didn't wait for it)."""
+
+    lock_file = os.path.join(catalog_util.get_cache_dir(defs), "queue.lock")
+
+    with open(lock_file, "w") as lock:
+        # without fcntl no worker is ever started, so we are the only
+        # one draining the queue
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+
+        error = None
+        for job_file in get_jobs(defs):
+            try:
+                with open(job_file) as f:
+                    job = json.load(f)
+            except ValueError:
+                error = f"{job_file} is not a valid job -- remove it by hand"
+                break
+
+            error = run_job(job)
+            if error is not None:
+                error = f"{job['message'] or 'staging'}: {error.strip()}"
+                break
+
+            os.remove(job_file)
+
+        if error is None and do_push:
+            error = push(defs)
+
+        record_status(defs, error)
+
+    return True
+
+
+def worker(defs):
+    """drain the queue until it is empty.  A job queued just as another
+    worker was finishing is picked up when we recheck after it lets go
+    of the lock."""
+
+    while drain(defs):
+        if not get_jobs(defs):
+            break
+
+        # the jobs left over can't be done right now
+        with open(get_status_file(defs)) as f:
+            if json.load(f)["error"] is not None:
+                break
+
+
+def status(defs):
+    """print the state of the queue"""
+
+    jobs = get_jobs(defs)
+    if jobs:
+        print(f"{len(jobs)} queued git job(s):")
+        for job_file in jobs:
+            try:
+                with open(job_file) as f:
+                    job = json.load(f)
+            except ValueError:
+                print(f"  {job_file} is not a valid job")
+                continue
+
+            print(f"  {job['created']}  {job['message'] or 'stage only'} ({len(job['files'])} file(s))")
+    else:
+        print("no queued git jobs")
+
+    journal_dir = shlex.quote(catalog_util.get_journal_dir(defs))
+    stdout, _, rc = shell_util.run(f"git -C {journal_dir} rev-list --count @{{u}}..HEAD")
+    if rc == 0 and int(stdout) > 0:
+        print(f"{int(stdout)} commit(s) not pushed yet")
+
+    if fcntl is not None:
+        lock_file = os.path.join(catalog_util.get_cache_dir(defs), "queue.lock")
+        with open(lock_file, "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print("a worker is running")
+
+    try:
+        with open(get_status_file(defs)) as f:
+            last = json.load(f)
+    except (OSError, ValueError):
+        return
+
+    if last["error"] is not None:
+        print(f"the last run ({last['time']}) failed: {last['error']}")
+
+
+if __name__ == "__main__":
+    worker(json.loads(sys.argv[1]))
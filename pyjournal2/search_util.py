@@ -0,0 +1,337 @@
+"""full-text search of the journal entries from the command line.
+
+We keep an inverted index of every entry (the topics, year_review,
+todo, and projects) in an SQLite database in the journal's cache
+directory.  Each indexed file is stored with its mtime and size, and
+before a query we only reindex the files whose mtime or size changed.
+Results are ranked with BM25.  To keep the index small we only store
+term counts, and check quoted phrases against the text of the few
+entries that contain all of their words.
+
+"""
+
+import collections
+import math
+import os
+import re
+import shlex
+import sqlite3
+import sys
+
+from pyjournal2 import build_util
+from pyjournal2 import catalog_util
+
+INDEX_VERSION = 2
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_RE = re.compile(r"\w+")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY,
+                                 path TEXT UNIQUE,
+                                 topic TEXT,
+                                 date TEXT,
+                                 mtime INTEGER,
+                                 size INTEGER,
+                                 length INTEGER);
+CREATE TABLE IF NOT EXISTS postings (term TEXT,
+                                     doc INTEGER,
+                                     tf INTEGER,
+                                     PRIMARY KEY (term, doc)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc);
+"""
+
+
+class SearchHit:
+    """a single search result"""
+
+    __slots__ = ("path", "topic", "date", "score")
+
+    def __init__(self, path, topic, date, score):
+        self.path = path
+        self.topic = topic
+        self.date = date
+        self.score = score
+
+    def __str__(self):
+        date = self.date if self.date else "----------"
+        return f"{self.score:7.2f}  {date}  {self.topic}: {self.path}"
+
+
+def tokenize(text):
+    """split text into lowercase word tokens"""
+    return TOKEN_RE.findall(text.lower())
+
+
+def connect(defs):
+    """open (creating if needed) the search index database"""
+
+    db_file = os.path.join(catalog_util.get_cache_dir(defs), "search.sqlite")
+
+    try:
+        db = sqlite3.connect(db_file)
+        # the index can always be rebuilt, so favor speed over durability
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = OFF")
+        db.execute("PRAGMA cache_size = -65536")
+        db.executescript(SCHEMA)
+    except sqlite3.DatabaseError:
+        sys.exit(f"ERROR: unable to open the search index {db_file}")
+
+    row = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+    if row is None or int(row[0]) != INDEX_VERSION:
+        with db:
+            db.execute("DELETE FROM postings")
+            db.execute("DELETE FROM docs")
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(INDEX_VERSION),))
+
+    return db
+
+
+def get_documents(defs):
+    """return a list of (path, topic, date) for every entry file in the
+    journal, with path relative to source/.  date is YYYY-MM-DD for
+    dated entries, YYYY-01-01 for year reviews, and empty for the todo
+    and projects lists."""
+
+    source_dir = build_util.get_source_dir(defs)
+
+    topics, other = build_util.get_topics(defs)
+
+    docs = []
+    for topic in topics:
+        for e in build_util.get_topic_entries(topic, defs):
+            d = e.entry_date_num
+            docs.append((f"{topic}/{d}/{d}.rst", topic, d))
+
+    if "year_review" in other:
+        for f in build_util.get_year_review_entries(defs):
+            m = re.match(r"year-(\d+)\.rst$", f)
+            date = f"{m.group(1)}-01-01" if m else ""
+            docs.append((f"year_review/{f}", "year_review", date))
+
+    for special in ["todo", "projects"]:
+        if special in other and os.path.isfile(os.path.join(source_dir, special, f"{special}.rst")):
+            docs.append((f"{special}/{special}.rst", special, ""))
+
+    return docs
+
+
+def index_document(db, doc_id, text):
+    """add the postings for a document's text, returning its length in
+    tokens"""
+
+    tokens = tokenize(text)
+
+    db.executemany("INSERT INTO postings VALUES (?, ?, ?)",
+                   [(t, doc_id, tf) for t, tf in collections.Counter(tokens).items()])
+
+    return len(tokens)
+
+
+def update_index(defs, db):
+    """bring the index up to date with the entry files, reindexing only
+    the ones whose mtime or size changed.  Returns the number of files
+    that were (re)indexed or removed."""
+
+    source_dir = build_util.get_source_dir(defs)
+
+    known = {path: (doc_id, mtime, size)
+             for doc_id, path, mtime, size in db.execute("SELECT id, path, mtime, size FROM docs")}
+
+    changed = 0
+
+    with db:
+        for path, topic, date in get_documents(defs):
+            try:
+                st = os.stat(os.path.join(source_dir, path))
+            except OSError:
+                continue
+
+            old = known.pop(path, None)
+            if old is not None:
+                doc_id, mtime, size = old
+                if mtime == st.st_mtime_ns and size == st.st_size:
+                    continue
+                db.execute("DELETE FROM postings WHERE doc = ?", (doc_id,))
+                db.execute("DELETE FROM docs WHERE id = ?", (doc_id,))
+
+            try:
+                with open(os.path.join(source_dir, path), errors="replace") as f:
+                    text = f.read()
+            except OSError:
+                continue
+
+            cur = db.execute("INSERT INTO docs (path, topic, date, mtime, size, length) VALUES (?, ?, ?, ?, ?, 0)",
+                             (path, topic, date, st.st_mtime_ns, st.st_size))
+            length = index_document(db, cur.lastrowid, text)
+            db.execute("UPDATE docs SET length = ? WHERE id = ?", (length, cur.lastrowid))
+            changed += 1
+
+        # anything left over was deleted from the journal
+        for doc_id, _, _ in known.values():
+            db.execute("DELETE FROM postings WHERE doc = ?", (doc_id,))
+            db.execute("DELETE FROM docs WHERE id = ?", (doc_id,))
+            changed += 1
+
+    return changed
+
+
+def parse_query(query):
+    """split a query string into a list of words and a list of phrases
+    (each a list of words).  Phrases are given in double quotes."""
+
+    words = []
+    phrases = []
+
+    try:
+        parts = shlex.split(query)
+    except ValueError:
+        # an unbalanced quote -- just treat everything as words
+        parts = query.replace('"', " ").split()
+
+    for p in parts:
+        tokens = tokenize(p)
+        if len(tokens) > 1:
+            phrases.append(tokens)
+        words += tokens
+
+    return words, phrases
+
+
+def has_phrase(tokens, phrase):
+    """does the list of tokens contain the words of phrase consecutively?"""
+
+    n = len(phrase)
+    for i, t in enumerate(tokens):
+        if t == phrase[0] and tokens[i:i+n] == phrase:
+            return True
+
+    return False
+
+
+def search(defs, query, *, topics=None, since=None, until=None, N=20, update=True):
+    """search the journal, returning a list of up to N SearchHit objects
+    sorted by relevance.  All the words in the query must appear in an
+    entry, and quoted phrases must appear verbatim.  The results can be
+    restricted to a list of topics and a date range (YYYY-MM-DD
+    strings, inclusive)."""
+
+    db = connect(defs)
+
+    try:
+        if update:
+            update_index(defs, db)
+
+        hits = query_index(db, build_util.get_source_dir(defs), query,
+                           topics=topics, since=since, until=until)
+    finally:
+        db.close()
+
+    return hits[:N]
+
+
+def query_index(db, source_dir, query, *, topics=None, since=None, until=None):
+    """return all the SearchHit objects for query, most relevant first.
+    source_dir is needed to check phrases against the entry text."""
+
+    words, phrases = parse_query(query)
+    if not words:
+        return []
+
+    ndocs, avg_length = db.execute("SELECT COUNT(*), AVG(length) FROM docs").fetchone()
+    if ndocs == 0:
+        return []
+
+    # find the documents containing every word, starting with the
+    # rarest word so the candidate set stays small
+    postings = {}
+    for w in set(words):
+        postings[w] = dict(db.execute("SELECT doc, tf FROM postings WHERE term = ?", (w,)))
+
+    candidates = None
+    for w in sorted(postings, key=lambda q: len(postings[q])):
+        docs = postings[w].keys()
+        candidates = set(docs) if candidates is None else candidates & docs
+        if not candidates:
+            return []
+
+    # apply the topic and date filters
+    meta = {}
+    for doc_id in candidates:
+        path, topic, date, length = db.execute("SELECT path, topic, date, length FROM docs WHERE id = ?",
+                                               (doc_id,)).fetchone()
+        if topics and topic not in topics:
+            continue
+        if (since or until) and not date:
+            continue
+        if since and date < since:
+            continue
+        if until and date > until:
+            continue
+        meta[doc_id] = (path, topic, date, length)
+
+    # check the phrases against the text of the remaining entries
+    if phrases:
+        for doc_id in list(meta):
+            try:
+                with open(os.path.join(source_dir, meta[doc_id][0]), errors="replace") as f:
+                    tokens = tokenize(f.read())
+            except OSError:
+                tokens = []
+            if not all(has_phrase(tokens, p) for p in phrases):
+                del meta[doc_id]
+
+    # rank with BM25
+    hits = []
+    for doc_id, (path, topic, date, length) in meta.items():
+        score = 0.0
+        for w in set(words):
+            df = len(postings[w])
+            idf = math.log(1.0 + (ndocs - df + 0.5) / (df + 0.5))
+            tf = postings[w][doc_id]
+            score += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length))
+        hits.append(SearchHit(path, topic, date, score))
+
+    # ties go to the most recent entry
+    hits.sort(key=lambda h: (h.score, h.date), reverse=True)
+
+    return hits
+
+
+def get_snippet(defs, hit, query, width=100):
+    """return the first line of the hit's entry that contains one of the
+    query words"""
+
+    words = set(parse_query(query)[0])
+
+    try:
+        with open(os.path.join(build_util.get_source_dir(defs), hit.path), errors="replace") as f:
+            for line in f:
+                if words & set(tokenize(line)):
+                    line = line.strip()
+                    return line if len(line) <= width else line[:width-3] + "..."
+    except OSError:
+        pass
+
+    return ""
+
+
+def run_search(defs, query, *, topics=None, since=None, until=None, N=20):
+    """search the journal and print the results"""
+
+    hits = search(defs, query, topics=topics, since=since, until=until, N=N)
+
+    if not hits:
+        print("no matches")
+        return
+
+    for h in hits:
+        print(h)
+        snippet = get_snippet(defs, h, query)
+        if snippet:
+            print(f"           {snippet}")
@@ -0,0 +1,219 @@
+"""serve the built journal over HTTP and rebuild it as the sources change"""
+
+import functools
+import http.server
+import os
+import sys
+import threading
+import time
+import webbrowser
+
+from pyjournal2 import build_util
+from pyjournal2 import catalog_util
+from pyjournal2 import sphinx_util
+
+# the browser polls this URL to learn when a new build is ready
+RELOAD_URL = "/__pyjournal_reload"
+
+RELOAD_SCRIPT = f"""
+<script>
+(function() {{
+  var generation = null;
+  function poll() {{
+    fetch("{RELOAD_URL}", {{cache: "no-store"}})
+      .then(function(r) {{ return r.text(); }})
+      .then(function(g) {{
+        if (generation !== null && g !== generation) {{
+          window.location.reload();
+        }}
+        generation = g;
+      }})
+      .catch(function() {{}})
+      .finally(function() {{ setTimeout(poll, 300); }});
+  }}
+  poll();
+}})();
+</script>
+"""
+
+
+class BuildState:
+    """the number of builds done so far, shared with the HTTP handler"""
+
+    def __init__(self):
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def bump(self):
+        """note that a new build is available"""
+        with self.lock:
+            self.generation += 1
+
+    def get(self):
+        """return the current build number"""
+        with self.lock:
+            return self.generation
+
+
+class ReloadingHandler(http.server.SimpleHTTPRequestHandler):
+    """serve the HTML output, adding a script to each page that reloads
+    it when a new build is available"""
+
+    def __init__(self, *args, state=None, **kwargs):
+        self.state = state
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        """handle the reload poll and HTML pages ourselves"""
+
+        path = self.path.split("?", 1)[0].split("#", 1)[0]
+
+        if path == RELOAD_URL:
+            self.send_bytes(str(self.state.get()).encode(), "text/plain")
+            return
+
+        fs_path = self.translate_path(path)
+        if os.path.isdir(fs_path):
+            fs_path = os.path.join(fs_path, "index.html")
+
+        if fs_path.endswith(".html") and os.path.isfile(fs_path):
+            try:
+                with open(fs_path, "rb") as f:
+                    page = f.read()
+            except OSError:
+                self.send_error(404, "File not found")
+                return
+
+            idx = page.rfind(b"</body>")
+            if idx < 0:
+                idx = len(page)
+            page = page[:idx] + RELOAD_SCRIPT.encode() + page[idx:]
+
+            self.send_bytes(page, "text/html; charset=utf-8")
+            return
+
+        super().do_GET()
+
+    def send_bytes(self, data, content_type):
+        """send data as an uncached response"""
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # don't print a line for every request
+        pass
+
+
+def ignore_file(name):
+    """should a change to this file be ignored?  These are editor
+    backups and lock files, and the temporary files we write"""
+    return (name.startswith(".") or name.startswith("#") or
+            name.endswith("~") or name.endswith(".tmp"))
+
+
+def snapshot(source_dir):
+    """return a dict mapping each file under source_dir to its (mtime, size)"""
+
+    files = {}
+
+    stack = [source_dir]
+    while stack:
+        d = stack.pop()
+        try:
+            with os.scandir(d) as it:
+                for e in it:
+                    if ignore_file(e.name):
+                        continue
+                    if e.is_dir():
+                        stack.append(e.path)
+                    else:
+                        st = e.stat()
+                        files[e.path] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            # the directory may have disappeared while we were looking
+            continue
+
+    return files
+
+
+def get_topics(source_dir, old, new):
+    """return the top-level directories of source_dir where files differ
+    between the snapshots old and new"""
+
+    paths = {p for p in old.keys() | new.keys() if old.get(p) != new.get(p)}
+    return {os.path.relpath(p, source_dir).split(os.sep)[0] for p in paths}
+
+
+def serve(defs, *, port=8000, jobs=None, interval=0.25, open_browser=True):
+    """build the journal, serve build/html on localhost:port, and poll
+    source/ for changes, rebuilding and reloading the browser each time
+    something changes"""
+
+    source_dir, html_dir, _ = sphinx_util.get_build_dirs(defs)
+    sharded = defs.get("sharded_build", False)
+
+    state = BuildState()
+
+    with sphinx_util.SphinxRunner(defs, jobs=jobs) as runner:
+
+        def rebuild():
+            """do the same build as "pyjournal build", but with our warm
+            Sphinx environment, returning the snapshot of the sources.
+            We take the snapshot before running Sphinx, so it includes
+            our TOC updates but edits made during the build are still
+            caught on the next pass"""
+
+            topics, other = build_util.prepare_sources(defs, jobs=runner.jobs)
+            files = snapshot(source_dir)
+            result = build_util.run_sphinx(defs, topics, other, jobs=runner.jobs,
+                                           sharded=sharded, runner=runner)
+            build_util.finish_build(defs, result, jobs=runner.jobs, sharded=sharded)
+            return files
+
+        files = rebuild()
+
+        handler = functools.partial(ReloadingHandler, directory=html_dir, state=state)
+        try:
+            server = http.server.ThreadingHTTPServer(("localhost", port), handler)
+        except OSError as err:
+            sys.exit(f"ERROR: unable to serve on port {port}: {err}")
+
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        url = f"http://localhost:{port}/index.html"
+        print(f"serving the journal at {url} -- press Ctrl-C to stop")
+
+        if open_browser:
+            webbrowser.open_new_tab(url)
+
+        try:
+            while True:
+                time.sleep(interval)
+
+                new_files = snapshot(source_dir)
+                if new_files == files:
+                    continue
+
+                # a sharded build only looks at the topics that were
+                # marked or whose directory changed
+                if sharded:
+                    for topic in get_topics(source_dir, files, new_files):
+                        catalog_util.mark_changed(defs, topic)
+
+                start = time.time()
+                files = rebuild()
+                print(f"rebuilt in {time.time() - start:.2f} s")
+
+                state.bump()
+
+        except KeyboardInterrupt:
+            print("stopping")
+
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,266 @@
+"""sharded builds: each topic as its own Sphinx project.
+
+In a sharded build ("pyjournal build --sharded", or sharded_build =
+true in .pyjournal2rc), every topic -- and each of todo, projects, and
+year_review -- is built as a separate Sphinx project, in its own
+process.  A shard uses the journal's conf.py, with its TOC file as the
+root document and everything outside its directory excluded, and
+writes to build/html/_shards/<shard>/.  A thin top-level site in
+build/html/ links the shards together.
+
+A shard is rebuilt only if its directory's mtime changed (an entry or
+a TOC file was added or rewritten), if it was marked as changed (see
+catalog_util.mark_changed -- editing an entry, pulling, and fetching
+attachments leave marks), or if the shared inputs (conf.py and the
+templates and static files) changed.  Every other shard is skipped
+without even starting Sphinx, and without looking at its files, so the
+build time grows with the number of topics that changed rather than
+with the size of the journal.  Files changed behind pyjournal's back
+are only seen with "pyjournal build --rescan".
+
+With the stats_page setting, the statistics page is part of the
+top-level site, linking to the shards' pages.
+
+Since each shard only knows its own documents, references between
+topics don't resolve, and the index and search pages only cover one
+shard.
+
+"""
+
+import concurrent.futures
+import hashlib
+import io
+import json
+import os
+import shutil
+import time
+
+from pyjournal2 import build_util
+from pyjournal2 import catalog_util
+from pyjournal2 import sphinx_util
+from pyjournal2 import stats_util
+
+# the files in source/ that every shard depends on
+SHARED_INPUTS = ["conf.py", "mathsymbols.tex", "_static", "_templates"]
+
+# the root document of the special shards
+SPECIAL_ROOTS = {"todo": "todo/todo",
+                 "projects": "projects/projects",
+                 "year_review": "year_review/years"}
+
+
+def get_shard_dirs(defs, shard):
+    """return the HTML output and doctree directories for a shard"""
+
+    _, html_dir, doctree_dir = sphinx_util.get_build_dirs(defs)
+    return (os.path.join(html_dir, "_shards", shard),
+            os.path.join(doctree_dir, "_shards", shard))
+
+
+def get_root_doc(shard):
+    """return the root document of a shard"""
+    return SPECIAL_ROOTS.get(shard, f"{shard}/{shard}")
+
+
+def get_page_url(shard, docname):
+    """return the URL of a shard's page, relative to the site's root"""
+    return f"_shards/{shard}/{docname}.html"
+
+
+def fingerprint(source_dir, paths):
+    """return a hash of the names, sizes, and mtimes of all of the files
+    in (or under) paths, relative to source_dir"""
+
+    h = hashlib.sha1()
+
+    for path in paths:
+        path = os.path.join(source_dir, path)
+        if os.path.isfile(path):
+            files = [path]
+        else:
+            files = []
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files += [os.path.join(root, n) for n in sorted(names)]
+
+        for f in files:
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            h.update(f"{os.path.relpath(f, source_dir)}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+
+    return h.hexdigest()
+
+
+def build_shard(defs, shard, freshenv):
+    """build one shard with Sphinx (this runs in a worker process) and
+    return its BuildResult"""
+
+    source_dir, _, _ = sphinx_util.get_build_dirs(defs)
+    outdir, doctreedir = get_shard_dirs(defs, shard)
+
+    # leave out every top-level document and directory but the shard's
+    exclude = [q for q in sorted(os.listdir(source_dir))
+               if q != shard and not q.startswith(("_", ".")) and
+               (q.endswith(".rst") or os.path.isdir(os.path.join(source_dir, q)))]
+
+    overrides = {"root_doc": get_root_doc(shard),
+                 "master_doc": get_root_doc(shard),
+                 "exclude_patterns": exclude}
+
+    with sphinx_util.SphinxRunner(defs, jobs=1, freshenv=freshenv,
+                                  outdir=outdir, doctreedir=doctreedir,
+                                  confoverrides=overrides) as runner:
+        return runner.build()
+
+
+def write_site(defs, site_dir, shards, recent):
+    """write the sources of the top-level site that links the shards
+    together.  recent is the list of the most recent entries."""
+
+    os.makedirs(site_dir, exist_ok=True)
+
+    rf = io.StringIO()
+    rf.write(":orphan:\n\n")
+    title = "recent entries"
+    rf.write(len(title)*"*" + "\n")
+    rf.write(f"{title}\n")
+    rf.write(len(title)*"*" + "\n\n")
+
+    # the thumbnails are copied into the site, since the shards' builds
+    # don't include them
+    source_dir = build_util.get_source_dir(defs)
+    thumbs = []
+    for e in recent:
+        url = get_page_url(e.topic, f"{e.topic}/{e.entry_date_num}/{e.entry_date_num}")
+        rf.write(f"* `{e} <{url}>`__\n")
+
+        for name in build_util.get_thumbnails(defs, e):
+            image = f"_thumbs/{e.topic}/{e.entry_date_num}/{name}"
+            src = os.path.join(source_dir, e.topic, e.entry_date_num, name)
+            dest = os.path.join(site_dir, image)
+            try:
+                current = os.path.getmtime(dest) == os.path.getmtime(src)
+            except OSError:
+                current = False
+            if not current:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copy2(src, dest)
+            thumbs.append((image, url, f"{e}"))
+
+    build_util.write_gallery(rf, thumbs)
+
+    build_util.write_if_changed(os.path.join(site_dir, "recent.rst"), rf.getvalue())
+
+    stats = defs.get("stats_page", False)
+    if stats:
+        def link(docname, title):
+            return f"`{title} <{get_page_url(docname.split('/')[0], docname)}>`__"
+
+        build_util.write_if_changed(os.path.join(site_dir, "stats.rst"),
+                                    ":orphan:\n\n" + stats_util.get_page(defs, link))
+
+    mf = io.StringIO()
+    mf.write("Research Journal\n")
+    mf.write("================\n\n")
+
+    mf.write("Summaries\n")
+    mf.write("---------\n\n")
+    mf.write("* :doc:`recent`\n")
+    if stats:
+        mf.write("* :doc:`stats`\n")
+
+    for shard, name in [("projects", "projects"), ("todo", "todo"), ("year_review", "year review")]:
+        if shard in shards:
+            mf.write(f"* `{name} <{get_page_url(shard, get_root_doc(shard))}>`__\n")
+
+    mf.write("\n")
+    mf.write("Topics\n")
+    mf.write("------\n\n")
+
+    for shard in sorted(shards):
+        if shard not in SPECIAL_ROOTS:
+            mf.write(f"* `{shard} <{get_page_url(shard, get_root_doc(shard))}>`__\n")
+
+    build_util.write_if_changed(os.path.join(site_dir, "index.rst"), mf.getvalue())
+
+
+def build_shards(defs, topics, other, *, jobs=None, clean=False, rescan=False):
+    """build the journal as shards, in parallel processes, skipping the
+    shards that haven't changed (with rescan, every shard is rebuilt).
+    Returns the combined BuildResult."""
+
+    source_dir, html_dir, doctree_dir = sphinx_util.get_build_dirs(defs)
+
+    shards = list(topics) + [q for q in other if q in SPECIAL_ROOTS]
+
+    fingerprint_file = os.path.join(catalog_util.get_cache_dir(defs), "shards.json")
+    try:
+        with open(fingerprint_file) as f:
+            old_prints = json.load(f)
+    except (OSError, ValueError):
+        old_prints = {}
+
+    marked = catalog_util.take_changed(defs, "shards")
+    if clean or rescan or "*" in marked:
+        old_prints = {}
+
+    shared = fingerprint(source_dir, SHARED_INPUTS)
+    scanned = time.time()
+
+    new_prints = {}
+    todo = []
+    for shard in shards:
+        try:
+            mtime = os.stat(os.path.join(source_dir, shard)).st_mtime_ns
+        except OSError:
+            mtime = None
+        old = old_prints.get(shard)
+        outdir, _ = get_shard_dirs(defs, shard)
+        root_page = os.path.join(outdir, f"{get_root_doc(shard)}.html")
+        if (shard not in marked and isinstance(old, dict) and old.get("shared") == shared and
+                catalog_util.is_valid(old, mtime) and os.path.isfile(root_page)):
+            new_prints[shard] = old
+        else:
+            new_prints[shard] = {"mtime": mtime, "scanned": scanned, "shared": shared}
+            todo.append(shard)
+
+    result = sphinx_util.BuildResult()
+
+    if todo:
+        nworkers = min(len(todo), sphinx_util.get_jobs(defs, jobs))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=nworkers) as pool:
+            futures = {pool.submit(build_shard, defs, shard, clean): shard for shard in todo}
+            for future in concurrent.futures.as_completed(futures):
+                shard = futures[future]
+                r = future.result()
+                result.status = max(result.status, r.status)
+                result.warnings += r.warnings
+                result.errors += r.errors
+                if not r:
+                    # try again next time
+                    del new_prints[shard]
+
+    print(f"built {len(todo)} of {len(shards)} shard(s) ({len(shards) - len(todo)} unchanged)")
+
+    # the top-level site
+    site_dir = os.path.join(os.path.dirname(html_dir), "site_source")
+    write_site(defs, site_dir, shards, build_util.get_most_recent_entries(topics, defs))
+
+    site_print = fingerprint(site_dir, ["."]) + shared
+    if old_prints.get("_site") != site_print or not os.path.isfile(os.path.join(html_dir, "index.html")):
+        with sphinx_util.SphinxRunner(defs, jobs=1, freshenv=clean, srcdir=site_dir,
+                                      doctreedir=os.path.join(doctree_dir, "_site")) as runner:
+            r = runner.build()
+        result.status = max(result.status, r.status)
+        result.warnings += r.warnings
+        result.errors += r.errors
+        if r:
+            new_prints["_site"] = site_print
+    else:
+        new_prints["_site"] = site_print
+
+    build_util.write_if_changed(fingerprint_file, json.dumps(new_prints, indent=1))
+
+    return result
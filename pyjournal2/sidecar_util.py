@@ -0,0 +1,230 @@
+"""keep large attachments out of git, in a sidecar object store.
+
+This is enabled by setting sidecar_store in .pyjournal2rc to a
+directory that every machine using the journal can reach -- e.g.
+journal-<nickname>.objects/ next to the bare master repo.  When an
+attachment larger than sidecar_min_size (in MB) is added to an entry,
+its content is copied to the sidecar store (named by its SHA-256
+hash, like the local attachment store), and git only tracks a small
+pointer file, name.pjptr, recording the hash and size.  The file
+itself stays in the entry directory for Sphinx, but is listed in the
+entry's .gitignore.
+
+Other clones get the pointers with a normal pull, and the files they
+point to are fetched from the sidecar store the first time pull or
+build finds them missing.
+
+"""
+
+import os
+import re
+import shlex
+import sys
+
+from pyjournal2 import attach_util
+from pyjournal2 import catalog_util
+from pyjournal2 import shell_util
+
+POINTER_EXT = ".pjptr"
+
+# the default size (in MB) above which attachments go to the sidecar store
+SIDECAR_MIN_SIZE = 10.0
+
+
+def get_sidecar_dir(defs):
+    """return the sidecar store directory, or None if it is not enabled"""
+
+    store = defs.get("sidecar_store")
+    if not store:
+        return None
+
+    return os.path.abspath(os.path.expanduser(store))
+
+
+def use_sidecar(defs, path):
+    """should the attachment at path go to the sidecar store?"""
+
+    if get_sidecar_dir(defs) is None:
+        return False
+
+    min_size = defs.get("sidecar_min_size", SIDECAR_MIN_SIZE)
+    return os.path.getsize(path) > min_size * 1024**2
+
+
+def sidecar_path(defs, digest, name):
+    """return the path of an object in the sidecar store"""
+
+    ext = os.path.splitext(name)[1].lower()
+    return os.path.join(get_sidecar_dir(defs), digest[:2], f"{digest}{ext}")
+
+
+def write_pointer(path, digest, size):
+    """write the pointer file for an attachment"""
+
+    with open(path + POINTER_EXT, "w") as f:
+        f.write(f"sha256 {digest}\n")
+        f.write(f"size {size}\n")
+
+
+def read_pointer(pointer):
+    """return the (digest, size) recorded in a pointer file, or None if
+    it can't be read"""
+
+    try:
+        with open(pointer) as f:
+            fields = dict(l.split(None, 1) for l in f if l.strip())
+        return fields["sha256"].strip(), int(fields["size"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def ignore(odir, name):
+    """add name to the .gitignore of the entry directory odir"""
+
+    gitignore = os.path.join(odir, ".gitignore")
+
+    # anchor the name to this directory and escape any glob characters
+    line = "/" + re.sub(r"([*?\[\]\\])", r"\\\1", name)
+
+    lines = []
+    if os.path.isfile(gitignore):
+        with open(gitignore) as f:
+            lines = f.read().splitlines()
+
+    if line not in lines:
+        with open(gitignore, "a") as f:
+            f.write(line + "\n")
+
+
+def upload(defs, path, digest):
+    """copy the attachment at path to the sidecar store, if it is not
+    already there.  Returns False if the store can't be written to."""
+
+    obj = sidecar_path(defs, digest, path)
+    if os.path.isfile(obj):
+        return True
+
+    try:
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        tmp = f"{obj}.{os.getpid()}.tmp"
+        attach_util.copy_file(path, tmp)
+        os.replace(tmp, obj)
+    except OSError:
+        return False
+
+    return True
+
+
+def offload(defs, odir, name, digest):
+    """move the attachment name in the entry directory odir out of git:
+    upload it to the sidecar store and replace it in git with a pointer.
+    Returns the list of files to stage in git and whether the upload
+    worked (if not, "pyjournal push" will retry it)."""
+
+    path = os.path.join(odir, name)
+
+    write_pointer(path, digest, os.path.getsize(path))
+    ignore(odir, name)
+
+    uploaded = upload(defs, path, digest)
+
+    return [name + POINTER_EXT, ".gitignore"], uploaded
+
+
+def get_pointers(defs):
+    """return the paths of all of the pointer files tracked by git"""
+
+    journal_dir = catalog_util.get_journal_dir(defs)
+
+    stdout, _, rc = shell_util.run(f"git -C {shlex.quote(journal_dir)} ls-files -z -- '*{POINTER_EXT}'")
+    if rc != 0:
+        return []
+
+    return [os.path.join(journal_dir, p) for p in stdout.split("\0") if p]
+
+
+def fetch_missing(defs):
+    """get any attachment whose pointer is in git but whose file is
+    missing (or incomplete) from the sidecar store.  This only costs a
+    stat per pointer when everything is already here."""
+
+    if get_sidecar_dir(defs) is None:
+        return
+
+    source_dir = os.path.join(catalog_util.get_journal_dir(defs), "source")
+
+    nfetched = 0
+    missing = []
+    topics = set()
+
+    for pointer in get_pointers(defs):
+        info = read_pointer(pointer)
+        if info is None:
+            continue
+
+        digest, size = info
+        path = pointer[:-len(POINTER_EXT)]
+
+        try:
+            if os.path.getsize(path) == size:
+                continue
+        except OSError:
+            pass
+
+        # we may still have it in the local attachment store
+        obj = attach_util.object_path(defs, digest, path)
+        try:
+            if not os.path.isfile(obj):
+                os.makedirs(os.path.dirname(obj), exist_ok=True)
+                tmp = f"{obj}.{os.getpid()}.tmp"
+                attach_util.copy_file(sidecar_path(defs, digest, path), tmp)
+                os.replace(tmp, obj)
+
+            attach_util.link_or_copy(obj, path)
+        except OSError:
+            missing.append(path)
+            continue
+
+        nfetched += 1
+        topics.add(os.path.relpath(path, source_dir).split(os.sep)[0])
+
+    # the new files don't change the mtime of their topic's directory
+    for topic in sorted(topics):
+        catalog_util.mark_changed(defs, topic)
+
+    if nfetched:
+        print(f"fetched {nfetched} attachment(s) from the sidecar store")
+
+    if missing:
+        print(f"WARNING: {len(missing)} attachment(s) are not in the sidecar store "
+              f"{get_sidecar_dir(defs)}:", file=sys.stderr)
+        for path in missing:
+            print(f"  {path}", file=sys.stderr)
+
+
+def push_missing(defs):
+    """upload any attachment whose pointer is in git but that is not yet
+    in the sidecar store (e.g. because the store wasn't reachable when
+    the entry was made)"""
+
+    if get_sidecar_dir(defs) is None:
+        return
+
+    nuploaded = 0
+    for pointer in get_pointers(defs):
+        info = read_pointer(pointer)
+        if info is None:
+            continue
+
+        digest, _ = info
+        path = pointer[:-len(POINTER_EXT)]
+        if os.path.isfile(sidecar_path(defs, digest, path)):
+            continue
+
+        if not os.path.isfile(path) or not upload(defs, path, digest):
+            sys.exit(f"ERROR: unable to copy {path} to the sidecar store {get_sidecar_dir(defs)}")
+
+        nuploaded += 1
+
+    if nuploaded:
+        print(f"copied {nuploaded} attachment(s) to the sidecar store")
@@ -0,0 +1,258 @@
+"""routines for running Sphinx in-process on the journal sources"""
+
+import contextlib
+import io
+import os
+import pathlib
+import re
+
+from pyjournal2 import notebook_util
+
+# a new message from Sphinx's warning stream looks like
+# "path:line: WARNING: text" (the location is optional)
+MESSAGE_RE = re.compile(r"(?:^|: )(WARNING|ERROR|CRITICAL|SEVERE): ")
+
+# the .pyjournal2rc navigation settings and the sphinx_rtd_theme
+# options they set
+NAV_OPTIONS = {"nav_collapse": "collapse_navigation",
+               "nav_depth": "navigation_depth",
+               "nav_titles_only": "titles_only"}
+
+# Sphinx may color its messages
+COLOR_RE = re.compile(r"\x1b\[[0-9;]*m")
+
+
+class BuildResult:
+    """the outcome of a Sphinx build: a status code (0 for success) and
+    the lists of warning and error messages Sphinx reported"""
+
+    def __init__(self, status=0, warnings=None, errors=None):
+        self.status = status
+        self.warnings = warnings if warnings is not None else []
+        self.errors = errors if errors is not None else []
+
+    def __bool__(self):
+        return self.status == 0 and not self.errors
+
+    def report(self):
+        """print the warnings and errors, followed by a summary line"""
+
+        for msg in self.warnings + self.errors:
+            print(msg)
+
+        state = "succeeded" if self else "failed"
+        print(f"build {state} with {len(self.warnings)} warning(s) and {len(self.errors)} error(s)")
+
+
+def get_jobs(defs, jobs=None):
+    """return the number of parallel Sphinx workers: jobs if given,
+    otherwise the jobs setting from .pyjournal2rc, and otherwise the
+    number of CPUs"""
+
+    if jobs is None:
+        jobs = defs.get("jobs")
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    return max(1, jobs)
+
+
+def get_build_dirs(defs):
+    """return the source, HTML output, and doctree directories, laid out
+    the same way as the Makefile's "make html" """
+
+    journal_dir = f"{defs['working_path']}/journal-{defs['nickname']}"
+
+    return (os.path.join(journal_dir, "source"),
+            os.path.join(journal_dir, "build", "html"),
+            os.path.join(journal_dir, "build", "doctrees"))
+
+
+def get_confoverrides(defs):
+    """return the Sphinx configuration overrides from the navigation and
+    notebook settings in .pyjournal2rc.  The navigation settings are
+    the sphinx_rtd_theme options that decide how much of the global
+    navigation tree every page embeds."""
+
+    overrides = {}
+    for key, option in NAV_OPTIONS.items():
+        if key in defs:
+            overrides[f"html_theme_options.{option}"] = defs[key]
+
+    # the notebooks are executed ahead of time (see notebook_util)
+    if notebook_util.use_cache(defs):
+        overrides["nbsphinx_execute"] = "never"
+
+    return overrides
+
+
+def get_suppress_warnings(confdir):
+    """return the suppress_warnings setting of the journal's conf.py,
+    with the warnings about documents that aren't in a toctree added --
+    with the archive_pages setting the entries are only linked from the
+    archive pages.  This has to be passed to Sphinx as an override: if
+    it were changed once the application exists, Sphinx would see a
+    different configuration on the next build and reread everything."""
+
+    from sphinx.config import eval_config_file
+    from sphinx.errors import ConfigError
+    from sphinx.util.tags import Tags
+
+    # anything conf.py prints is shown when Sphinx reads it again
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            namespace = eval_config_file(pathlib.Path(confdir, "conf.py"), Tags())
+    except ConfigError:
+        # Sphinx will report the problem when it reads conf.py itself
+        namespace = {}
+
+    return list(namespace.get("suppress_warnings", [])) + ["toc.not_included"]
+
+
+def disable_search(app):
+    """a SphinxRunner hook that stops Sphinx from building its search
+    index -- the journal's own is written by websearch_util"""
+    app.builder.search = False
+
+
+def parse_messages(text):
+    """split the text Sphinx wrote to its warning stream into lists of
+    warnings and errors.  Continuation lines are kept with the message
+    they belong to."""
+
+    messages = []
+    for line in COLOR_RE.sub("", text).splitlines():
+        m = MESSAGE_RE.search(line)
+        if m is not None:
+            messages.append((m.group(1), line))
+        elif messages and line.strip():
+            kind, msg = messages[-1]
+            messages[-1] = (kind, msg + "\n" + line)
+
+    warnings = [msg for kind, msg in messages if kind == "WARNING"]
+    errors = [msg for kind, msg in messages if kind != "WARNING"]
+
+    return warnings, errors
+
+
+class SphinxRunner:
+    """a Sphinx application for the journal that can be built more than
+    once.  Keeping the runner around keeps the Sphinx environment warm,
+    so later builds only need to read the sources that changed.  Use it
+    as a context manager:
+
+        with SphinxRunner(defs) as runner:
+            result = runner.build()
+
+    hooks is a list of functions that are called with the Sphinx
+    application once it is created, e.g. to connect event handlers.
+    The hook that reads executed notebooks from the cache is always
+    added (unless the cache is off), as is disable_search if the
+    web_search setting is on.
+
+    """
+
+    def __init__(self, defs, *, jobs=None, freshenv=False,
+                 srcdir=None, outdir=None, doctreedir=None, confoverrides=None,
+                 hooks=None):
+
+        default_src, default_out, default_doctree = get_build_dirs(defs)
+
+        self.srcdir = srcdir if srcdir is not None else default_src
+        self.outdir = outdir if outdir is not None else default_out
+        self.doctreedir = doctreedir if doctreedir is not None else default_doctree
+        self.confdir = default_src
+
+        self.jobs = get_jobs(defs, jobs)
+        self.freshenv = freshenv
+        self.confoverrides = get_confoverrides(defs)
+        if confoverrides is not None:
+            self.confoverrides.update(confoverrides)
+        self.archive_pages = defs.get("archive_pages", False)
+        self.hooks = list(hooks) if hooks is not None else []
+        if notebook_util.use_cache(defs):
+            self.hooks.append(notebook_util.get_hook(defs))
+        if defs.get("web_search", False):
+            self.hooks.append(disable_search)
+
+        self.status = io.StringIO()
+        self.warning = io.StringIO()
+
+        self.app = None
+        self.result = None
+        self._stack = None
+
+    def __enter__(self):
+        # sphinx is slow to import, so only do it when we build
+        from sphinx.util.docutils import docutils_namespace, patch_docutils
+
+        self._stack = contextlib.ExitStack()
+        self._stack.enter_context(patch_docutils(self.confdir))
+        self._stack.enter_context(docutils_namespace())
+
+        return self
+
+    def __exit__(self, *exc):
+        self._stack.close()
+        self._stack = None
+        return False
+
+    def create(self):
+        """create the Sphinx application, returning False (and setting
+        self.result) if the configuration could not be loaded"""
+
+        from sphinx.application import Sphinx
+        from sphinx.errors import SphinxError
+
+        if self.archive_pages and "suppress_warnings" not in self.confoverrides:
+            self.confoverrides["suppress_warnings"] = get_suppress_warnings(self.confdir)
+
+        try:
+            self.app = Sphinx(self.srcdir, self.confdir, self.outdir, self.doctreedir, "html",
+                              confoverrides=self.confoverrides,
+                              status=self.status, warning=self.warning,
+                              freshenv=self.freshenv, parallel=self.jobs)
+        except (SphinxError, OSError) as err:
+            warnings, errors = parse_messages(self.warning.getvalue())
+            self.result = BuildResult(1, warnings, errors + [str(err)])
+            return False
+
+        for hook in self.hooks:
+            hook(self.app)
+
+        return True
+
+    def build(self, force_all=False, filenames=None):
+        """build the HTML, returning a BuildResult"""
+
+        from sphinx.errors import SphinxError
+
+        # only report the messages from this build
+        self.warning.seek(0)
+        self.warning.truncate()
+        self.status.seek(0)
+        self.status.truncate()
+
+        if self.app is None and not self.create():
+            return self.result
+
+        # the parallel writer takes its doctrees from the environment's
+        # pickled doctree cache, which a previous build leaves filled
+        # with the old versions of the documents we are about to reread
+        # (older Sphinx versions don't have these caches)
+        for cache in ("_pickled_doctree_cache", "_write_doc_doctree_cache"):
+            getattr(self.app.env, cache, {}).clear()
+
+        errors = []
+        try:
+            self.app.build(force_all, filenames)
+            status = self.app.statuscode
+        except (SphinxError, OSError) as err:
+            status = 1
+            errors.append(str(err))
+
+        warnings, logged_errors = parse_messages(self.warning.getvalue())
+        self.result = BuildResult(status, warnings, logged_errors + errors)
+
+        return self.result
@@ -0,0 +1,331 @@
+"""activity statistics for the journal ("pyjournal stats").
+
+The statistics are computed from the columnar entry catalog (see
+columns_util), which already holds the date, topic, word count, and
+attachments of every entry, in a single pass over its rows in date
+order: the totals by topic, year, and month (and the entries per
+topic in each month) are accumulated in arrays indexed by topic and
+month, and the streaks of consecutive days with entries -- and the
+gaps between them -- are followed along the way.  No entry file is
+read unless it changed since the catalog last saw it.
+
+The tables are printed, or written as source/stats.rst, which the
+index links to (with stats_page = true in .pyjournal2rc it is
+rewritten on every build, and a sharded build puts it in the
+top-level site -- see shard_util).
+
+"""
+
+import array
+import datetime
+import io
+import os
+import sys
+
+from pyjournal2 import build_util
+from pyjournal2 import columns_util
+
+
+class Streak:
+    """a run of consecutive days (or, for a gap, of days without
+    entries), from the ordinal start to end, inclusive"""
+
+    __slots__ = ("start", "end")
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start + 1
+
+    def __str__(self):
+        if self.start > self.end:
+            return "none"
+        start = datetime.date.fromordinal(self.start).isoformat()
+        end = datetime.date.fromordinal(self.end).isoformat()
+        return f"{len(self)} day(s), {start} to {end}"
+
+
+class JournalStats:
+    """the statistics of a set of catalog rows"""
+
+    def __init__(self, catalog, rows):
+        ntopics = len(catalog.topics)
+        self.topics = catalog.topics
+
+        self.entries = len(rows)
+
+        # per topic
+        self.topic_entries = array.array("I", bytes(4 * ntopics))
+        self.topic_words = array.array("Q", bytes(8 * ntopics))
+        self.topic_attachments = array.array("Q", bytes(8 * ntopics))
+        self.topic_bytes = array.array("Q", bytes(8 * ntopics))
+        self.topic_first = array.array("i", bytes(4 * ntopics))
+        self.topic_last = array.array("i", bytes(4 * ntopics))
+        self.topic_streak = [Streak(1, 0) for _ in range(ntopics)]
+
+        # per month (as year*12 + month - 1, from the first month on),
+        # and the entries per topic in each month
+        self.first_month = None
+        self.month_entries = array.array("I")
+        self.month_words = array.array("Q")
+        self.month_bytes = array.array("Q")
+        self.month_topic_entries = array.array("I")
+
+        # the days with entries
+        self.active_days = 0
+        self.longest_streak = Streak(1, 0)
+        self.current_streak = Streak(1, 0)
+        self.longest_gap = Streak(1, 0)
+
+        topic_run = [Streak(1, 0) for _ in range(ntopics)]
+        run = Streak(1, 0)
+
+        date = catalog.date
+        topic = catalog.topic
+        words = catalog.words
+        attachments = catalog.attachments
+        attachment_bytes = catalog.attachment_bytes
+
+        # the rows are in date order, so we only need to work out the
+        # month when the date changes
+        last_day = None
+        month = 0
+        for i in rows:
+            day = date[i]
+            t = topic[i]
+
+            if day != last_day:
+                d = datetime.date.fromordinal(day)
+                m = d.year * 12 + d.month - 1
+                if self.first_month is None:
+                    self.first_month = m
+                month = m - self.first_month
+                while len(self.month_entries) <= month:
+                    self.month_entries.append(0)
+                    self.month_words.append(0)
+                    self.month_bytes.append(0)
+                    self.month_topic_entries.extend([0] * ntopics)
+
+                # the streaks of days with entries
+                self.active_days += 1
+                if last_day is not None and day == last_day + 1:
+                    run.end = day
+                else:
+                    if last_day is not None and day - last_day - 1 > len(self.longest_gap):
+                        self.longest_gap = Streak(last_day + 1, day - 1)
+                    run = Streak(day, day)
+                if len(run) > len(self.longest_streak):
+                    self.longest_streak = Streak(run.start, run.end)
+                last_day = day
+
+            if self.topic_entries[t] == 0:
+                self.topic_first[t] = day
+            self.topic_last[t] = day
+            self.topic_entries[t] += 1
+            self.topic_words[t] += words[i]
+            self.topic_attachments[t] += attachments[i]
+            self.topic_bytes[t] += attachment_bytes[i]
+
+            # a topic can have one entry a day
+            r = topic_run[t]
+            if r.end == day - 1:
+                r.end = day
+            else:
+                r = topic_run[t] = Streak(day, day)
+            if len(r) > len(self.topic_streak[t]):
+                self.topic_streak[t] = Streak(r.start, r.end)
+
+            self.month_entries[month] += 1
+            self.month_words[month] += words[i]
+            self.month_bytes[month] += attachment_bytes[i]
+            self.month_topic_entries[month * ntopics + t] += 1
+
+        # a streak is only current if it reaches today (or yesterday,
+        # since today's entry may not be written yet)
+        today = datetime.date.today().toordinal()
+        if last_day is not None and last_day >= today - 1:
+            self.current_streak = run
+
+    def get_month(self, month):
+        """return the month (an index into the month arrays) as YYYY-MM"""
+
+        m = self.first_month + month
+        return f"{m // 12:04d}-{m % 12 + 1:02d}"
+
+
+def mb(nbytes):
+    """return nbytes in MB, for the tables"""
+    return f"{nbytes / 1024**2:.1f}"
+
+
+def doc_link(docname, title):
+    """return a ReST link to the page docname"""
+    return f":doc:`{title} <{docname}>`"
+
+
+def get_tables(stats, year_reviews=None, *, link=None):
+    """return the statistics as a list of (title, header, rows) tables.
+    year_reviews is the set of years with a year review.  If link is
+    given, the tables link to the pages, with link(docname, title)
+    returning the ReST for a link (e.g. doc_link)."""
+
+    year_reviews = year_reviews if year_reviews is not None else set()
+    ntopics = len(stats.topics)
+    tables = []
+
+    words = sum(stats.month_words)
+    attachments = sum(stats.topic_attachments)
+    nbytes = sum(stats.month_bytes)
+    active = [t for t in range(ntopics) if stats.topic_entries[t]]
+
+    summary = [["entries", f"{stats.entries}"],
+               ["topics", f"{len(active)}"],
+               ["days with entries", f"{stats.active_days}"],
+               ["words", f"{words}"],
+               ["attachments", f"{attachments} ({mb(nbytes)} MB)"],
+               ["longest streak", f"{stats.longest_streak}"],
+               ["current streak", f"{stats.current_streak}"],
+               ["longest gap", f"{stats.longest_gap}"]]
+    tables.append(("summary", ["", ""], summary))
+
+    rows = []
+    for t in sorted(active, key=lambda q: stats.topics[q]):
+        name = stats.topics[t]
+        rows.append([link(f"{name}/{name}", name) if link else name,
+                     f"{stats.topic_entries[t]}", f"{stats.topic_words[t]}",
+                     f"{stats.topic_attachments[t]}", mb(stats.topic_bytes[t]),
+                     datetime.date.fromordinal(stats.topic_first[t]).isoformat(),
+                     datetime.date.fromordinal(stats.topic_last[t]).isoformat(),
+                     f"{len(stats.topic_streak[t])}"])
+    tables.append(("by topic", ["topic", "entries", "words", "attachments", "MB",
+                                "first", "last", "longest streak"], rows))
+
+    # the years, newest first, with their year reviews
+    years = {}
+    for month, n in enumerate(stats.month_entries):
+        if n:
+            y = years.setdefault(stats.get_month(month)[:4], [0, 0, 0])
+            y[0] += n
+            y[1] += stats.month_words[month]
+            y[2] += stats.month_bytes[month]
+
+    rows = []
+    for year in sorted(years, reverse=True):
+        n, w, b = years[year]
+        review = ""
+        if year in year_reviews:
+            review = link(f"year_review/year-{year}", f"year-{year}") if link else "yes"
+        rows.append([year, f"{n}", f"{w}", mb(b), review])
+    tables.append(("by year", ["year", "entries", "words", "MB", "year review"], rows))
+
+    # the entries per topic in each month, newest first
+    rows = []
+    for month in reversed(range(len(stats.month_entries))):
+        if not stats.month_entries[month]:
+            continue
+        counts = stats.month_topic_entries[month * ntopics:(month + 1) * ntopics]
+        busiest = sorted((t for t in range(ntopics) if counts[t]), key=lambda q, c=counts: (-c[q], stats.topics[q]))
+        rows.append([stats.get_month(month), f"{stats.month_entries[month]}",
+                     f"{stats.month_words[month]}", mb(stats.month_bytes[month]),
+                     ", ".join(f"{stats.topics[t]} {counts[t]}" for t in busiest)])
+    tables.append(("by month", ["month", "entries", "words", "MB", "entries per topic"], rows))
+
+    return tables
+
+
+def format_text(tables):
+    """return the tables as plain text"""
+
+    out = io.StringIO()
+    for title, header, rows in tables:
+        out.write(f"{title}:\n")
+        if not rows:
+            out.write("  (none)\n\n")
+            continue
+
+        lines = [header] + rows if any(header) else rows
+        widths = [max(len(line[c]) for line in lines) for c in range(len(header))]
+        for line in lines:
+            out.write("  " + "  ".join(f"{v:{w}s}" if c in (0, len(line) - 1) else f"{v:>{w}s}"
+                                       for c, (v, w) in enumerate(zip(line, widths))).rstrip() + "\n")
+        out.write("\n")
+
+    return out.getvalue()
+
+
+def format_rst(tables):
+    """return the tables as a ReST page"""
+
+    out = io.StringIO()
+    title = "journal statistics"
+    out.write(len(title)*"*" + "\n")
+    out.write(f"{title}\n")
+    out.write(len(title)*"*" + "\n\n")
+
+    for title, header, rows in tables:
+        out.write(f"{title}\n")
+        out.write(len(title)*"=" + "\n\n")
+        if not rows:
+            out.write("(none)\n\n")
+            continue
+
+        out.write(".. list-table::\n")
+        if any(header):
+            out.write("   :header-rows: 1\n")
+        out.write("\n")
+        for line in [header] + rows if any(header) else rows:
+            for c, v in enumerate(line):
+                out.write(f"   {'* -' if c == 0 else '  -'} {v}\n")
+        out.write("\n")
+
+    return out.getvalue()
+
+
+def get_year_reviews(defs):
+    """return the set of years (YYYY strings) with a year review"""
+
+    _, other = build_util.get_topics(defs)
+    if "year_review" not in other:
+        return set()
+
+    return {f[5:9] for f in build_util.get_year_review_entries(defs) if f.startswith("year-")}
+
+
+def get_page(defs, link=doc_link, rescan=False):
+    """return the statistics of the whole journal as a ReST page, with
+    link(docname, title) making the links to the pages"""
+
+    catalog = columns_util.update(defs, rescan=rescan)
+    stats = JournalStats(catalog, range(len(catalog)))
+    return format_rst(get_tables(stats, get_year_reviews(defs), link=link))
+
+
+def write_page(defs, rescan=False):
+    """write the statistics of the whole journal as source/stats.rst.
+    Returns True if the page changed."""
+
+    return build_util.write_if_changed(os.path.join(build_util.get_source_dir(defs), "stats.rst"),
+                                       get_page(defs, rescan=rescan))
+
+
+def show_stats(defs, *, topics=None, since=None, until=None, rst=False, rescan=False):
+    """print the statistics of the entries in topics (default: all)
+    from since to until, or with rst, write the statistics of the whole
+    journal as source/stats.rst.  rescan checks every entry for changes
+    (see columns_util.update)."""
+
+    if rst:
+        write_page(defs, rescan=rescan)
+        print(f"wrote {os.path.join(build_util.get_source_dir(defs), 'stats.rst')}")
+        return
+
+    catalog = columns_util.update(defs, rescan=rescan)
+
+    for t in topics or []:
+        if t not in catalog.topics:
+            sys.exit(f"ERROR: {t} is not a valid topic")
+
+    stats = JournalStats(catalog, catalog.select(topics, since, until))
+    print(format_text(get_tables(stats, get_year_reviews(defs))), end="")
@@ -0,0 +1,174 @@
+// search the journal using the sharded index written by pyjournal2's
+// websearch_util.  _search/manifest.json lists the shards -- one per
+// topic and year -- and only the shards matching the topic and year
+// filters are fetched, each at most once per page.
+
+(function () {
+  "use strict";
+
+  var BM25_K1 = 1.2;
+  var BM25_B = 0.75;
+  var MAX_RESULTS = 100;
+
+  var TOKEN_RE = /[\p{L}\p{N}_]+/gu;
+
+  var shardCache = {};
+
+  function tokenize(text) {
+    return text.toLowerCase().match(TOKEN_RE) || [];
+  }
+
+  function fetchJSON(url) {
+    return fetch(url).then(function (response) {
+      if (!response.ok) {
+        throw new Error("unable to load " + url);
+      }
+      return response.json();
+    });
+  }
+
+  function loadShard(shard) {
+    if (!(shard.file in shardCache)) {
+      shardCache[shard.file] = fetchJSON("_search/" + shard.file);
+    }
+    return shardCache[shard.file];
+  }
+
+  // score every document that contains all of the words with BM25.
+  // The document frequencies come from the shards that were searched.
+  function rank(shards, words, avgLength) {
+    var ndocs = 0;
+    var df = {};
+    words.forEach(function (w) { df[w] = 0; });
+
+    shards.forEach(function (shard) {
+      ndocs += shard.docs.length;
+      words.forEach(function (w) {
+        var postings = shard.terms[w];
+        if (postings) {
+          df[w] += postings.length / 2;
+        }
+      });
+    });
+
+    var hits = [];
+    shards.forEach(function (shard) {
+      // the postings are flat lists of document index, term count
+      var tfs = words.map(function (w) {
+        var postings = shard.terms[w] || [];
+        var tf = {};
+        for (var i = 0; i < postings.length; i += 2) {
+          tf[postings[i]] = postings[i + 1];
+        }
+        return tf;
+      });
+
+      Object.keys(tfs[0]).forEach(function (d) {
+        var score = 0.0;
+        var doc = shard.docs[d];
+        for (var i = 0; i < words.length; i++) {
+          var tf = tfs[i][d];
+          if (tf === undefined) {
+            return;
+          }
+          var idf = Math.log(1.0 + (ndocs - df[words[i]] + 0.5) / (df[words[i]] + 0.5));
+          score += idf * tf * (BM25_K1 + 1) /
+            (tf + BM25_K1 * (1 - BM25_B + BM25_B * doc[3] / avgLength));
+        }
+        hits.push({url: doc[0], title: doc[1], date: doc[2], score: score});
+      });
+    });
+
+    // ties go to the most recent entry
+    hits.sort(function (a, b) {
+      return b.score - a.score || (b.date < a.date ? -1 : b.date > a.date ? 1 : 0);
+    });
+
+    return hits;
+  }
+
+  function show(hits, status) {
+    var list = document.getElementById("search-results");
+    list.innerHTML = "";
+
+    hits.slice(0, MAX_RESULTS).forEach(function (hit) {
+      var item = document.createElement("li");
+      var link = document.createElement("a");
+      link.href = hit.url;
+      link.textContent = hit.title;
+      item.appendChild(link);
+
+      var meta = document.createElement("span");
+      meta.className = "search-meta";
+      meta.textContent = "  (score " + hit.score.toFixed(2) + ")";
+      item.appendChild(meta);
+
+      list.appendChild(item);
+    });
+
+    document.getElementById("search-status").textContent = status;
+  }
+
+  function fillSelect(select, values, selected) {
+    values.forEach(function (v) {
+      var option = document.createElement("option");
+      option.value = v;
+      option.textContent = v;
+      option.selected = v === selected;
+      select.appendChild(option);
+    });
+  }
+
+  function run(manifest) {
+    var params = new URLSearchParams(window.location.search);
+    var query = params.get("q") || "";
+    var topic = params.get("topic") || "";
+    var year = params.get("year") || "";
+
+    document.getElementById("search-q").value = query;
+
+    var topics = [];
+    var years = [];
+    manifest.shards.forEach(function (shard) {
+      if (topics.indexOf(shard.topic) < 0) {
+        topics.push(shard.topic);
+      }
+      if (shard.year && years.indexOf(shard.year) < 0) {
+        years.push(shard.year);
+      }
+    });
+    topics.sort();
+    years.sort().reverse();
+
+    fillSelect(document.getElementById("search-topic"), topics, topic);
+    fillSelect(document.getElementById("search-year"), years, year);
+
+    var words = tokenize(query).filter(function (w, i, all) {
+      return all.indexOf(w) === i;
+    });
+    if (words.length === 0) {
+      return;
+    }
+
+    var shards = manifest.shards.filter(function (shard) {
+      return (!topic || shard.topic === topic) && (!year || shard.year === year);
+    });
+
+    show([], "searching " + shards.length + " of " + manifest.shards.length + " index shard(s)...");
+
+    Promise.all(shards.map(loadShard)).then(function (loaded) {
+      var hits = rank(loaded, words, manifest.avg_length);
+      var status = hits.length + " match(es)";
+      if (hits.length > MAX_RESULTS) {
+        status += ", showing the first " + MAX_RESULTS;
+      }
+      show(hits, status);
+    }).catch(function (err) {
+      show([], err.message);
+    });
+  }
+
+  fetchJSON("_search/manifest.json").then(run).catch(function (err) {
+    show([], err.message);
+  });
+})();
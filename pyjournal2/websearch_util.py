@@ -0,0 +1,194 @@
+"""a sharded search index for the HTML journal.
+
+Sphinx's own search loads one searchindex.js covering the whole
+journal, which every visit to the search page has to download and
+parse.  With web_search = true in .pyjournal2rc, Sphinx doesn't build
+that index at all.  Instead, after each build we write the index as
+one small JSON shard per topic and year (plus one each for the todo
+and projects lists) in build/html/_search/, and our own search page
+(search.html) only fetches the shards for the topic and year being
+searched.
+
+The shards are made from the command line search index (see
+search_util), which already covers every entry build_util knows about
+and is updated incrementally.  A shard is only rewritten when one of
+its entries changed, and its file name includes a hash of its
+content, so browsers can cache it for good.
+
+The search page ranks entries with BM25, like "pyjournal search", but
+it has no entry text to check quoted phrases against, so the words of
+a phrase are just required to all appear.
+
+"""
+
+import hashlib
+import json
+import os
+
+from pyjournal2 import build_util
+from pyjournal2 import catalog_util
+from pyjournal2 import search_util
+from pyjournal2 import shard_util
+from pyjournal2 import sphinx_util
+
+# bump this when the shard format changes
+SHARD_VERSION = 1
+
+# a search page for each shard of a sharded build that sends the query
+# on to the journal's search page
+SHARD_SEARCH_PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head><meta charset="utf-8"><title>Search</title></head>
+<body><script>window.location.replace("../../search.html" + window.location.search);</script></body>
+</html>
+"""
+
+
+def use_web_search(defs):
+    """is the sharded search index used instead of Sphinx's?"""
+    return defs.get("web_search", False)
+
+
+def get_search_dir(defs):
+    """return the directory holding the search index shards"""
+
+    _, html_dir, _ = sphinx_util.get_build_dirs(defs)
+    return os.path.join(html_dir, "_search")
+
+
+def get_shard_key(topic, date):
+    """return the shard a document of topic with date belongs to"""
+    return f"{topic}-{date[:4]}" if date else topic
+
+
+def get_title(path, topic, date):
+    """return the title a document is listed with in the results"""
+
+    if topic == "year_review":
+        return f"year review {date[:4]}" if date else os.path.basename(path)[:-4]
+
+    return f"{topic} {date}" if date else topic
+
+
+def write_shard(db, search_dir, key, docs):
+    """write the shard key, holding the documents docs (a list of
+    (doc_id, url, title, date, length)), returning its file name"""
+
+    index = {doc_id: n for n, (doc_id, *_) in enumerate(docs)}
+
+    terms = {}
+    ids = ",".join(str(doc_id) for doc_id in index)
+    for term, doc_id, tf in db.execute(f"SELECT term, doc, tf FROM postings WHERE doc IN ({ids}) "
+                                       "ORDER BY term, doc"):
+        terms.setdefault(term, []).extend((index[doc_id], tf))
+
+    shard = {"docs": [[url, title, date, length] for _, url, title, date, length in docs],
+             "terms": terms}
+
+    data = json.dumps(shard, separators=(",", ":"), sort_keys=True)
+    name = f"{key}.{hashlib.sha256(data.encode()).hexdigest()[:12]}.json"
+    build_util.write_if_changed(os.path.join(search_dir, name), data)
+
+    return name
+
+
+def write_index(defs, sharded=False):
+    """bring the search index shards, the manifest listing them, and the
+    search page in build/html up to date.  sharded says whether the
+    HTML was built as shards, which changes the URLs of the entries."""
+
+    _, html_dir, _ = sphinx_util.get_build_dirs(defs)
+    search_dir = get_search_dir(defs)
+    os.makedirs(search_dir, exist_ok=True)
+
+    state_file = os.path.join(catalog_util.get_cache_dir(defs), "websearch.json")
+    try:
+        with open(state_file) as f:
+            old_state = json.load(f)
+    except (OSError, ValueError):
+        old_state = {}
+
+    if old_state.get("version") != SHARD_VERSION or old_state.get("sharded") != sharded:
+        old_state = {}
+    old_shards = old_state.get("shards", {})
+
+    db = search_util.connect(defs)
+    try:
+        search_util.update_index(defs, db)
+
+        # group the documents into shards, newest first within each
+        groups = {}
+        for doc_id, path, topic, date, mtime, size, length in db.execute(
+                "SELECT id, path, topic, date, mtime, size, length FROM docs ORDER BY date DESC, path"):
+            groups.setdefault(get_shard_key(topic, date), []).append(
+                (doc_id, path, topic, date, mtime, size, length))
+
+        shards = {}
+        nwritten = 0
+        for key, group in sorted(groups.items()):
+            h = hashlib.sha1()
+            for _, path, _, _, mtime, size, _ in group:
+                h.update(f"{path}\0{size}\0{mtime}\n".encode())
+            fingerprint = h.hexdigest()
+
+            old = old_shards.get(key)
+            if old is not None and old["fingerprint"] == fingerprint and \
+               os.path.isfile(os.path.join(search_dir, old["file"])):
+                shards[key] = old
+                continue
+
+            topic = group[0][2]
+            docs = []
+            for doc_id, path, _, date, _, _, length in group:
+                docname = path[:-4]
+                url = shard_util.get_page_url(topic, docname) if sharded else f"{docname}.html"
+                docs.append((doc_id, url, get_title(path, topic, date), date, length))
+
+            shards[key] = {"file": write_shard(db, search_dir, key, docs),
+                           "fingerprint": fingerprint,
+                           "topic": topic,
+                           "year": group[0][3][:4],
+                           "ndocs": len(group)}
+            nwritten += 1
+
+        ndocs, avg_length = db.execute("SELECT COUNT(*), AVG(length) FROM docs").fetchone()
+    finally:
+        db.close()
+
+    manifest = {"version": SHARD_VERSION,
+                "ndocs": ndocs,
+                "avg_length": avg_length or 0.0,
+                "shards": [{"file": s["file"], "topic": s["topic"], "year": s["year"], "ndocs": s["ndocs"]}
+                           for _, s in sorted(shards.items())]}
+    build_util.write_if_changed(os.path.join(search_dir, "manifest.json"),
+                                json.dumps(manifest, separators=(",", ":")))
+
+    # remove the shards that were replaced (and their compressed
+    # copies), and Sphinx's index from before web_search was turned on
+    keep = {s["file"] for s in shards.values()} | {"manifest.json", "search.js"}
+    for name in os.listdir(search_dir):
+        base, ext = os.path.splitext(name)
+        if name not in keep and not (ext in (".gz", ".br") and base in keep):
+            os.remove(os.path.join(search_dir, name))
+
+    try:
+        os.remove(os.path.join(html_dir, "searchindex.js"))
+    except FileNotFoundError:
+        pass
+
+    # the search page
+    websearch_dir = os.path.join(defs["module_dir"], "websearch")
+    for src, dest in [("search.html", html_dir), ("search.js", search_dir)]:
+        with open(os.path.join(websearch_dir, src)) as f:
+            build_util.write_if_changed(os.path.join(dest, src), f.read())
+
+    if sharded:
+        shards_dir = os.path.join(html_dir, "_shards")
+        for shard in os.listdir(shards_dir) if os.path.isdir(shards_dir) else []:
+            build_util.write_if_changed(os.path.join(shards_dir, shard, "search.html"), SHARD_SEARCH_PAGE)
+
+    build_util.write_if_changed(state_file, json.dumps({"version": SHARD_VERSION,
+                                                        "sharded": sharded,
+                                                        "shards": shards}, indent=1))
+
+    print(f"updated {nwritten} of {len(shards)} search index shard(s)")
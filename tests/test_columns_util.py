@@ -0,0 +1,55 @@
+"""tests of the entry catalog's word and attachment counts"""
+
+from pyjournal2 import columns_util
+from pyjournal2 import entry_util
+
+
+def write_entry(path, text, figures, links=""):
+    """write an entry the way entry_util does: the header, the text, a
+    figure block for each (name, label, download) in figures, and then
+    links"""
+
+    date = path.stem
+    with open(path, "w") as f:
+        f.write(f".. _physics_{date}:\n\n")
+        f.write(len(date)*"*" + "\n" + f"{date}\n" + len(date)*"*" + "\n")
+        f.write(entry_util.SYMBOLS + "\n\n")
+        f.write(text)
+        for name, label, download in figures:
+            for l in entry_util.FIGURE_STR.split("\n"):
+                l = l.replace("@figname@", name).replace("@figlabel@", label)
+                f.write(l.replace("@download@", download).rstrip() + "\n")
+        f.write(links)
+
+
+def test_count_words_skips_boilerplate(tmp_path):
+    entry = tmp_path / "2024-03-01.rst"
+
+    write_entry(entry, "", [])
+    assert columns_util.count_words(entry) == 0
+
+    write_entry(entry, "the flame front is unstable\n\n",
+                [("plot.web.png", "2024-03-01_10.00.00:plot", " (:download:`original <plot.png>`)"),
+                 ("doc.pdf", "2024-03-01_10.00.00:doc", "")])
+    assert columns_util.count_words(entry) == 5
+
+    # a caption that was filled in counts
+    entry.write_text(entry.read_text().replace("The caption goes here", "Growth rate vs. time", 1))
+    assert columns_util.count_words(entry) == 9
+
+    # the links to the files that aren't figures don't count
+    write_entry(entry, "", [], ":download:`data.txt <data.txt>`\n\n"
+                "`run.log <file:///home/me/run.log>`__ (not copied into the journal)\n\n")
+    assert columns_util.count_words(entry) == 0
+
+
+def test_scan_entry_skips_renditions(tmp_path):
+    (tmp_path / "2024-03-01.rst").write_text("text\n")
+    (tmp_path / "plot.png").write_bytes(b"x" * 100)
+    (tmp_path / "plot.web.png").write_bytes(b"x" * 10)
+    (tmp_path / "plot.thumb.png").write_bytes(b"x" * 1)
+    (tmp_path / "data.txt").write_bytes(b"x" * 20)
+    (tmp_path / "big.h5.pjptr").write_text("pointer\n")
+    (tmp_path / ".gitignore").write_text("big.h5\n")
+
+    assert columns_util.scan_entry(tmp_path) == (2, 120)
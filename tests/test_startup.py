@@ -0,0 +1,53 @@
+"""tests that the command line doesn't import the slow modules that
+only some commands need (see benchmarks/bench_startup.py for the
+timing)"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+# the modules that are only imported by the commands that use them
+LAZY_MODULES = ["sphinx", "PIL", "sqlite3", "webbrowser"]
+
+REPORT = f"print('loaded:', *(m for m in {LAZY_MODULES} if m in sys.modules))"
+
+IMPORT = f"import sys\nimport pyjournal2.main_util\n{REPORT}\n"
+
+RUN = f"""import sys
+sys.argv = ["pyjournal"] + sys.argv[1:]
+from pyjournal2.main_util import run
+try:
+    run()
+except SystemExit:
+    pass
+{REPORT}
+"""
+
+
+def get_loaded(home, code, args):
+    """run code in a new interpreter and return the lazy modules it
+    loaded"""
+
+    # a minimal configuration, so we get past the initialization check
+    (home / ".pyjournal2rc").write_text("[main]\n"
+                                        f"master_repo = {home}/journal-test.git\n"
+                                        f"working_path = {home}\n"
+                                        "nickname = test\n")
+
+    p = subprocess.run([sys.executable, "-c", code] + args, env=dict(os.environ, HOME=str(home)),
+                       capture_output=True, text=True, check=True)
+
+    report = [line for line in p.stdout.splitlines() if line.startswith("loaded:")]
+    assert len(report) == 1
+    return report[0].split()[1:]
+
+
+def test_import(tmp_path):
+    assert get_loaded(tmp_path, IMPORT, []) == []
+
+
+@pytest.mark.parametrize("args", [["--help"], ["status"]])
+def test_command(tmp_path, args):
+    assert get_loaded(tmp_path, RUN, args) == []